@@ -21,39 +21,11 @@
 # Exit immediately if a command exits with a non-zero status.
 set -e
 
-# Wait for the database to be ready.
-# A simple sleep is used here for demonstration. In production, you might
-# use a more robust script like wait-for-it.sh.
-echo "Waiting for database..."
-# Wait 15 seconds to ensure the database is up and running.
-sleep 15
-
-# Run Django management commands
-echo "Applying database migrations..."
-python manage.py migrate
-
-echo "Creating superuser..."
-# This command uses a Python script to create a superuser non-interactively.
-# It checks if the user already exists to make the script idempotent.
-python manage.py shell <<EOF
-import os
-from library.models import User
-if not User.objects.filter(username='admin').exists():
-    password = os.environ.get('DJANGO_SUPERUSER_PASSWORD')
-    if not password:
-        raise ValueError("DJANGO_SUPERUSER_PASSWORD environment variable not set")
-    User.objects.create_superuser('admin', 'admin@example.com', password)
-    print(f'Superuser "admin" created.')
-else:
-    print('Superuser "admin" already exists.')
-EOF
-
-echo "Seeding database with initial data..."
-python manage.py seed_data --clear
-
-echo "Collecting static files..."
-# The --noinput flag prevents any interactive prompts, and --clear removes old files.
-python manage.py collectstatic --noinput --clear
+# Wait for the database, apply pending migrations, create the superuser,
+# seed an empty database, build the OpenAPI schema and collect static files.
+# Each phase is skipped when there is nothing to do, and the time spent in
+# each one is reported. See library/management/commands/bootstrap.py.
+python manage.py bootstrap
 
 echo "Database setup complete. Starting server."
 
@@ -7,17 +7,71 @@ making them accessible and manageable through the admin panel.
 
 Author: Raul Berrios
 """
+from django.conf import settings
 from django.contrib import admin
 from django.contrib import messages
-from django.utils import timezone
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import transaction
 from django.utils.translation import ngettext
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 
-from .models import Book, Checkout, User
+from .cache import invalidate_books
+from .circulation import return_checkouts
+from .models import Book, Checkout, Hold, StockMovement, Task, User
+from .pagination import EstimatedCountPaginator
+from .stock import lock_stock, set_stock
+
+
+class CachedChoicesFilter(admin.SimpleListFilter):
+    """
+    A list filter offering the distinct values of the `parameter_name`
+    column.
+
+    Django's default filter runs a `SELECT DISTINCT` over the whole table
+    on every changelist page; here the choices are cached for
+    `LIBRARY_ADMIN_FILTER_CACHE_SECONDS`, so a value added meanwhile shows
+    up once the cache expires.
+    """
+
+    def lookups(self, request, model_admin):
+        field = self.parameter_name
+        key = f'library:admin:choices:{model_admin.model._meta.label_lower}:{field}'
+        values = cache.get_or_set(
+            key,
+            lambda: list(model_admin.model.objects.order_by(field).values_list(field, flat=True).distinct()),
+            settings.LIBRARY_ADMIN_FILTER_CACHE_SECONDS,
+        )
+        return [(str(value), value) for value in values]
+
+    def queryset(self, request, queryset):
+        if self.value() is None:
+            return queryset
+        return queryset.filter(**{self.parameter_name: self.value()})
+
+
+class GenreFilter(CachedChoicesFilter):
+    title = 'genre'
+    parameter_name = 'genre'
+
+
+class PublishedYearFilter(CachedChoicesFilter):
+    title = 'published year'
+    parameter_name = 'published_year'
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    """
+    Base admin for tables with millions of rows: changelists are paginated
+    with estimated counts (see `EstimatedCountPaginator`) and filtered
+    pages do not count the whole table a second time.
+    """
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
 
 @admin.register(User)
-class UserAdmin(BaseUserAdmin):
+class UserAdmin(LargeTableAdmin, BaseUserAdmin):
     """
     Customizes the admin interface for the User model.
 
@@ -34,7 +88,7 @@ class UserAdmin(BaseUserAdmin):
 
 
 @admin.register(Book)
-class BookAdmin(admin.ModelAdmin):
+class BookAdmin(LargeTableAdmin):
     """
     Admin interface configuration for the Book model.
 
@@ -43,20 +97,64 @@ class BookAdmin(admin.ModelAdmin):
     """
     list_display = ('title', 'author', 'published_year', 'genre', 'stock')
     search_fields = ('title', 'author', 'genre')
-    list_filter = ('genre', 'published_year')
+    list_filter = (GenreFilter, PublishedYearFilter)
+    readonly_fields = ('stock_shards',)
+
+    def get_form(self, request, obj=None, **kwargs):
+        """Posts the stock shown in the form back with it (see `save_model`)."""
+        form = super().get_form(request, obj, **kwargs)
+        if 'stock' in form.base_fields:
+            form.base_fields['stock'].show_hidden_initial = True
+        return form
+
+    def save_model(self, request, obj, form, change):
+        """
+        Saves the book and drops its cached API representation. An edited
+        stock is applied as the difference to the stock shown in the form
+        with `set_stock`, so it is recorded in the stock ledger and copies
+        lent or returned meanwhile are not overwritten: the stock it is added
+        to is read under the stock lock, as the form already changed `obj`.
+        """
+        if not change:
+            super().save_model(request, obj, form, change)
+        else:
+            obj.save(update_fields=[name for name in form.changed_data if name != 'stock'])
+            if 'stock' in form.changed_data:
+                try:
+                    shown = form.fields['stock'].to_python(form.data.get(form.add_initial_prefix('stock')))
+                except ValidationError:
+                    shown = None
+                delta = form.cleaned_data['stock'] - (form.initial['stock'] if shown is None else shown)
+                with transaction.atomic():
+                    set_stock(obj, max(lock_stock(obj.pk).current_stock() + delta, 0))
+        invalidate_books([obj.pk])
+
+    def delete_model(self, request, obj):
+        """Deletes the book and drops its cached API representation."""
+        invalidate_books([obj.pk])
+        super().delete_model(request, obj)
+
+    def delete_queryset(self, request, queryset):
+        """Deletes the selected books and drops their cached API representations."""
+        invalidate_books(queryset.values_list('pk', flat=True))
+        super().delete_queryset(request, queryset)
 
 
 @admin.register(Checkout)
-class CheckoutAdmin(admin.ModelAdmin):
+class CheckoutAdmin(LargeTableAdmin):
     """
     Admin interface configuration for the Checkout model.
 
     Displays checkout records and provides an action to mark books as returned,
-    which updates the book's stock accordingly.
+    which updates the book's stock accordingly. Students and books are joined
+    into the changelist query and picked with autocomplete widgets instead of
+    selects listing every user and book.
     """
-    list_display = ('student', 'book', 'checkout_date', 'return_date')
+    list_display = ('student', 'book', 'checkout_date', 'due_date', 'return_date', 'is_overdue')
+    list_select_related = ('student', 'book')
+    autocomplete_fields = ('student', 'book')
     search_fields = ('student__username', 'book__title')
-    list_filter = ('return_date',)
+    list_filter = ('return_date', 'is_overdue')
     actions = ['mark_as_returned']
 
     @admin.action(description='Mark selected checkouts as returned')
@@ -64,18 +162,12 @@ class CheckoutAdmin(admin.ModelAdmin):
         """
         Admin action to mark one or more checkout records as returned.
 
-        This action sets the `return_date` to the current time and increments
-        the stock for the associated book. It only processes active checkouts
-        (those without a `return_date`).
+        This action sets the `return_date` to the current time and, like the
+        API's return endpoint, lends each copy to the next hold on the book
+        or increments its stock, atomically. It only processes active
+        checkouts (those without a `return_date`).
         """
-        active_checkouts = queryset.filter(return_date__isnull=True)
-        updated_count = 0
-        for checkout in active_checkouts:
-            checkout.return_date = timezone.now()
-            checkout.book.stock += 1
-            checkout.book.save()
-            checkout.save()
-            updated_count += 1
+        updated_count = return_checkouts(queryset.filter(return_date__isnull=True))
 
         if updated_count > 0:
             self.message_user(request, ngettext(
@@ -85,3 +177,62 @@ class CheckoutAdmin(admin.ModelAdmin):
             ) % updated_count, messages.SUCCESS)
         else:
             self.message_user(request, 'No active checkouts were selected to be returned.', messages.WARNING)
+
+
+@admin.register(Hold)
+class HoldAdmin(LargeTableAdmin):
+    """
+    Admin interface configuration for the Hold model.
+
+    Shows the hold queues; holds are fulfilled automatically when copies
+    are returned.
+    """
+    list_display = ('student', 'book', 'status', 'created_at', 'fulfilled_at')
+    list_select_related = ('student', 'book')
+    autocomplete_fields = ('student', 'book')
+    raw_id_fields = ('checkout',)
+    search_fields = ('student__username', 'book__title')
+    list_filter = ('status',)
+
+
+@admin.register(StockMovement)
+class StockMovementAdmin(LargeTableAdmin):
+    """
+    Read-only admin interface for the stock ledger.
+
+    Movements are only written by the stock and circulation operations, so
+    they can be browsed but not added, changed or deleted here.
+    """
+    list_display = ('book', 'delta', 'reason', 'checkout', 'created_at')
+    list_select_related = ('book',)
+    list_filter = ('reason',)
+    raw_id_fields = ('book', 'checkout')
+    search_fields = ('book__title',)
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(Task)
+class TaskAdmin(LargeTableAdmin):
+    """
+    Admin interface configuration for the Task model.
+
+    Lists the background tasks and their outcome. Tasks are queued by the
+    API and `manage.py enqueue_task` and run by `manage.py run_worker`, so
+    they cannot be added here.
+    """
+    list_display = ('id', 'name', 'status', 'priority', 'attempts', 'created_by', 'created_at', 'finished_at')
+    list_select_related = ('created_by',)
+    list_filter = ('status', 'name')
+    raw_id_fields = ('created_by',)
+    exclude = ('kwargs',)
+
+    def has_add_permission(self, request):
+        return False
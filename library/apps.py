@@ -19,3 +19,7 @@ class LibraryConfig(AppConfig):
     """
     default_auto_field = "django.db.models.BigAutoField"
     name = "library"
+
+    def ready(self):
+        """Connects the signal receivers keeping the autocomplete index and search documents current."""
+        from . import autocomplete, search  # noqa: F401
@@ -0,0 +1,311 @@
+"""
+library/autocomplete.py
+
+This file is part of the University Library project.
+It contains the in-memory prefix index behind `/api/books/autocomplete/`,
+which completes book titles and authors as the user types without querying
+the database.
+
+Author: Raul Berrios
+"""
+import bisect
+import threading
+import time
+from array import array
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Book
+
+TITLE = 'title'
+AUTHOR = 'author'
+
+
+def normalize(text):
+    """Returns the case- and whitespace-insensitive form of `text` used as index key."""
+    return ' '.join(text.casefold().split())
+
+
+def index_keys(text):
+    """
+    Returns the keys `text` is indexed under: its full normalized text and
+    the text starting at each later word, so "mess" completes "Dune Messiah".
+    """
+    words = normalize(text).split(' ')
+    return [' '.join(words[start:]) for start in range(len(words)) if words[start]]
+
+
+class PrefixIndex:
+    """
+    A sorted array of keys searched with `bisect`: a lookup is a binary
+    search plus a scan of the matching keys.
+
+    The keys are stored as a plain list of strings, and the title or author
+    each key belongs to as an integer slot in a parallel `array`, which
+    keeps an entry to the size of its key string plus a few bytes. Books
+    with the same title or author share its slot (slots are reference
+    counted), so an author of many books is completed once.
+
+    At most `max_entries` keys are kept; past the cap, the later-word keys
+    are dropped first, and `truncated` is set.
+    """
+
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries
+        self.keys = []
+        self.slots = array('l')
+        self.items = []        # slot -> (kind, text), or None once unused
+        self.refs = []         # slot -> number of books using it
+        self.slot_of = {}      # (kind, text) -> slot
+        self.free_slots = []
+        self.books = {}        # book id -> (title, author)
+        self.truncated = False
+        self.built_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def build(cls, books, max_entries=None):
+        """Builds an index from `(id, title, author)` tuples with a single sort."""
+        index = cls(max_entries)
+        for book_id, title, author in books:
+            index.books[book_id] = (title, author)
+            for item in index.book_items(title, author):
+                index.acquire(item)
+
+        keys, slots = [], []
+        for position in (0, 1):  # full texts first, so they survive the cap
+            for slot, (kind, text) in enumerate(index.items):
+                item_keys = index_keys(text)
+                for key in (item_keys[:1] if position == 0 else item_keys[1:]):
+                    keys.append(key)
+                    slots.append(slot)
+        if max_entries is not None and len(keys) > max_entries:
+            del keys[max_entries:], slots[max_entries:]
+            index.truncated = True
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        index.keys = [keys[position] for position in order]
+        index.slots = array('l', (slots[position] for position in order))
+        return index
+
+    @staticmethod
+    def book_items(title, author):
+        """Returns the `(kind, text)` items a book contributes."""
+        return [(kind, text) for kind, text in ((TITLE, title), (AUTHOR, author)) if normalize(text or '')]
+
+    def acquire(self, item):
+        """Adds a reference to `item` and returns `(slot, is_new)`."""
+        slot = self.slot_of.get(item)
+        if slot is not None:
+            self.refs[slot] += 1
+            return slot, False
+        if self.free_slots:
+            slot = self.free_slots.pop()
+            self.items[slot], self.refs[slot] = item, 1
+        else:
+            slot = len(self.items)
+            self.items.append(item)
+            self.refs.append(1)
+        self.slot_of[item] = slot
+        return slot, True
+
+    def add(self, book_id, title, author):
+        """Indexes a new or changed book."""
+        with self.lock:
+            self._remove(book_id)
+            self.books[book_id] = (title, author)
+            for item in self.book_items(title, author):
+                slot, is_new = self.acquire(item)
+                if not is_new:
+                    continue
+                for key in index_keys(item[1]):
+                    if self.max_entries is not None and len(self.keys) >= self.max_entries:
+                        self.truncated = True
+                        break
+                    position = bisect.bisect_right(self.keys, key)
+                    self.keys.insert(position, key)
+                    self.slots.insert(position, slot)
+
+    def remove(self, book_id):
+        """Removes a deleted book from the index."""
+        with self.lock:
+            self._remove(book_id)
+
+    def _remove(self, book_id):
+        if book_id not in self.books:
+            return
+        for item in self.book_items(*self.books.pop(book_id)):
+            slot = self.slot_of[item]
+            self.refs[slot] -= 1
+            if self.refs[slot]:
+                continue
+            for key in index_keys(item[1]):
+                position = bisect.bisect_left(self.keys, key)
+                while position < len(self.keys) and self.keys[position] == key:
+                    if self.slots[position] == slot:
+                        del self.keys[position], self.slots[position]
+                        break
+                    position += 1
+            del self.slot_of[item]
+            self.items[slot] = None
+            self.free_slots.append(slot)
+
+    def search(self, prefix, limit=10):
+        """
+        Returns up to `limit` completions of `prefix`, in alphabetical order
+        of the matched text, as `{'text': ..., 'kind': 'title' | 'author'}`.
+        """
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        results = []
+        seen = set()
+        with self.lock:
+            position = bisect.bisect_left(self.keys, prefix)
+            while position < len(self.keys) and len(results) < limit:
+                if not self.keys[position].startswith(prefix):
+                    break
+                slot = self.slots[position]
+                if slot not in seen:
+                    seen.add(slot)
+                    kind, text = self.items[slot]
+                    results.append({'text': text, 'kind': kind})
+                position += 1
+        return results
+
+
+_index = None
+_build_lock = threading.Lock()
+_building = threading.Event()
+# Book changes committed while an index is being built, replayed into it
+# before it is installed; None when no build is running.
+_pending = None
+
+
+def build_index():
+    """Builds a new index from the `Book` table."""
+    books = Book.objects.order_by().values_list('id', 'title', 'author').iterator(chunk_size=10000)
+    return PrefixIndex.build(books, settings.LIBRARY_AUTOCOMPLETE_MAX_ENTRIES)
+
+
+def apply_change(index, change):
+    """Applies a book change, `('add', id, title, author)` or `('remove', id)`, to `index`."""
+    if change[0] == 'add':
+        index.add(*change[1:])
+    else:
+        index.remove(*change[1:])
+
+
+def record_change(change):
+    """
+    Applies a committed book change to this process's index, and records it
+    for the index being built, if any, which may have read the book before
+    the change.
+    """
+    with _build_lock:
+        index = _index
+        if _pending is not None:
+            _pending.append(change)
+    if index is not None:
+        apply_change(index, change)
+
+
+def load_index():
+    """
+    Builds the index and installs it as this process's index, once the book
+    changes committed during the build have been replayed into it.
+    """
+    global _index, _pending
+    with _build_lock:
+        _pending = []
+    try:
+        index = build_index()
+        with _build_lock:
+            for change in _pending:
+                apply_change(index, change)
+            _index = index
+    finally:
+        with _build_lock:
+            _pending = None
+    return index
+
+
+def refresh_index():
+    """Rebuilds the index in a background thread."""
+    try:
+        load_index()
+    finally:
+        connections.close_all()
+        _building.clear()
+
+
+def get_index():
+    """
+    Returns this process's index, or None until it has been built.
+
+    The first call starts building the index in a background thread. Saves
+    and deletes of books in this process are applied to the index right
+    away (see the signal receivers below), and to an index being rebuilt
+    once it is done (see `load_index`); changes made by other processes,
+    or with `bulk_create` and `update()`, are picked up by a rebuild in the
+    background once the index is older than `LIBRARY_AUTOCOMPLETE_REFRESH_SECONDS`.
+    Every process holds and rebuilds its own index.
+    """
+    index = _index
+    if index is None or time.monotonic() - index.built_at > settings.LIBRARY_AUTOCOMPLETE_REFRESH_SECONDS:
+        with _build_lock:
+            if _building.is_set():
+                return index
+            _building.set()
+        threading.Thread(target=refresh_index, daemon=True).start()
+    return index
+
+
+def reset_index():
+    """Drops the index, so it is rebuilt on next use."""
+    global _index
+    _index = None
+
+
+def search_database(prefix, limit=10):
+    """
+    Returns up to `limit` titles and authors starting with `prefix` from
+    the database; used while the index is being built.
+    """
+    prefix = ' '.join(prefix.split())
+    if not prefix:
+        return []
+    results = [
+        {'text': text, 'kind': kind}
+        for kind in (TITLE, AUTHOR)
+        for text in Book.objects.filter(**{f'{kind}__istartswith': prefix}).order_by(kind).values_list(kind, flat=True).distinct()[:limit]
+    ]
+    return sorted(results, key=lambda result: normalize(result['text']))[:limit]
+
+
+def complete(prefix, limit=10):
+    """Returns up to `limit` completions of `prefix` (see `PrefixIndex.search`)."""
+    index = get_index()
+    if index is None:
+        return search_database(prefix, limit)
+    return index.search(prefix, limit)
+
+
+@receiver(post_save, sender=Book, dispatch_uid='library.autocomplete.index_book')
+def index_book(sender, instance, update_fields=None, **kwargs):
+    """Indexes a saved book once its transaction commits."""
+    if (_index is None and _pending is None) or (update_fields is not None and not {'title', 'author'} & set(update_fields)):
+        return
+    change = ('add', instance.pk, instance.title, instance.author)
+    transaction.on_commit(lambda: record_change(change))
+
+
+@receiver(post_delete, sender=Book, dispatch_uid='library.autocomplete.unindex_book')
+def unindex_book(sender, instance, **kwargs):
+    """Removes a deleted book from the index once its transaction commits."""
+    if _index is None and _pending is None:
+        return
+    change = ('remove', instance.pk)
+    transaction.on_commit(lambda: record_change(change))
@@ -0,0 +1,174 @@
+"""
+library/batch.py
+
+This file is part of the University Library project.
+It implements `POST /api/batch/`, which runs several API requests in one
+HTTP round-trip: the sub-requests are dispatched in-process to the views of
+`library.urls`, reusing the authentication of the batch request.
+
+Author: Raul Berrios
+"""
+import contextvars
+import io
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import close_old_connections, connections
+from django.http import HttpRequest, QueryDict
+from django.urls import Resolver404, resolve
+from drf_spectacular.types import OpenApiTypes
+from drf_spectacular.utils import extend_schema
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+
+from .budget import current_budget, track_thread
+from .serializers import BatchSerializer
+
+logger = logging.getLogger(__name__)
+
+PREFIX = '/api/'
+
+# Endpoints which cannot run inside a batch: nested batches, and the event
+# stream, whose response never ends.
+EXCLUDED_URL_NAMES = {'batch', 'event-stream'}
+
+# Request metadata copied from the batch request to every sub-request.
+INHERITED_META = ('REMOTE_ADDR', 'SERVER_NAME', 'SERVER_PORT', 'SERVER_PROTOCOL', 'wsgi.url_scheme')
+
+# Headers of the batch request which describe that one request (its body,
+# its replay key, its conditions) and are not copied to the sub-requests;
+# a sub-request sends its own in `headers`.
+REQUEST_SCOPED_HEADERS = {
+    'HTTP_CONTENT_LENGTH', 'HTTP_CONTENT_TYPE', 'HTTP_IDEMPOTENCY_KEY', 'HTTP_IF_MATCH', 'HTTP_IF_NONE_MATCH',
+    'HTTP_IF_MODIFIED_SINCE', 'HTTP_IF_UNMODIFIED_SINCE', 'HTTP_RANGE', 'HTTP_LAST_EVENT_ID',
+}
+
+
+def elapsed_ms(started):
+    """Returns the milliseconds elapsed since `started` (a `perf_counter` value)."""
+    return round((time.perf_counter() - started) * 1000, 2)
+
+
+def build_request(parent, item):
+    """
+    Builds the `HttpRequest` of a sub-request from its method, path, body
+    and headers. It carries the headers of the batch request (so content
+    negotiation and `Accept-Language` behave the same), except the
+    `REQUEST_SCOPED_HEADERS` such as `Idempotency-Key`, and is marked as
+    authenticated as the batch request's user, so DRF skips authentication.
+    """
+    url = urlsplit(item['path'])
+    request = HttpRequest()
+    request.method = item['method']
+    request.path = request.path_info = url.path
+    request.GET = QueryDict(url.query)
+    request.COOKIES = parent.COOKIES
+    request.META = {
+        key: value for key, value in parent.META.items()
+        if (key.startswith('HTTP_') and key not in REQUEST_SCOPED_HEADERS) or key in INHERITED_META
+    }
+    request.META.update(REQUEST_METHOD=item['method'], PATH_INFO=url.path, QUERY_STRING=url.query)
+    for name, value in item.get('headers', {}).items():
+        request.META['HTTP_' + name.upper().replace('-', '_')] = value
+
+    body = json.dumps(item['body'], cls=DjangoJSONEncoder).encode() if 'body' in item else b''
+    request.META.update(CONTENT_TYPE='application/json', CONTENT_LENGTH=str(len(body)))
+    request._stream = io.BytesIO(body)
+    request._read_started = False
+
+    request._force_auth_user = parent.user
+    request._force_auth_token = parent.auth
+    return request
+
+
+def dispatch(parent, item):
+    """
+    Runs one sub-request and returns its `{'status', 'body', 'duration_ms'}`
+    entry. Errors of a sub-request are reported in its entry and never fail
+    the batch.
+    """
+    started = time.perf_counter()
+    path = urlsplit(item['path']).path
+    if not path.startswith(PREFIX):
+        return {'status': 400, 'body': {'detail': f'The path must start with {PREFIX}.'}, 'duration_ms': elapsed_ms(started)}
+    try:
+        match = resolve(path[len(PREFIX) - 1:], urlconf='library.urls')
+    except Resolver404:
+        return {'status': 404, 'body': {'detail': 'Not found.'}, 'duration_ms': elapsed_ms(started)}
+    if match.url_name in EXCLUDED_URL_NAMES:
+        return {'status': 400, 'body': {'detail': 'This endpoint cannot be used in a batch.'}, 'duration_ms': elapsed_ms(started)}
+
+    request = build_request(parent, item)
+    request.resolver_match = match
+    try:
+        response = match.func(request, *match.args, **match.kwargs)
+        if hasattr(response, 'render'):
+            response.render()
+    except Exception:
+        logger.exception('Batch sub-request %s %s failed', item['method'], item['path'])
+        return {'status': 500, 'body': {'detail': 'A server error occurred.'}, 'duration_ms': elapsed_ms(started)}
+
+    if hasattr(response, 'data'):
+        body = response.data
+    elif response.get('Content-Type', '').startswith('application/json') and response.content:
+        body = json.loads(response.content)
+    else:
+        body = response.content.decode(response.charset) or None
+    return {'status': response.status_code, 'body': body, 'duration_ms': elapsed_ms(started)}
+
+
+def dispatch_in_thread(parent, item):
+    """
+    Runs `dispatch` in a worker thread, closing the thread's connection
+    afterwards. Runs in a copy of the batch request's context, whose request
+    budget (see `library.budget`) then also covers the thread's statements.
+    """
+    close_old_connections()
+    try:
+        track_thread(current_budget.get())
+        return dispatch(parent, item)
+    finally:
+        connections.close_all()
+
+
+@extend_schema(
+    request=BatchSerializer,
+    responses={200: OpenApiTypes.OBJECT},
+)
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def batch_api(request):
+    """
+    Runs up to `LIBRARY_BATCH_MAX_REQUESTS` API requests in one round-trip
+    and returns their responses, in order:
+
+        {"requests": [{"method": "GET", "path": "/api/books/1/"},
+                      {"method": "GET", "path": "/api/checkouts/?page=2"}]}
+
+    Each sub-request is routed through `library.urls` like a normal request
+    of the same user, with its own permission checks, and its entry reports
+    its status, body and duration. Sub-requests run one after the other,
+    so a write is visible to the requests after it; with `"parallel": true`
+    a batch of GET requests runs on up to `LIBRARY_BATCH_WORKERS` threads.
+    Middleware runs once, for the batch request.
+    """
+    serializer = BatchSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+    items = serializer.validated_data['requests']
+    parallel = serializer.validated_data['parallel'] and all(item['method'] == 'GET' for item in items)
+
+    started = time.perf_counter()
+    if parallel and len(items) > 1:
+        with ThreadPoolExecutor(max_workers=min(settings.LIBRARY_BATCH_WORKERS, len(items))) as executor:
+            # One context per sub-request: a context cannot be entered by two threads at once.
+            contexts = [contextvars.copy_context() for _ in items]
+            responses = list(executor.map(lambda item, context: context.run(dispatch_in_thread, request, item), items, contexts))
+    else:
+        responses = [dispatch(request, item) for item in items]
+    return Response({'responses': responses, 'parallel': parallel, 'duration_ms': elapsed_ms(started)})
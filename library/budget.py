@@ -0,0 +1,252 @@
+"""
+library/budget.py
+
+This file is part of the University Library project.
+It contains the request budget middleware, which limits the number of SQL
+queries, the total SQL time and the duration of single statements per
+request, so that one regressed endpoint (e.g. an N+1 query) cannot hold a
+worker and its database connection for long.
+
+Author: Raul Berrios
+"""
+import json
+import logging
+import threading
+import time
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import DEFAULT_DB_ALIAS, OperationalError, connections
+from django.http import JsonResponse
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+logger = logging.getLogger(__name__)
+
+HEADER = 'X-Request-Budget'
+
+# Number of statements listed in the log line of a request over budget.
+TOP_STATEMENTS = 5
+
+# SQLite checks the statement timeout every this many virtual machine steps.
+SQLITE_PROGRESS_STEPS = 10000
+
+# The budget of the request being served, set by the middleware before the
+# view runs. A context variable, so that it follows the request into the
+# thread running a synchronous view under ASGI, and into the worker threads
+# of a parallel batch (see `track_thread`).
+current_budget = ContextVar('library_request_budget', default=None)
+
+
+class BudgetExceeded(APIException):
+    """Aborts a request over its budget with 503 Service Unavailable."""
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'This request used too many database resources and was stopped.'
+    default_code = 'request_budget_exceeded'
+
+
+def route_budget(route):
+    """
+    Returns the limits of the URL name `route` from `LIBRARY_REQUEST_BUDGETS`,
+    merged over the default ones, or None when the route is exempt.
+    """
+    budgets = settings.LIBRARY_REQUEST_BUDGETS
+    if route in budgets and budgets[route] is None:
+        return None
+    return {**budgets['default'], **budgets.get(route, {})}
+
+
+class RequestBudget:
+    """
+    Counts and times the SQL statements of one request, as an execute
+    wrapper (see `track`). When `enforce` is set, the statement which would
+    go over the query count, or any statement once the SQL time is spent,
+    raises `BudgetExceeded` instead of running. The statements of a request
+    may run on several threads (a parallel batch), hence the lock.
+    """
+
+    def __init__(self, route, limits, enforce):
+        self.route = route
+        self.max_queries = limits['queries']
+        self.max_sql_ms = limits['sql_ms']
+        self.timeout_ms = limits['statement_timeout_ms']
+        self.enforce = enforce
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.statements = {}  # sql -> [count, seconds]
+        self.aborted = False
+        self.lock = threading.Lock()
+
+    @property
+    def sql_ms(self):
+        return self.sql_seconds * 1000
+
+    def exceeded(self):
+        """Returns whether the request went over its query count or SQL time."""
+        return self.queries > self.max_queries or self.sql_ms > self.max_sql_ms
+
+    def summary(self):
+        """Returns the usage of the request against its limits, for the response header."""
+        return f'queries={self.queries}/{self.max_queries}, sql_ms={self.sql_ms:.0f}/{self.max_sql_ms:.0f}'
+
+    def top_statements(self):
+        """Returns the statements which took the most time, with their counts."""
+        slowest = sorted(self.statements.items(), key=lambda item: -item[1][1])[:TOP_STATEMENTS]
+        return [{'sql': sql[:300], 'count': count, 'ms': round(seconds * 1000, 1)} for sql, (count, seconds) in slowest]
+
+    def __call__(self, execute, sql, params, many, context):
+        with self.lock:
+            if self.enforce and (self.queries >= self.max_queries or self.sql_ms > self.max_sql_ms):
+                self.aborted = True
+                raise BudgetExceeded()
+            self.queries += 1
+        connection = context['connection']
+        started = time.perf_counter()
+        try:
+            if connection.vendor == 'sqlite' and self.timeout_ms:
+                return self.execute_with_deadline(connection, execute, sql, params, many, context, started)
+            return execute(sql, params, many, context)
+        except OperationalError as error:
+            # PostgreSQL's statement_timeout cancels the statement (SQLSTATE 57014).
+            if getattr(error.__cause__, 'pgcode', None) == '57014':
+                self.aborted = True
+                raise BudgetExceeded('A database statement of this request took too long and was stopped.') from error
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            with self.lock:
+                self.sql_seconds += elapsed
+                entry = self.statements.setdefault(sql, [0, 0.0])
+                entry[0] += 1
+                entry[1] += elapsed
+
+    def execute_with_deadline(self, connection, execute, sql, params, many, context, started):
+        """Runs a SQLite statement, interrupting it once it runs past the statement timeout."""
+        deadline = started + self.timeout_ms / 1000
+        connection.connection.set_progress_handler(lambda: time.perf_counter() > deadline, SQLITE_PROGRESS_STEPS)
+        try:
+            return execute(sql, params, many, context)
+        except OperationalError as error:
+            if time.perf_counter() > deadline:
+                self.aborted = True
+                raise BudgetExceeded('A database statement of this request took too long and was stopped.') from error
+            raise
+        finally:
+            connection.connection.set_progress_handler(None, SQLITE_PROGRESS_STEPS)
+
+
+def track(execute, sql, params, many, context):
+    """Execute wrapper passing the statements of requests to their budget."""
+    budget = current_budget.get()
+    if budget is None:
+        return execute(sql, params, many, context)
+    return budget(execute, sql, params, many, context)
+
+
+def set_statement_timeout(timeout_ms):
+    """
+    Sets PostgreSQL's `statement_timeout` on the default connection (0 for
+    none). The setting stays on the (persistent) connection, so it is set
+    for every request, also to 0 when the request has no timeout, but only
+    sent when it differs from the one the connection already has.
+    """
+    connection = connections[DEFAULT_DB_ALIAS]
+    if connection.vendor != 'postgresql':
+        return
+    connection.ensure_connection()
+    if getattr(connection, 'library_statement_timeout', None) == (connection.connection, timeout_ms):
+        return
+    with connection.connection.cursor() as cursor:
+        cursor.execute('SET statement_timeout = %s', [timeout_ms])
+    connection.library_statement_timeout = (connection.connection, timeout_ms)
+
+
+def track_thread(budget):
+    """
+    Applies `budget` (or no budget) to the connections of the current
+    thread: installs the `track` wrapper on them and sets their statement
+    timeout.
+    """
+    if budget is not None:
+        for connection in connections.all():
+            if track not in connection.execute_wrappers:
+                connection.execute_wrappers.append(track)
+    set_statement_timeout(budget.timeout_ms or 0 if budget is not None else 0)
+
+
+class RequestBudgetMiddleware:
+    """
+    Applies the budget of its route (see `LIBRARY_REQUEST_BUDGETS`) to every
+    request: a statement timeout, and a limit on its number of queries and
+    total SQL time.
+
+    In 'log' mode a request over budget is served, with an `X-Request-Budget`
+    header reporting its usage and a warning log line listing its slowest
+    statements. In 'enforce' mode it is stopped with a 503 response as soon
+    as it goes over. Statements running past the statement timeout are
+    stopped with a 503 in both modes. The cost per request is a timer and a
+    dictionary update per statement.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if settings.LIBRARY_REQUEST_BUDGET_MODE == 'off':
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        response = self.get_response(request)
+        return self.finish(request, response)
+
+    async def __acall__(self, request):
+        response = await self.get_response(request)
+        return self.finish(request, response)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        """
+        Starts tracking the request once its route is known. This runs in the
+        thread which runs a synchronous view, also under ASGI, so the wrapper
+        is installed on the connections that thread uses.
+        """
+        route = request.resolver_match.url_name
+        limits = route_budget(route)
+        budget = None if limits is None else RequestBudget(route, limits, settings.LIBRARY_REQUEST_BUDGET_MODE == 'enforce')
+        track_thread(budget)
+        current_budget.set(budget)
+        return None
+
+    def process_exception(self, request, exception):
+        """Answers a budget abort in a view outside DRF (e.g. the admin) with a 503."""
+        if isinstance(exception, BudgetExceeded):
+            return JsonResponse({'detail': str(exception.detail)}, status=exception.status_code)
+        return None
+
+    def finish(self, request, response):
+        """Stops tracking the request, and reports it when it went over budget."""
+        budget = current_budget.get()
+        if budget is None:
+            return response
+        current_budget.set(None)
+        if budget.aborted or budget.exceeded():
+            response[HEADER] = budget.summary()
+            logger.warning('Request over budget: %s', json.dumps({
+                'method': request.method,
+                'path': request.path,
+                'route': budget.route,
+                'action': 'aborted' if budget.aborted else 'logged',
+                'status': response.status_code,
+                'queries': budget.queries,
+                'max_queries': budget.max_queries,
+                'sql_ms': round(budget.sql_ms, 1),
+                'max_sql_ms': budget.max_sql_ms,
+                'top_statements': budget.top_statements(),
+            }))
+        return response
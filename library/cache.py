@@ -0,0 +1,103 @@
+"""
+library/cache.py
+
+This file is part of the University Library project.
+It contains the keys and invalidation helpers of the data cached by the API:
+the student dashboard (`/api/me/dashboard/`) and the book representations
+served by the multi-get endpoint (`/api/books/bulk/`).
+
+Every cached entry is stored with the version its key had when the entry
+was built, and invalidation gives the key a new version instead of deleting
+the entry. An entry built from data read before an invalidation committed
+is thus never served, even when it is written after the invalidation.
+
+Author: Raul Berrios
+"""
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+DASHBOARD_KEY = 'library:dashboard:{}'
+BOOK_KEY = 'library:book:{}'
+VERSION_KEY = '{}:version'
+
+
+def new_version():
+    """Returns a version no key ever had, also after the cache lost its versions."""
+    return uuid.uuid4().hex
+
+
+def get_versioned(keys):
+    """
+    Returns the cached values of `keys` which are still current, and the
+    current versions of all `keys`, in one round trip to the cache.
+
+    The versions must be read before the data of missing values is, and
+    passed with the values to `set_versioned`.
+    """
+    version_keys = {key: VERSION_KEY.format(key) for key in keys}
+    found = cache.get_many([*keys, *version_keys.values()])
+    values, versions = {}, {}
+    for key in keys:
+        version = found.get(version_keys[key])
+        if version is None:
+            version = new_version()
+            if not cache.add(version_keys[key], version, None):
+                version = cache.get(version_keys[key], version)  # set concurrently
+        versions[key] = version
+        entry = found.get(key)
+        if entry is not None and entry[0] == version:
+            values[key] = entry[1]
+    return values, versions
+
+
+def set_versioned(values, versions, timeout):
+    """Caches `values` for `timeout` seconds, with the versions returned by `get_versioned`."""
+    cache.set_many({key: (versions[key], value) for key, value in values.items()}, timeout)
+
+
+def invalidate(keys):
+    """
+    Gives `keys` new versions once the current transaction commits, so
+    their entries are rebuilt from the committed state.
+    """
+    if keys:
+        transaction.on_commit(lambda: cache.set_many({VERSION_KEY.format(key): new_version() for key in keys}, None))
+
+
+def dashboard_key(user_id):
+    """Returns the cache key of a user's dashboard."""
+    return DASHBOARD_KEY.format(user_id)
+
+
+def dashboard_timeout(next_due_date, now):
+    """
+    Returns how long a dashboard may be cached: `LIBRARY_DASHBOARD_CACHE_SECONDS`,
+    or less if one of its loans becomes overdue sooner, so the cached
+    overdue flags are never wrong.
+    """
+    timeout = settings.LIBRARY_DASHBOARD_CACHE_SECONDS
+    if next_due_date is not None and next_due_date > now:
+        timeout = min(timeout, int((next_due_date - now).total_seconds()) + 1)
+    return timeout
+
+
+def invalidate_dashboards(user_ids):
+    """Invalidates the cached dashboards of `user_ids` (see `invalidate`)."""
+    invalidate([dashboard_key(user_id) for user_id in set(user_ids)])
+
+
+def book_key(book_id):
+    """Returns the cache key of a book's representation."""
+    return BOOK_KEY.format(book_id)
+
+
+def invalidate_books(book_ids):
+    """
+    Invalidates the cached representations of `book_ids` (see
+    `invalidate`). Called whenever a book, its stock or its number of
+    active loans changes.
+    """
+    invalidate([book_key(book_id) for book_id in set(book_ids)])
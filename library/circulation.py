@@ -0,0 +1,214 @@
+"""
+library/circulation.py
+
+This file is part of the University Library project.
+It contains the circulation operations shared by the API views, the admin
+and the management commands: opening and returning loans and managing the
+per-book hold queues that returned copies are allocated to. Every operation
+also updates the daily circulation rollups, records its stock changes in the
+stock ledger (see `library.stock`) and its changes in the event outbox (see
+`library.events`) in the same transaction, and drops the cached dashboards
+of the students it affects and the cached book.
+
+Author: Raul Berrios
+"""
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+
+from .cache import invalidate_books, invalidate_dashboards
+from .events import publish_availability, publish_checkout
+from .models import Book, Checkout, Hold, OutboxEvent, StockMovement, User
+from .rollups import record_checkout, record_return
+from .stock import put_copy, record_movement, take_copy
+
+
+def lock_book(book_id):
+    """
+    Locks a book row for the rest of the current transaction.
+
+    Returns, hold placement and hold allocation for the same book take this
+    lock first, so they are serialized per title while different titles
+    proceed in parallel.
+    """
+    return Book.objects.select_for_update().get(pk=book_id)
+
+
+def invalidate_queue(book_id, *student_ids):
+    """
+    Drops the cached dashboards of `student_ids` and of every student
+    waiting for `book_id`, whose positions in the queue may have changed.
+    """
+    waiting = Hold.objects.filter(book_id=book_id, status=Hold.PENDING).values_list('student_id', flat=True)
+    invalidate_dashboards([*student_ids, *waiting])
+
+
+def take_loan_slot(student, enforce_limit=True):
+    """
+    Counts a new loan in `student.active_checkout_count` and returns True,
+    or returns False if the student already has as many active loans as
+    their role allows. The check and the increment are one conditional
+    UPDATE, so concurrent checkouts cannot exceed the limit.
+    """
+    students = User.objects.filter(pk=student.pk)
+    if enforce_limit:
+        students = students.filter(active_checkout_count__lt=User.loan_limit(student.role))
+    return students.update(active_checkout_count=F('active_checkout_count') + 1) == 1
+
+
+def release_loan_slot(student_id):
+    """Uncounts a returned loan from the student's active loans."""
+    User.objects.filter(pk=student_id, active_checkout_count__gt=0).update(active_checkout_count=F('active_checkout_count') - 1)
+
+
+def loan_limit_error(student):
+    """Returns the error raised when `student` has reached their loan limit."""
+    limit = User.loan_limit(student.role)
+    return ValidationError({'detail': f'You have reached the limit of {limit} active loans. Return a book first.'})
+
+
+def open_loan(student, book):
+    """
+    Creates the loan record for a copy that has already been taken out of
+    stock (or allocated from a hold) and counts it in the rollups.
+    """
+    checkout = Checkout.objects.create(student=student, book=book)
+    record_checkout(checkout, book)
+    publish_checkout(OutboxEvent.CHECKOUT_CREATED, checkout)
+    invalidate_dashboards([student.pk])
+    invalidate_books([book.pk])
+    return checkout
+
+
+def checkout_book(student, book):
+    """
+    Lends a copy of `book` to `student`, decrementing its stock (see
+    `library.stock.take_copy`) and counting the loan against the student's
+    limit (see `take_loan_slot`).
+
+    Raises `ValidationError` if the last copy of the book was taken
+    concurrently or the student reached their loan limit, and
+    `IntegrityError` if the student already has an active loan of the book
+    (the `unique_active_checkout` constraint); the transaction is rolled
+    back, so the stock and the counter are left untouched.
+
+    The stock row is updated before the student's row, like in
+    `return_checkout`, so concurrent checkouts and returns cannot deadlock.
+    """
+    with transaction.atomic():
+        if not take_copy(book):
+            raise ValidationError({'book': 'This book is out of stock. Place a hold to get the next returned copy.'})
+        if not take_loan_slot(student):
+            raise loan_limit_error(student)
+        checkout = open_loan(student, book)
+        record_movement(book.pk, -1, StockMovement.CHECKOUT, checkout)
+        publish_availability(book.pk, Book.objects.get(pk=book.pk).current_stock())
+        return checkout
+
+
+def place_hold(student, book):
+    """
+    Adds `student` to the end of the hold queue of `book`.
+
+    Holds can only be placed on books that are out of stock; otherwise the
+    student should simply check the book out. Raises `ValidationError` when
+    the hold cannot be placed.
+    """
+    with transaction.atomic():
+        book = lock_book(book.pk)
+        if book.current_stock() > 0:
+            raise ValidationError({'book': 'This book is available; check it out instead.'})
+        if Checkout.objects.filter(student=student, book=book, return_date__isnull=True).exists():
+            raise ValidationError({'book': 'You have already checked out this book.'})
+        if Hold.objects.filter(student=student, book=book, status=Hold.PENDING).exists():
+            raise ValidationError({'book': 'You already have a hold on this book.'})
+        if User.objects.filter(pk=student.pk, active_checkout_count__gte=User.loan_limit(student.role)).exists():
+            raise loan_limit_error(student)
+        invalidate_dashboards([student.pk])
+        return Hold.objects.create(student=student, book=book)
+
+
+def cancel_hold(hold):
+    """Cancels a pending hold. Fulfilled or cancelled holds are left untouched."""
+    with transaction.atomic():
+        cancelled = Hold.objects.filter(pk=hold.pk, status=Hold.PENDING).update(status=Hold.CANCELLED) == 1
+        if cancelled:
+            invalidate_queue(hold.book_id, hold.student_id)
+        return cancelled
+
+
+def allocate_to_next_hold(book, now):
+    """
+    Lends the copy of `book` that was just returned to the oldest pending
+    hold and returns that hold, or None if the queue is empty.
+
+    Must be called inside a transaction holding the book's lock (see
+    `lock_book`). Holds whose student meanwhile got a copy by other means
+    are cancelled and skipped. The loan counts towards the student's active
+    loans even if they reached their limit since placing the hold.
+    """
+    queue = Hold.objects.filter(book=book, status=Hold.PENDING).select_related('student').order_by('created_at', 'id')
+    skipped = []
+    for hold in queue.iterator():
+        if Checkout.objects.filter(student_id=hold.student_id, book=book, return_date__isnull=True).exists():
+            hold.status = Hold.CANCELLED
+            hold.save(update_fields=['status'])
+            skipped.append(hold.student_id)
+            continue
+        take_loan_slot(hold.student, enforce_limit=False)
+        hold.checkout = open_loan(hold.student, book)
+        hold.status = Hold.FULFILLED
+        hold.fulfilled_at = now
+        hold.save(update_fields=['checkout', 'status', 'fulfilled_at'])
+        invalidate_queue(book.pk, *skipped)
+        return hold
+    invalidate_dashboards(skipped)
+    return None
+
+
+def return_checkout(checkout):
+    """
+    Marks a loan as returned and puts the copy back into circulation.
+
+    In a single transaction, the loan is closed, the returned copy is
+    either allocated to the next hold on the book or added back to its
+    stock, and the loan is uncounted from the student's active loans. Returns `(returned, hold)`: `returned` is False if the loan had
+    already been returned, `hold` is the hold the copy was allocated to.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        book = lock_book(checkout.book_id)
+        returned = Checkout.objects.filter(pk=checkout.pk, return_date__isnull=True).update(return_date=now)
+        if not returned:
+            return False, None
+        checkout.return_date = now
+        record_return(checkout, book)
+        publish_checkout(OutboxEvent.CHECKOUT_RETURNED, checkout)
+        invalidate_dashboards([checkout.student_id])
+        invalidate_books([book.pk])
+
+        hold = allocate_to_next_hold(book, now)
+        if hold is None:
+            stock = book.current_stock() + 1
+            put_copy(book)
+            record_movement(book.pk, 1, StockMovement.RETURN, checkout)
+            publish_availability(book.pk, stock)
+        release_loan_slot(checkout.student_id)
+        return True, hold
+
+
+def return_checkouts(checkouts):
+    """
+    Returns several loans at once, e.g. from the admin's bulk action.
+
+    Loans are processed in book order so concurrent bulk returns take the
+    book locks in the same order and cannot deadlock. Returns the number of
+    loans that were actually returned.
+    """
+    returned_count = 0
+    with transaction.atomic():
+        for checkout in sorted(checkouts, key=lambda c: (c.book_id, c.pk)):
+            returned, _ = return_checkout(checkout)
+            returned_count += returned
+    return returned_count
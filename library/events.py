@@ -0,0 +1,323 @@
+"""
+library/events.py
+
+This file is part of the University Library project.
+It contains the Server-Sent Events feed of book availability and checkout
+changes: the transactional outbox the circulation operations write to, the
+broker that wakes up open streams when events are committed, and the
+asynchronous view streaming the events to clients.
+
+The view is asynchronous so that, when served through ASGI (see
+`ulibrary_api/asgi.py`), an idle stream only costs a suspended coroutine
+rather than a worker thread.
+
+Author: Raul Berrios
+"""
+import asyncio
+import contextlib
+import json
+import threading
+import time
+from functools import lru_cache
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core import signing
+from django.db import close_old_connections, transaction
+from django.db.models import Max, Q
+from django.http import JsonResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from django.views.decorators.http import require_GET
+from drf_spectacular.types import OpenApiTypes
+from drf_spectacular.utils import extend_schema
+from rest_framework.authentication import TokenAuthentication, get_authorization_header
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+
+from .models import OutboxEvent, User
+
+# Maximum number of events read from the outbox per query.
+BATCH_SIZE = 100
+
+# How long a gap in the event IDs may be waited on. IDs are allocated when a
+# transaction inserts its event, not when it commits, so a lower ID can become
+# visible after a higher one. The stream holds the events after a gap back for
+# this long, to keep them in order; after that it sends them and keeps
+# re-reading the gap (see `Cursor`).
+SETTLE_SECONDS = 2.0
+
+# A gap still empty after this long is assumed to be a rolled back transaction
+# and is no longer re-read. At most MAX_GAPS gaps, the newest, are re-read.
+GAP_SECONDS = 600.0
+MAX_GAPS = 100
+
+TICKET_SALT = 'library.events.ticket'
+
+# Reconnection delay suggested to clients, in milliseconds.
+RETRY_MS = 3000
+
+
+class InProcessBroker:
+    """
+    Wakes up the streams served by the current process when an event is
+    committed.
+
+    Streams served by other processes are not notified; they find the new
+    events on their next poll (`LIBRARY_EVENT_POLL_SECONDS`). A broker that
+    reaches every process (e.g. over Redis or PostgreSQL LISTEN/NOTIFY) can
+    be configured with `LIBRARY_EVENT_BROKER`; it needs the same `publish`
+    and `subscribe` methods.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiters = set()
+
+    def publish(self, event_id):
+        """Wakes up every subscribed stream. Called from any thread."""
+        with self._lock:
+            waiters = list(self._waiters)
+        for loop, wakeup in waiters:
+            with contextlib.suppress(RuntimeError):  # the stream's loop is closed
+                loop.call_soon_threadsafe(wakeup.set)
+
+    @contextlib.asynccontextmanager
+    async def subscribe(self):
+        """Yields an `asyncio.Event` that is set whenever an event is published."""
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self._lock:
+            self._waiters.add(waiter)
+        try:
+            yield waiter[1]
+        finally:
+            with self._lock:
+                self._waiters.discard(waiter)
+
+
+@lru_cache(maxsize=None)
+def get_broker():
+    """Returns the broker configured by `LIBRARY_EVENT_BROKER`."""
+    return import_string(settings.LIBRARY_EVENT_BROKER)()
+
+
+def publish(kind, payload, student_id=None):
+    """
+    Records an event in the outbox, as part of the current transaction.
+
+    Open streams are woken up once the transaction commits; if it rolls
+    back, the event disappears with the change it describes.
+    """
+    event = OutboxEvent.objects.create(kind=kind, payload=payload, student_id=student_id)
+    transaction.on_commit(lambda: get_broker().publish(event.pk))
+    return event
+
+
+def publish_availability(book_id, stock):
+    """Records the new stock of a book."""
+    return publish(OutboxEvent.BOOK_AVAILABILITY, {'book': book_id, 'stock': stock})
+
+
+def publish_checkout(kind, checkout):
+    """Records that a loan was opened or returned."""
+    payload = {
+        'id': checkout.pk,
+        'book': checkout.book_id,
+        'student': checkout.student_id,
+        'due_date': checkout.due_date,
+        'return_date': checkout.return_date,
+    }
+    return publish(kind, payload, student_id=checkout.student_id)
+
+
+def can_see(user, event):
+    """Loan events are visible to the borrower and to librarians only."""
+    return event.student_id is None or event.student_id == user.pk or user.role == 'librarian'
+
+
+def latest_event_id():
+    """Returns the ID of the newest event, or 0 if the outbox is empty."""
+    close_old_connections()
+    return OutboxEvent.objects.aggregate(last=Max('pk'))['last'] or 0
+
+
+class Cursor:
+    """
+    The position of a stream in the outbox: the highest event ID read, and
+    the lower IDs skipped while their transaction had not committed yet
+    (gaps), which are re-read until their event shows up or they expire.
+
+    It is sent as the SSE event ID, `<last_id>` or `<last_id>:<gap>,<gap>`,
+    so a reconnecting client resumes with its gaps as well.
+    """
+
+    def __init__(self, last_id, gaps=()):
+        self.last_id = last_id
+        now = time.monotonic()
+        self.gaps = {gap: now for gap in sorted(gaps)[-MAX_GAPS:]}  # ID -> when it was skipped
+
+    @classmethod
+    def parse(cls, value):
+        """Parses a `Last-Event-ID` value, returning None if it is not a cursor."""
+        try:
+            last_id, _, gaps = str(value).partition(':')
+            last_id = max(int(last_id), 0)
+            return cls(last_id, {int(gap) for gap in gaps.split(',') if gap and 0 < int(gap) < last_id})
+        except (TypeError, ValueError):
+            return None
+
+    def __str__(self):
+        if not self.gaps:
+            return str(self.last_id)
+        return f"{self.last_id}:{','.join(map(str, sorted(self.gaps)))}"
+
+    def skip(self, start, end):
+        """Records the IDs `start` to `end` (excluded) as gaps."""
+        now = time.monotonic()
+        for gap in range(max(start, end - MAX_GAPS), end):
+            self.gaps[gap] = now
+        for gap in sorted(self.gaps)[:-MAX_GAPS]:
+            del self.gaps[gap]
+
+    def expire(self):
+        """Forgets the gaps older than `GAP_SECONDS`."""
+        cutoff = time.monotonic() - GAP_SECONDS
+        for gap in [gap for gap, since in self.gaps.items() if since < cutoff]:
+            del self.gaps[gap]
+
+
+def read_events(user, cursor):
+    """
+    Reads the events after `cursor`, and those filling its gaps, that can
+    be sent now, advancing `cursor`.
+
+    Returns `(events, more, settle)`: `(event, cursor ID)` pairs for the
+    events `user` may see, whether a full batch was read and, when the read
+    stopped at a new gap in the IDs, how long to wait before reading again.
+
+    Runs in a worker thread, outside any request, so stale connections are
+    recycled first.
+    """
+    close_old_connections()
+    cursor.expire()
+    pending = Q(pk__gt=cursor.last_id)
+    if cursor.gaps:
+        pending |= Q(pk__in=list(cursor.gaps))
+    batch = list(OutboxEvent.objects.filter(pending).order_by('pk')[:BATCH_SIZE])
+    now = timezone.now()
+    visible = []
+    for event in batch:
+        if event.pk < cursor.last_id:
+            # A late commit filling a gap.
+            del cursor.gaps[event.pk]
+        else:
+            if event.pk != cursor.last_id + 1:
+                age = (now - event.created_at).total_seconds()
+                if age < SETTLE_SECONDS:
+                    return visible, False, SETTLE_SECONDS - age
+                cursor.skip(cursor.last_id + 1, event.pk)
+            cursor.last_id = event.pk
+        if can_see(user, event):
+            visible.append((event, str(cursor)))
+    return visible, len(batch) == BATCH_SIZE, None
+
+
+def format_event(event, event_id):
+    """Encodes an outbox event in the SSE wire format, with the stream's cursor as its ID."""
+    return f'id: {event_id}\nevent: {event.kind}\ndata: {json.dumps(event.payload)}\n\n'
+
+
+async def stream_events(user, cursor, poll_seconds=None):
+    """
+    Yields the events after `cursor` (a `Cursor`) visible to `user`, forever.
+
+    New events are read when the broker signals a commit, or after
+    `poll_seconds` without one; an idle poll sends a comment line, which
+    keeps proxies from closing the connection.
+    """
+    poll_seconds = poll_seconds or settings.LIBRARY_EVENT_POLL_SECONDS
+    fetch = sync_to_async(read_events, thread_sensitive=False)
+    async with get_broker().subscribe() as wakeup:
+        yield f'retry: {RETRY_MS}\n\n'
+        while True:
+            wakeup.clear()
+            events, more, settle = await fetch(user, cursor)
+            for event, event_id in events:
+                yield format_event(event, event_id)
+            if more:
+                continue
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout=settle or poll_seconds)
+            except asyncio.TimeoutError:
+                if settle is None:
+                    yield ': keep-alive\n\n'
+
+
+def issue_ticket(user):
+    """Returns a signed ticket opening the stream as `user` (see `authenticate`)."""
+    return signing.dumps(user.pk, salt=TICKET_SALT)
+
+
+def authenticate(request):
+    """
+    Returns the user of the request's API token, or None.
+
+    Browsers' `EventSource` cannot send headers, so the stream also accepts
+    a `?ticket=` query parameter: a ticket from `POST /api/events/ticket/`,
+    valid for `LIBRARY_EVENT_TICKET_SECONDS`. Unlike the API token, it is
+    harmless once it expires, so it may end up in proxy and access logs.
+    """
+    auth = get_authorization_header(request).split()
+    if len(auth) == 2 and auth[0].lower() == b'token':
+        try:
+            user, _ = TokenAuthentication().authenticate_credentials(auth[1].decode())
+        except AuthenticationFailed:
+            return None
+        return user
+    ticket = request.GET.get('ticket')
+    if not ticket:
+        return None
+    try:
+        user_id = signing.loads(ticket, salt=TICKET_SALT, max_age=settings.LIBRARY_EVENT_TICKET_SECONDS)
+    except signing.BadSignature:
+        return None
+    return User.objects.filter(pk=user_id, is_active=True).first()
+
+
+@extend_schema(request=None, responses={200: OpenApiTypes.OBJECT})
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def event_ticket(request):
+    """
+    Returns a short-lived ticket for opening the event stream from a
+    browser's `EventSource`, which cannot send the API token:
+    `new EventSource('/api/events/?ticket=' + ticket)`.
+    """
+    return Response({'ticket': issue_ticket(request.user), 'expires_in': settings.LIBRARY_EVENT_TICKET_SECONDS})
+
+
+@require_GET
+async def event_stream(request):
+    """
+    Streams book availability and checkout changes as Server-Sent Events.
+
+    Every client receives `book.availability` events; `checkout.created`
+    and `checkout.returned` events are sent to the borrower and to
+    librarians. A reconnecting client sends `Last-Event-ID` (or
+    `?last_event_id=`) and receives the events it missed; a new client
+    only receives events from now on.
+    """
+    user = await sync_to_async(authenticate)(request)
+    if user is None:
+        return JsonResponse({'detail': 'Authentication credentials were not provided.'}, status=401)
+
+    cursor = Cursor.parse(request.headers.get('Last-Event-ID', request.GET.get('last_event_id')))
+    if cursor is None:
+        cursor = Cursor(await sync_to_async(latest_event_id, thread_sensitive=False)())
+
+    response = StreamingHttpResponse(stream_events(user, cursor), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # disable proxy buffering (nginx)
+    return response
@@ -0,0 +1,209 @@
+"""
+library/fieldsets.py
+
+This file is part of the University Library project.
+It implements sparse fieldsets for the REST API: parsing of the `?fields=`
+and `?expand=` query parameters, and the queryset shaping that lets the
+database skip the columns, joins and annotations a client did not ask for.
+
+Author: Raul Berrios
+"""
+from django.db.models import Count, OuterRef, Prefetch, Subquery, Sum
+from django.db.models.functions import Coalesce
+from rest_framework.permissions import SAFE_METHODS
+
+from .models import Book, BookStockShard, Checkout
+
+# Fields of BookSerializer that need the active checkout count annotation.
+BOOK_COUNT_FIELDS = ('checked_out_count', 'available')
+
+# Fields of BookSerializer that need the stock held in shards.
+BOOK_STOCK_FIELDS = ('stock', 'available')
+
+
+def _split(value):
+    """Splits a comma separated query parameter into a list of names."""
+    return [part.strip() for part in value.split(',') if part.strip()]
+
+
+class Fieldset:
+    """
+    The fields and nested relations requested by a client.
+
+    `?fields=` takes a comma separated list of (optionally dotted) field
+    paths, e.g. `?fields=id,book.title,student.username`. Naming a relation
+    without a sub-path (`?fields=book`) keeps all of its fields.
+
+    `?expand=` lists the relations that are rendered as nested objects,
+    e.g. `?expand=book`. Relations that are not listed are collapsed to
+    their primary key. Without `?expand=` every relation is nested, which
+    is the historical behavior of the API.
+    """
+
+    def __init__(self, fields=None, expand=None):
+        self.tree = self._build_tree(fields) if fields is not None else None
+        self.expand = set(expand) if expand is not None else None
+
+    @staticmethod
+    def _build_tree(paths):
+        """
+        Turns dotted paths into a nested dict. A `None` leaf means that the
+        whole subtree was requested.
+        """
+        tree = {}
+        for path in paths:
+            node = tree
+            parts = path.split('.')
+            for i, part in enumerate(parts):
+                if i == len(parts) - 1:
+                    node[part] = None
+                elif part not in node:
+                    node[part] = {}
+                elif node[part] is None:
+                    break
+                node = node[part]
+        return tree
+
+    @classmethod
+    def from_request(cls, request):
+        """
+        Returns the fieldset of a request, parsing it only once per request.
+
+        Only safe methods are pruned; write requests always get the full
+        representation so no writable field is silently dropped.
+        """
+        fieldset = getattr(request, '_library_fieldset', None)
+        if fieldset is not None:
+            return fieldset
+
+        params = getattr(request, 'query_params', None)
+        if params is None or request.method not in SAFE_METHODS:
+            fieldset = cls()
+        else:
+            fieldset = cls(
+                fields=_split(params['fields']) if 'fields' in params else None,
+                expand=_split(params['expand']) if 'expand' in params else None,
+            )
+        request._library_fieldset = fieldset
+        return fieldset
+
+    @property
+    def is_sparse(self):
+        """True when the client restricted the returned fields."""
+        return self.tree is not None
+
+    def includes(self, path):
+        """Returns True if the dotted field `path` is part of the response."""
+        node = self.tree
+        for part in path.split('.'):
+            if node is None:
+                return True
+            if part not in node:
+                return False
+            node = node[part]
+        return True
+
+    def expands(self, path):
+        """Returns True if the relation at `path` is rendered as a nested object."""
+        return self.expand is None or path in self.expand
+
+    def nests(self, path):
+        """Returns True if the relation at `path` is both included and expanded."""
+        return self.includes(path) and self.expands(path)
+
+    def columns(self, serializer_class, prefix='', depends=None):
+        """
+        Returns the concrete model fields needed to render `serializer_class`
+        at `prefix`, suitable for `QuerySet.only()`.
+
+        `depends` maps serializer fields to the model fields they are
+        computed from (e.g. `available` needs `stock`).
+        """
+        model = serializer_class.Meta.model
+        concrete = {field.name for field in model._meta.concrete_fields}
+        columns = {model._meta.pk.name}
+        for name in serializer_class.Meta.fields:
+            if not self.includes(prefix + name):
+                continue
+            if name in concrete:
+                columns.add(name)
+            columns.update((depends or {}).get(name, ()))
+        return sorted(columns)
+
+
+def active_checkouts_subquery(outer_ref='pk'):
+    """
+    Returns an expression counting the active checkouts of the book at
+    `outer_ref`, so a page of books is counted in the same query instead of
+    one COUNT per book.
+    """
+    counts = (
+        Checkout.objects.filter(book=OuterRef(outer_ref), return_date__isnull=True)
+        .order_by()
+        .values('book')
+        .annotate(count=Count('pk'))
+        .values('count')
+    )
+    return Coalesce(Subquery(counts), 0)
+
+
+def shard_stock_subquery(outer_ref='pk'):
+    """
+    Returns an expression summing the stock shards of the book at
+    `outer_ref` (0 for unsharded books).
+    """
+    totals = (
+        BookStockShard.objects.filter(book=OuterRef(outer_ref))
+        .order_by()
+        .values('book')
+        .annotate(total=Sum('count'))
+        .values('total')
+    )
+    return Coalesce(Subquery(totals), 0)
+
+
+def shape_book_queryset(queryset, fieldset, serializer_class, prefix=''):
+    """
+    Narrows a Book queryset to what `serializer_class` renders at `prefix`.
+
+    The active checkout count is only annotated when `checked_out_count` or
+    `available` is requested, the stock held in shards only when `stock`
+    or `available` is, and only the requested columns are loaded when the
+    client sent `?fields=`.
+    """
+    if any(fieldset.includes(prefix + name) for name in BOOK_COUNT_FIELDS):
+        queryset = queryset.annotate(active_checkouts=active_checkouts_subquery())
+    if any(fieldset.includes(prefix + name) for name in BOOK_STOCK_FIELDS):
+        queryset = queryset.annotate(shard_stock=shard_stock_subquery())
+    if fieldset.is_sparse:
+        depends = {'available': ['stock', 'stock_shards'], 'stock': ['stock_shards']}
+        queryset = queryset.only(*fieldset.columns(serializer_class, prefix, depends=depends))
+    return queryset
+
+
+def shape_checkout_queryset(queryset, fieldset, serializer_class):
+    """
+    Narrows a Checkout queryset to what `serializer_class` renders.
+
+    Nested books are prefetched through `shape_book_queryset` (one query per
+    page, with the checkout counts annotated), nested students are joined
+    with `select_related`, and relations that are pruned or collapsed to a
+    primary key are not loaded at all.
+    """
+    declared = serializer_class._declared_fields
+    only = fieldset.columns(serializer_class) if fieldset.is_sparse else None
+
+    if 'book' in declared and fieldset.nests('book'):
+        book_serializer = type(declared['book'])
+        books = shape_book_queryset(Book.objects.all(), fieldset, book_serializer, 'book.')
+        queryset = queryset.prefetch_related(Prefetch('book', queryset=books))
+
+    if 'student' in declared and fieldset.nests('student'):
+        queryset = queryset.select_related('student')
+        if only is not None:
+            student_serializer = type(declared['student'])
+            only += ['student__' + name for name in fieldset.columns(student_serializer, 'student.')]
+
+    if only is not None:
+        queryset = queryset.only(*only)
+    return queryset
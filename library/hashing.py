@@ -0,0 +1,45 @@
+"""
+library/hashing.py
+
+This file is part of the University Library project.
+It hashes passwords in bulk across a pool of processes.
+
+This module must not import models: the pool's processes import it before
+Django is set up.
+
+Author: Raul Berrios
+"""
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+
+
+def _setup_worker():
+    """Initializes Django in a hashing process (started with `spawn`)."""
+    django.setup()
+
+
+def hash_passwords(passwords, workers=None):
+    """
+    Returns the hashes of `passwords`, in order.
+
+    Password hashers are deliberately slow (PBKDF2 takes ~100ms per
+    password), so large batches are hashed by a pool of `workers` processes
+    (`LIBRARY_HASH_WORKERS`, the number of CPUs by default). Batches smaller
+    than `LIBRARY_HASH_PARALLEL_THRESHOLD` are hashed in the calling process,
+    where starting the pool would cost more than it saves.
+    """
+    passwords = list(passwords)
+    workers = workers or settings.LIBRARY_HASH_WORKERS or os.cpu_count() or 1
+    if workers == 1 or len(passwords) < settings.LIBRARY_HASH_PARALLEL_THRESHOLD:
+        return [make_password(password) for password in passwords]
+
+    # `spawn` rather than `fork`: the caller may be a multi-threaded server.
+    context = multiprocessing.get_context('spawn')
+    workers = min(workers, len(passwords))
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_setup_worker) as pool:
+        return list(pool.map(make_password, passwords, chunksize=max(1, len(passwords) // (workers * 4))))
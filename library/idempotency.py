@@ -0,0 +1,177 @@
+"""
+library/idempotency.py
+
+This file is part of the University Library project.
+It implements the `Idempotency-Key` header for mutating API endpoints, so
+that clients on unreliable networks can safely retry a POST: the first
+request is processed and its response stored, and retries with the same key
+are answered from the store without running the view again.
+
+Author: Raul Berrios
+"""
+import hashlib
+import json
+from datetime import timedelta
+from functools import wraps
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+from drf_spectacular.utils import OpenApiParameter
+from rest_framework import status
+from rest_framework.response import Response
+
+from .budget import current_budget
+from .models import IdempotencyKey
+
+HEADER = 'Idempotency-Key'
+
+# A request still marked as in progress after this long is assumed to have
+# died with its worker, and a retry may process it again.
+IN_PROGRESS_TIMEOUT = timedelta(seconds=60)
+
+# Documents the header on the endpoints using `idempotent`.
+IDEMPOTENCY_PARAMETER = OpenApiParameter(
+    HEADER, str, OpenApiParameter.HEADER,
+    description='Unique key (e.g. a UUID) making retries of this request safe; '
+                'a retry with the same key returns the original response.',
+)
+
+
+def fingerprint(request):
+    """Returns a hash identifying the method, path and body of a request."""
+    body = json.dumps(request.data, sort_keys=True, cls=DjangoJSONEncoder, default=str)
+    return hashlib.sha256(f'{request.method} {request.path}\n{body}'.encode()).hexdigest()
+
+
+def error(message, status_code):
+    """Returns an error response in DRF's `{'detail': ...}` format."""
+    return Response({'detail': message}, status=status_code)
+
+
+def replay(record):
+    """Rebuilds the stored response of a completed request."""
+    response = Response(record.response, status=record.status_code)
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def trim(user, cutoff):
+    """
+    Deletes the user's expired keys and, beyond the newest
+    `LIBRARY_IDEMPOTENCY_MAX_KEYS`, their oldest ones, in one statement.
+    This bounds the storage used per user however fast they send requests.
+    """
+    keys = IdempotencyKey.objects.filter(user=user)
+    newest = keys.order_by('-created_at').values('pk')[:settings.LIBRARY_IDEMPOTENCY_MAX_KEYS]
+    keys.filter(Q(created_at__lt=cutoff) | ~Q(pk__in=newest)).delete()
+
+
+def claim(user, key, request_hash):
+    """
+    Claims `key` for a new request, or returns the stored record when the
+    key was already used.
+
+    Returns `(record, claimed)`. A retry costs a single SELECT. A new claim
+    is an INSERT committed on its own, so of two concurrent requests with
+    the same key exactly one wins the unique constraint. Expired keys and
+    abandoned claims are taken over.
+    """
+    now = timezone.now()
+    ttl = timedelta(seconds=settings.LIBRARY_IDEMPOTENCY_TTL_SECONDS)
+    for _ in range(3):
+        record = IdempotencyKey.objects.filter(user=user, key=key).first()
+        if record is None:
+            try:
+                with transaction.atomic():
+                    record = IdempotencyKey.objects.create(user=user, key=key, fingerprint=request_hash, created_at=now)
+            except IntegrityError:
+                continue  # a concurrent request claimed the key first
+            try:
+                trim(user, now - ttl)
+            except BaseException:
+                release(record)
+                raise
+            return record, True
+
+        expired = record.created_at < now - ttl
+        abandoned = record.status_code is None and record.created_at < now - IN_PROGRESS_TIMEOUT
+        if not (expired or abandoned):
+            return record, False
+        # Take the key over, unless another retry did so first.
+        taken = IdempotencyKey.objects.filter(pk=record.pk, created_at=record.created_at).update(
+            fingerprint=request_hash, status_code=None, response=None, created_at=now,
+        )
+        if taken:
+            record.refresh_from_db()
+            return record, True
+    return IdempotencyKey.objects.get(user=user, key=key), False
+
+
+def release(record):
+    """
+    Deletes the claim of a request which failed, so that the client can
+    retry. This runs outside the request budget: a request stopped for going
+    over it must still release its key.
+    """
+    token = current_budget.set(None)
+    try:
+        record.delete()
+    finally:
+        current_budget.reset(token)
+
+
+def idempotent(handler):
+    """
+    Makes a viewset action honour the `Idempotency-Key` header.
+
+    Requests without the header are processed as usual. The first request
+    with a given key (per user) is processed and its response stored, unless
+    it fails with a server error or an exception, in which case the key is
+    released so the client can retry. Later requests with the key get:
+
+    - the stored response, with an `Idempotent-Replayed: true` header;
+    - 409 Conflict while the first request is still being processed;
+    - 422 Unprocessable Entity if the key was used for a different request.
+    """
+    @wraps(handler)
+    def wrapper(self, request, *args, **kwargs):
+        key = request.headers.get(HEADER)
+        if key is None or not request.user.is_authenticated:
+            return handler(self, request, *args, **kwargs)
+        if not key or len(key) > 255:
+            return error(f'The {HEADER} header must be 1 to 255 characters long.', status.HTTP_400_BAD_REQUEST)
+
+        request_hash = fingerprint(request)
+        record, claimed = claim(request.user, key, request_hash)
+        if not claimed:
+            if record.fingerprint != request_hash:
+                return error(f'This {HEADER} was already used for a different request.', status.HTTP_422_UNPROCESSABLE_ENTITY)
+            if record.status_code is None:
+                return error(f'A request with this {HEADER} is still being processed.', status.HTTP_409_CONFLICT)
+            return replay(record)
+
+        try:
+            response = handler(self, request, *args, **kwargs)
+        except BaseException:
+            release(record)
+            raise
+        if response.status_code >= 500:
+            release(record)
+        else:
+            record.status_code = response.status_code
+            record.response = response.data
+            record.save(update_fields=['status_code', 'response'])
+        return response
+    return wrapper
+
+
+def prune_expired():
+    """
+    Deletes every user's expired keys, including those of users who sent no
+    keyed request since; returns how many were deleted.
+    """
+    cutoff = timezone.now() - timedelta(seconds=settings.LIBRARY_IDEMPOTENCY_TTL_SECONDS)
+    return IdempotencyKey.objects.filter(created_at__lt=cutoff).delete()[0]
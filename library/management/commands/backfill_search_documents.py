@@ -0,0 +1,58 @@
+"""
+library/management/commands/backfill_search_documents.py
+
+This file is part of the University Library project.
+It contains a Django management command that fills `Checkout.search_document`
+for existing loans.
+
+Author: Raul Berrios
+"""
+from django.core.management.base import BaseCommand
+
+from library.models import Checkout
+from library.search import refresh_search_documents
+
+
+class Command(BaseCommand):
+    """
+    A custom Django management command to backfill checkout search documents.
+
+    New loans get their search document when they are created, and renames
+    of students and books through `save()` refresh it, and migration 0014
+    fills the documents of loans created before the field existed. Run this
+    command with `--all` after renaming students or books in bulk (e.g. with
+    `update()`); without it, it fills any document left empty.
+    Loans are processed in primary key batches, each one UPDATE statement,
+    and only rows whose document changed are written.
+
+    Usage:
+        python manage.py backfill_search_documents
+        python manage.py backfill_search_documents --all --batch-size 50000
+    """
+    help = 'Fills the search documents of existing checkouts.'
+
+    def add_arguments(self, parser):
+        """
+        Adds command-line arguments to the command.
+
+        Arguments:
+            --all: Recompute every document, not only the empty ones.
+            --batch-size: Number of checkouts updated per statement.
+        """
+        parser.add_argument('--all', action='store_true', help='Recompute every document, not only the empty ones.')
+        parser.add_argument('--batch-size', type=int, default=10000, help='Number of checkouts updated per statement.')
+
+    def handle(self, *args, **options):
+        """Refreshes the documents batch by batch, in primary key order."""
+        checkouts = Checkout.objects.order_by('pk')
+        if not options['all']:
+            checkouts = checkouts.filter(search_document='')
+        last_id = 0
+        updated = 0
+        while True:
+            ids = list(checkouts.filter(pk__gt=last_id).values_list('pk', flat=True)[:options['batch_size']])
+            if not ids:
+                break
+            updated += refresh_search_documents(Checkout.objects.filter(pk__in=ids))
+            last_id = ids[-1]
+        self.stdout.write(self.style.SUCCESS(f'Updated the search documents of {updated} checkout(s).'))
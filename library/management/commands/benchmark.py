@@ -0,0 +1,242 @@
+"""
+library/management/commands/benchmark.py
+
+This file is part of the University Library project.
+It contains a Django management command that runs micro-benchmarks against
+hot code paths of the API, using the data currently in the database.
+
+Author: Raul Berrios
+"""
+import io
+import random
+import resource
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections, transaction
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from library.autocomplete import PrefixIndex
+from library.circulation import checkout_book
+from library.models import Book, OutboxEvent, User
+from library.hashing import hash_passwords
+from library.provisioning import provision_users
+from library.stock import split_stock
+from library.renderers import FastJSONParser, FastJSONRenderer, fast_json_enabled
+from library.views import BookViewSet
+
+
+class Command(BaseCommand):
+    """
+    A custom Django management command to benchmark hot code paths.
+
+    Each benchmark target is implemented by a `bench_<target>` method and
+    reports its timings on stdout. Benchmarks run against the configured
+    database, so seed it first (see `seed_data`) to get meaningful numbers.
+
+    Usage:
+        python manage.py benchmark json
+        python manage.py benchmark json --iterations 500
+        python manage.py benchmark users --iterations 64
+        python manage.py benchmark stock --concurrency 1,4,16
+        python manage.py benchmark autocomplete --titles 1000000
+    """
+    help = 'Runs micro-benchmarks against hot code paths of the API.'
+
+    targets = ['json', 'users', 'stock', 'autocomplete']
+
+    def add_arguments(self, parser):
+        """
+        Adds command-line arguments to the command.
+
+        Arguments:
+            target: The benchmark to run.
+            --iterations: How many times the timed operation is repeated.
+            --concurrency: Comma separated numbers of concurrent clients (stock).
+            --titles: Number of generated titles to index (autocomplete).
+        """
+        parser.add_argument('target', choices=self.targets, help='The benchmark to run.')
+        parser.add_argument('--iterations', type=int, default=200, help='How many times the timed operation is repeated.')
+        parser.add_argument('--concurrency', default='1,2,4,8', help='Comma separated numbers of concurrent clients (stock).')
+        parser.add_argument('--titles', type=int, default=1000000, help='Number of generated titles to index (autocomplete).')
+
+    def handle(self, *args, **options):
+        """Dispatches to the selected benchmark."""
+        getattr(self, f"bench_{options['target']}")(**options)
+
+    def report(self, label, seconds, iterations):
+        """Writes a single timing line in a uniform format."""
+        per_op = seconds / iterations * 1000
+        self.stdout.write(f'{label:<32} {per_op:10.3f} ms/op  ({iterations} iterations, {seconds:.3f}s total)')
+
+    def timed(self, func, iterations):
+        """Runs `func` `iterations` times and returns the elapsed seconds."""
+        start = time.perf_counter()
+        for _ in range(iterations):
+            func()
+        return time.perf_counter() - start
+
+    def books_payload(self):
+        """
+        Returns the data of a real `/api/books/` response (first page).
+
+        The request goes through `BookViewSet` exactly like an API call, so
+        the payload has the same shape and types the renderer sees in
+        production.
+        """
+        user = User.objects.order_by('id').first()
+        if user is None:
+            raise CommandError('The database has no users. Run `manage.py seed_data` first.')
+        request = APIRequestFactory().get('/api/books/', HTTP_HOST=settings.ALLOWED_HOSTS[0])
+        force_authenticate(request, user=user)
+        response = BookViewSet.as_view({'get': 'list'})(request)
+        if response.status_code != 200:
+            raise CommandError(f'/api/books/ returned HTTP {response.status_code}.')
+        return response.data
+
+    def bench_json(self, iterations, **options):
+        """Compares the stdlib and orjson renderers/parsers on `/api/books/`."""
+        if not fast_json_enabled():
+            self.stdout.write(self.style.WARNING('orjson is not available; FastJSON* will use the stdlib.'))
+
+        data = self.books_payload()
+        body = JSONRenderer().render(data)
+        self.stdout.write(f"Payload: {len(data.get('results', data))} books, {len(body)} bytes")
+
+        for label, renderer in (('render stdlib', JSONRenderer()), ('render orjson', FastJSONRenderer())):
+            self.report(label, self.timed(lambda: renderer.render(data), iterations), iterations)
+
+        for label, parser in (('parse stdlib', JSONParser()), ('parse orjson', FastJSONParser())):
+            self.report(label, self.timed(lambda: parser.parse(io.BytesIO(body)), iterations), iterations)
+
+    def bench_users(self, iterations, **options):
+        """
+        Compares serial and process pool password hashing, and measures
+        end-to-end bulk provisioning of `iterations` users (rolled back).
+        """
+        passwords = [f'benchmark-password-{i}' for i in range(iterations)]
+        for label, workers in (('hash serial', 1), ('hash process pool', None)):
+            seconds = self.timed(lambda: hash_passwords(passwords, workers=workers), 1)
+            self.report(label, seconds, iterations)
+            self.stdout.write(f'{"":<32} {iterations / seconds:10.1f} users/s')
+
+        rows = [{'username': f'benchmark-user-{i}', 'password': password} for i, password in enumerate(passwords)]
+        with transaction.atomic():
+            seconds = self.timed(lambda: provision_users(rows), 1)
+            transaction.set_rollback(True)
+        self.report('provision (bulk)', seconds, iterations)
+        self.stdout.write(f'{"":<32} {iterations / seconds:10.1f} users/s')
+
+    def run_concurrently(self, clients, func):
+        """
+        Runs `func(client_index)` in `clients` threads at once and returns
+        the elapsed seconds. Each thread uses its own database connection.
+        """
+        barrier = threading.Barrier(clients + 1)
+
+        def client(index):
+            try:
+                barrier.wait()
+                func(index)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=client, args=(index,)) for index in range(clients)]
+        for thread in threads:
+            thread.start()
+        barrier.wait()
+        start = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - start
+
+    def bench_stock(self, iterations, concurrency, **options):
+        """
+        Measures checkout throughput on a single title with an increasing
+        number of concurrent clients, with the stock in `Book.stock` and
+        split across `LIBRARY_STOCK_SHARDS` shards.
+
+        Each client checks out `iterations` copies for as many throwaway
+        students; the book, students and their records are deleted after
+        each run. A final table shows how the throughput of each layout
+        scales with the clients, relative to the first concurrency level.
+        """
+        if connection.vendor == 'sqlite':
+            self.stdout.write(self.style.WARNING(
+                'SQLite serializes all writes, so concurrent checkouts queue for the write lock and '
+                'shards cannot help; compare with a run against PostgreSQL.'
+            ))
+        throughput = {}  # (label, clients) -> checkouts per second
+        levels = [int(value) for value in concurrency.split(',')]
+        for clients in levels:
+            for label, shards in (('single row', 0), (f'{settings.LIBRARY_STOCK_SHARDS} shards', settings.LIBRARY_STOCK_SHARDS)):
+                total = clients * iterations
+                book = Book.objects.create(title='Benchmark title', author='Benchmark', published_year=2000, genre='Benchmark', stock=total)
+                if shards:
+                    split_stock(book.pk, shards)
+                prefix = f'benchmark-stock-{book.pk}-'
+                User.objects.bulk_create([User(username=f'{prefix}{i}', password='!') for i in range(total)], batch_size=1000)
+                students = list(User.objects.filter(username__startswith=prefix).order_by('pk'))
+                first_event = OutboxEvent.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+
+                def client(index):
+                    title = Book.objects.get(pk=book.pk)
+                    for student in students[index::clients]:
+                        checkout_book(student, title)
+
+                try:
+                    seconds = self.run_concurrently(clients, client)
+                finally:
+                    book.delete()
+                    User.objects.filter(username__startswith=prefix).delete()
+                    OutboxEvent.objects.filter(pk__gt=first_event).delete()
+                self.report(f'checkout {label}, {clients} client(s)', seconds, total)
+                self.stdout.write(f'{"":<32} {total / seconds:10.1f} checkouts/s')
+                throughput[label, clients] = total / seconds
+
+        self.stdout.write(f"{'scaling':<12} {'clients':>8} {'single row':>12} {'sharded':>12} {'sharded/single':>15}")
+        sharded = f'{settings.LIBRARY_STOCK_SHARDS} shards'
+        for clients in levels:
+            single, split = throughput['single row', clients], throughput[sharded, clients]
+            self.stdout.write(
+                f"{'':<12} {clients:>8} {single / throughput['single row', levels[0]]:>11.2f}x "
+                f"{split / throughput[sharded, levels[0]]:>11.2f}x {split / single:>14.2f}x"
+            )
+
+    def bench_autocomplete(self, iterations, titles, **options):
+        """
+        Builds the autocomplete prefix index from `titles` generated titles
+        (without the database) and measures lookups of 1 to 4 letter
+        prefixes and incremental updates.
+        """
+        rng = random.Random(0)
+        words = ['the', 'of', 'dune', 'history', 'modern', 'introduction', 'principles', 'garden', 'night', 'river',
+                 'quantum', 'theory', 'lost', 'city', 'stars', 'economics', 'letters', 'war', 'peace', 'data']
+        authors = [f'{first} {last}' for first in ('Ana', 'Ben', 'Carla', 'David', 'Elena', 'Frank', 'Grace', 'Hugo')
+                   for last in ('Austen', 'Borges', 'Cortazar', 'Dickens', 'Eco', 'Faulkner', 'Garcia', 'Herbert')]
+        books = [
+            (book_id, ' '.join(rng.choice(words) for _ in range(rng.randint(1, 5))) + f' {book_id}', rng.choice(authors))
+            for book_id in range(titles)
+        ]
+
+        memory_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.perf_counter()
+        index = PrefixIndex.build(books, settings.LIBRARY_AUTOCOMPLETE_MAX_ENTRIES)
+        seconds = time.perf_counter() - start
+        memory = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - memory_before) / 1024
+        truncated = ' (truncated at LIBRARY_AUTOCOMPLETE_MAX_ENTRIES)' if index.truncated else ''
+        self.stdout.write(f'Indexed {titles} titles in {seconds:.2f}s: {len(index.keys)} keys{truncated}, ~{memory:.0f} MB peak')
+
+        for length in range(1, 5):
+            prefixes = [rng.choice(words)[:length] for _ in range(iterations)]
+            queries = iter(prefixes)
+            seconds = self.timed(lambda: index.search(next(queries)), iterations)
+            self.report(f'search {length}-letter prefix', seconds, iterations)
+
+        book_ids = iter(range(titles, titles + iterations))
+        seconds = self.timed(lambda: index.add(next(book_ids), 'Benchmark title', 'Benchmark author'), iterations)
+        self.report('add book', seconds, iterations)
@@ -0,0 +1,186 @@
+"""
+library/management/commands/bootstrap.py
+
+This file is part of the University Library project.
+It contains a Django management command that prepares the application for
+serving when its container starts: database readiness, migrations, the admin
+superuser, initial data, the OpenAPI schema and static files. Every phase is
+idempotent and skipped when there is nothing to do.
+
+Author: Raul Berrios
+"""
+import hashlib
+import os
+import time
+
+from django.conf import settings
+from django.contrib.staticfiles.finders import get_finders
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, OperationalError, connections
+from django.db.migrations.executor import MigrationExecutor
+
+from library.models import Book, User
+from library.schema import write_schema_artifact
+
+# File written next to the collected static files, holding the fingerprint of
+# the sources they were collected from.
+STATIC_FINGERPRINT_FILE = '.collectstatic-fingerprint'
+
+
+class Command(BaseCommand):
+    """
+    A custom Django management command to bootstrap a container.
+
+    Replaces the fixed sleep and the separate `migrate`, `shell`, `seed_data`
+    and `collectstatic` invocations of the old entrypoint with a single
+    process that:
+
+    - polls the database with exponential backoff instead of sleeping;
+    - runs `migrate` only when there are unapplied migrations;
+    - creates the superuser in-process, only if it does not exist;
+    - seeds sample data only into an empty database;
+    - rebuilds the OpenAPI schema artifact;
+    - runs `collectstatic` only when the static sources changed.
+
+    The time spent in each phase is reported at the end.
+
+    Usage:
+        python manage.py bootstrap
+        python manage.py bootstrap --no-seed --db-timeout 120
+    """
+    help = 'Prepares the database, superuser, seed data, schema and static files for serving.'
+
+    def add_arguments(self, parser):
+        """
+        Adds command-line arguments to the command.
+
+        Arguments:
+            --db-timeout: Seconds to wait for the database before failing.
+            --no-seed: Skip seeding sample data, even into an empty database.
+            --no-static: Skip the collectstatic phase.
+        """
+        parser.add_argument('--db-timeout', type=float, default=60.0, help='Seconds to wait for the database before failing.')
+        parser.add_argument('--no-seed', action='store_true', help='Skip seeding sample data, even into an empty database.')
+        parser.add_argument('--no-static', action='store_true', help='Skip the collectstatic phase.')
+
+    def handle(self, *args, **options):
+        """Runs each phase in order and reports how long each one took."""
+        self.timings = []
+        total = time.perf_counter()
+
+        self.phase('database', self.wait_for_database, options['db_timeout'])
+        self.phase('migrations', self.apply_migrations)
+        self.phase('superuser', self.create_superuser)
+        if not options['no_seed']:
+            self.phase('seed data', self.seed_database)
+        self.phase('schema', self.build_schema)
+        if not options['no_static']:
+            self.phase('static files', self.collect_static)
+
+        self.stdout.write('Boot phases:')
+        for name, seconds, outcome in self.timings:
+            self.stdout.write(f'  {name:<14} {seconds:7.2f}s  {outcome}')
+        self.stdout.write(self.style.SUCCESS(f'Bootstrap complete in {time.perf_counter() - total:.2f}s.'))
+
+    def phase(self, name, func, *args):
+        """Runs a phase, recording its duration and the outcome it returns."""
+        self.stdout.write(f'Bootstrap: {name}...')
+        start = time.perf_counter()
+        outcome = func(*args)
+        self.timings.append((name, time.perf_counter() - start, outcome))
+
+    def wait_for_database(self, timeout):
+        """
+        Polls the default database until it accepts connections, backing off
+        exponentially from 0.1s up to 2s between attempts.
+        """
+        connection = connections[DEFAULT_DB_ALIAS]
+        deadline = time.monotonic() + timeout
+        delay = 0.1
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                connection.ensure_connection()
+                return f'ready after {attempts} attempt(s)'
+            except OperationalError as exc:
+                if time.monotonic() + delay > deadline:
+                    raise CommandError(f'Database not ready after {timeout:.0f}s: {exc}')
+                time.sleep(delay)
+                delay = min(delay * 2, 2.0)
+
+    def apply_migrations(self):
+        """Runs `migrate` only if the migration plan is not empty."""
+        connection = connections[DEFAULT_DB_ALIAS]
+        executor = MigrationExecutor(connection)
+        plan = executor.migration_plan(executor.loader.graph.leaf_nodes())
+        if not plan:
+            return 'up to date, skipped'
+        call_command('migrate', interactive=False, verbosity=0)
+        return f'applied {len(plan)} migration(s)'
+
+    def create_superuser(self):
+        """
+        Creates the admin superuser if it does not exist yet.
+
+        The username and email default to 'admin' and 'admin@example.com'
+        and can be overridden with DJANGO_SUPERUSER_USERNAME and
+        DJANGO_SUPERUSER_EMAIL. DJANGO_SUPERUSER_PASSWORD is required only
+        when the user has to be created.
+        """
+        username = os.environ.get('DJANGO_SUPERUSER_USERNAME', 'admin')
+        if User.objects.filter(username=username).exists():
+            return f'"{username}" already exists'
+
+        password = os.environ.get('DJANGO_SUPERUSER_PASSWORD')
+        if not password:
+            raise CommandError('DJANGO_SUPERUSER_PASSWORD environment variable not set')
+        email = os.environ.get('DJANGO_SUPERUSER_EMAIL', 'admin@example.com')
+        User.objects.create_superuser(username, email, password)
+        return f'"{username}" created'
+
+    def seed_database(self):
+        """Seeds sample data only when the database has no books yet."""
+        if Book.objects.exists():
+            return 'database not empty, skipped'
+        call_command('seed_data', stdout=self.stdout)
+        return 'seeded'
+
+    def build_schema(self):
+        """Rebuilds the OpenAPI schema artifact for the deployed code."""
+        return f'written to {write_schema_artifact()}'
+
+    def static_fingerprint(self):
+        """
+        Returns a hash of the static source files (paths, sizes and
+        modification times) and of the storage backend configuration.
+        """
+        digest = hashlib.sha256(settings.STATIC_URL.encode())
+        digest.update(repr(settings.STORAGES.get('staticfiles')).encode())
+        entries = []
+        for finder in get_finders():
+            for path, storage in finder.list([]):
+                stat = os.stat(storage.path(path))
+                entries.append(f'{path}\0{stat.st_size}\0{stat.st_mtime_ns}')
+        for entry in sorted(entries):
+            digest.update(entry.encode())
+        return digest.hexdigest()
+
+    def collect_static(self):
+        """
+        Runs `collectstatic` unless the static sources are unchanged since
+        the files in STATIC_ROOT were collected.
+        """
+        fingerprint_path = os.path.join(str(settings.STATIC_ROOT), STATIC_FINGERPRINT_FILE)
+        fingerprint = self.static_fingerprint()
+
+        if os.path.exists(fingerprint_path):
+            with open(fingerprint_path) as stored:
+                if stored.read().strip() == fingerprint:
+                    return 'unchanged, skipped'
+
+        call_command('collectstatic', interactive=False, clear=True, verbosity=0)
+        with open(fingerprint_path, 'w') as stored:
+            stored.write(fingerprint)
+        return 'collected'
@@ -0,0 +1,48 @@
+"""
+library/management/commands/build_schema.py
+
+This file is part of the University Library project.
+It contains a Django management command that precomputes the OpenAPI schema
+artifact served by `/api/schema/`.
+
+Author: Raul Berrios
+"""
+import time
+
+from django.core.management.base import BaseCommand
+
+from library.schema import get_artifact_path, schema_cache, write_schema_artifact
+
+
+class Command(BaseCommand):
+    """
+    A custom Django management command to build the OpenAPI schema artifact.
+
+    Introspects all viewsets and serializers once and writes the resulting
+    schema to `LIBRARY_SCHEMA_ARTIFACT`. Run it at image build or container
+    boot (the `bootstrap` command does) so API workers never generate the
+    schema on a request. Writing a new artifact invalidates the schema cached
+    by running workers.
+
+    Usage:
+        python manage.py build_schema
+        python manage.py build_schema --file /tmp/openapi.json
+    """
+    help = 'Precomputes the OpenAPI schema artifact served by /api/schema/.'
+
+    def add_arguments(self, parser):
+        """
+        Adds command-line arguments to the command.
+
+        Arguments:
+            --file: Where to write the artifact. Defaults to LIBRARY_SCHEMA_ARTIFACT.
+        """
+        parser.add_argument('--file', default=None, help='Where to write the artifact. Defaults to LIBRARY_SCHEMA_ARTIFACT.')
+
+    def handle(self, *args, **options):
+        """Generates the schema and writes the artifact atomically."""
+        start = time.perf_counter()
+        path = write_schema_artifact(options['file'] or get_artifact_path())
+        schema_cache.clear()
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(f'OpenAPI schema written to {path} in {elapsed:.2f}s.'))
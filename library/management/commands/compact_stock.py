@@ -0,0 +1,48 @@
+"""
+library/management/commands/compact_stock.py
+
+This file is part of the University Library project.
+It contains a Django management command that folds sharded stock counters
+back into `Book.stock`.
+
+Author: Raul Berrios
+"""
+from django.core.management.base import BaseCommand
+
+from library.models import Book
+from library.stock import compact_stock
+
+
+class Command(BaseCommand):
+    """
+    A custom Django management command to compact sharded stock.
+
+    Sums the shards of each book into `Book.stock` and deletes them, under
+    the book's row lock, so the title goes back to a single counter once
+    the rush that justified sharding it is over.
+
+    Usage:
+        python manage.py compact_stock
+        python manage.py compact_stock 42 57
+    """
+    help = 'Folds the stock shards of the given (by default all sharded) books back into Book.stock.'
+
+    def add_arguments(self, parser):
+        """
+        Adds command-line arguments to the command.
+
+        Arguments:
+            book_ids: The books to compact (default: every sharded book).
+        """
+        parser.add_argument('book_ids', nargs='*', type=int, help='The books to compact (default: every sharded book).')
+
+    def handle(self, *args, **options):
+        """Compacts each book in its own transaction."""
+        books = Book.objects.filter(stock_shards__gt=0)
+        if options['book_ids']:
+            books = books.filter(pk__in=options['book_ids'])
+        compacted = 0
+        for book_id in books.values_list('pk', flat=True):
+            compact_stock(book_id)
+            compacted += 1
+        self.stdout.write(self.style.SUCCESS(f'Compacted the stock of {compacted} book(s).'))
@@ -0,0 +1,50 @@
+"""
+library/management/commands/enqueue_task.py
+
+This file is part of the University Library project.
+It contains a Django management command that queues another management
+command as a background task, for `manage.py run_worker` to run.
+
+Author: Raul Berrios
+"""
+import argparse
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from library.tasks import enqueue
+
+
+class Command(BaseCommand):
+    """
+    A custom Django management command to run a command in the background.
+
+    Queues one of the commands of `LIBRARY_TASK_COMMANDS` with its arguments
+    and returns at once, e.g. from cron, instead of running it in place. The
+    task's status and output are shown at `/api/tasks/{id}/` and in the admin.
+
+    Usage:
+        python manage.py enqueue_task rollup_circulation
+        python manage.py enqueue_task --priority 10 build_related --top 20
+    """
+    help = 'Queues a management command as a background task.'
+
+    def add_arguments(self, parser):
+        """
+        Adds command-line arguments to the command.
+
+        Arguments:
+            command: The management command to queue.
+            command_args: Its arguments.
+            --priority: Tasks with a higher priority run first.
+        """
+        parser.add_argument('--priority', type=int, default=0, help='Tasks with a higher priority run first.')
+        parser.add_argument('command', help='The management command to queue.')
+        parser.add_argument('command_args', nargs=argparse.REMAINDER, help='Its arguments.')
+
+    def handle(self, *args, **options):
+        """Queues the command."""
+        if options['command'] not in settings.LIBRARY_TASK_COMMANDS:
+            raise CommandError(f"Choose one of: {', '.join(settings.LIBRARY_TASK_COMMANDS)}.")
+        task = enqueue('command', priority=options['priority'], command=options['command'], args=options['command_args'])
+        self.stdout.write(self.style.SUCCESS(f'Queued {options["command"]} as task {task.pk}.'))
@@ -0,0 +1,77 @@
+"""
+library/management/commands/import_users.py
+
+This file is part of the University Library project.
+It contains a Django management command that creates user accounts in bulk
+from a CSV or JSON file, e.g. the students enrolled in a new semester.
+
+Author: Raul Berrios
+"""
+import csv
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from library.provisioning import provision_users
+
+
+class Command(BaseCommand):
+    """
+    A custom Django management command to import users in bulk.
+
+    The file is either a CSV file with a header row or a JSON list of
+    objects, with the columns `username`, `password`, and optionally
+    `email`, `first_name`, `last_name` and `role` (default 'student').
+    Rows go through the same batch validation, parallel password hashing
+    and `bulk_create` as `POST /api/users/bulk/`, in chunks of
+    `--batch-size` rows; each failed row is reported with its errors.
+
+    Usage:
+        python manage.py import_users students.csv
+        python manage.py import_users students.json --workers 8
+    """
+    help = 'Creates users in bulk from a CSV or JSON file.'
+
+    def add_arguments(self, parser):
+        """
+        Adds command-line arguments to the command.
+
+        Arguments:
+            path: The CSV or JSON file to import.
+            --workers: Number of password hashing processes (default: one per CPU).
+            --batch-size: Number of rows validated and inserted together.
+        """
+        parser.add_argument('path', help='The CSV or JSON file to import.')
+        parser.add_argument('--workers', type=int, default=None, help='Number of password hashing processes (default: one per CPU).')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Number of rows validated and inserted together.')
+
+    def read_rows(self, path):
+        """Reads the rows of a CSV or JSON file as a list of dicts."""
+        try:
+            with open(path, newline='', encoding='utf-8') as source:
+                if path.endswith('.json'):
+                    rows = json.load(source)
+                else:
+                    rows = [{key: value for key, value in row.items() if value != ''} for row in csv.DictReader(source)]
+        except (OSError, ValueError) as exc:
+            raise CommandError(f'Cannot read {path}: {exc}')
+        if not isinstance(rows, list):
+            raise CommandError('A JSON import file must contain a list of users.')
+        return rows
+
+    def handle(self, *args, **options):
+        """Imports the file in batches and reports the rows that failed."""
+        rows = self.read_rows(options['path'])
+        batch_size = options['batch_size']
+        created = failed = 0
+        for offset in range(0, len(rows), batch_size):
+            for result in provision_users(rows[offset:offset + batch_size], workers=options['workers']):
+                if result['status'] == 'created':
+                    created += 1
+                    continue
+                failed += 1
+                errors = '; '.join(f'{field}: {" ".join(map(str, messages))}' for field, messages in result['errors'].items())
+                self.stderr.write(f"Row {offset + result['row'] + 1} ({result['username']}): {errors}")
+
+        style = self.style.SUCCESS if not failed else self.style.WARNING
+        self.stdout.write(style(f'Created {created} user(s), {failed} row(s) failed.'))
@@ -0,0 +1,54 @@
+"""
+library/management/commands/prune_events.py
+
+This file is part of the University Library project.
+It contains a Django management command that deletes old events from the
+outbox behind the `/api/events/` stream.
+
+Author: Raul Berrios
+"""
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from library.models import OutboxEvent
+
+
+class Command(BaseCommand):
+    """
+    A custom Django management command to prune the event outbox.
+
+    Events are only needed until every client has received them; clients
+    that reconnect with a `Last-Event-ID` older than the retention window
+    resume from the oldest event still stored. Rows are deleted in batches
+    so the table is never locked for long.
+
+    Usage:
+        python manage.py prune_events
+        python manage.py prune_events --hours 6
+    """
+    help = 'Deletes outbox events older than the retention window.'
+
+    def add_arguments(self, parser):
+        """
+        Adds command-line arguments to the command.
+
+        Arguments:
+            --hours: Retention window, in hours.
+            --batch-size: Number of events deleted per statement.
+        """
+        parser.add_argument('--hours', type=float, default=24.0, help='Retention window, in hours.')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Number of events deleted per statement.')
+
+    def handle(self, *args, **options):
+        """Deletes the expired events, oldest first."""
+        cutoff = timezone.now() - timedelta(hours=options['hours'])
+        expired = OutboxEvent.objects.filter(created_at__lt=cutoff).order_by('pk')
+        deleted = 0
+        while True:
+            ids = list(expired.values_list('pk', flat=True)[:options['batch_size']])
+            if not ids:
+                break
+            deleted += OutboxEvent.objects.filter(pk__in=ids).delete()[0]
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} event(s).'))
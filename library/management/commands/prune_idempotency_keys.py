@@ -0,0 +1,29 @@
+"""
+library/management/commands/prune_idempotency_keys.py
+
+This file is part of the University Library project.
+It contains a Django management command that deletes expired idempotency
+keys.
+
+Author: Raul Berrios
+"""
+from django.core.management.base import BaseCommand
+
+from library.idempotency import prune_expired
+
+
+class Command(BaseCommand):
+    """
+    A custom Django management command to delete expired idempotency keys.
+
+    Each user's expired keys are already deleted when they send a new
+    keyed request; this command removes those of the users who did not.
+
+    Usage:
+        python manage.py prune_idempotency_keys
+    """
+    help = 'Deletes idempotency keys older than LIBRARY_IDEMPOTENCY_TTL_SECONDS.'
+
+    def handle(self, *args, **options):
+        """Deletes the expired keys."""
+        self.stdout.write(self.style.SUCCESS(f'Deleted {prune_expired()} expired key(s).'))
@@ -0,0 +1,70 @@
+"""
+library/management/commands/reconcile_loan_counts.py
+
+This file is part of the University Library project.
+It contains a Django management command that repairs the active loan
+counters behind the per-role loan limits.
+
+Author: Raul Berrios
+"""
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from library.models import Checkout, User
+
+
+def active_checkouts_subquery():
+    """Returns an expression counting the active loans of the user at `pk`."""
+    counts = (
+        Checkout.objects.filter(student=OuterRef('pk'), return_date__isnull=True)
+        .order_by()
+        .values('student')
+        .annotate(count=Count('pk'))
+        .values('count')
+    )
+    return Coalesce(Subquery(counts), 0)
+
+
+class Command(BaseCommand):
+    """
+    A custom Django management command to reconcile `User.active_checkout_count`.
+
+    The counters are updated with every checkout and return, but loans
+    created or deleted outside `library.circulation` (e.g. in the shell or
+    by deleting books) make them drift. Users are processed in primary key
+    batches: each batch locks its users, so no checkout of theirs is in
+    flight, and fixes the wrong counters with one UPDATE.
+
+    Usage:
+        python manage.py reconcile_loan_counts
+        python manage.py reconcile_loan_counts --batch-size 500
+    """
+    help = 'Repairs the active loan counters of users.'
+
+    def add_arguments(self, parser):
+        """
+        Adds command-line arguments to the command.
+
+        Arguments:
+            --batch-size: Number of users checked per transaction.
+        """
+        parser.add_argument('--batch-size', type=int, default=1000, help='Number of users checked per transaction.')
+
+    def handle(self, *args, **options):
+        """Recounts the active loans of every user, batch by batch."""
+        last_id = 0
+        repaired = 0
+        while True:
+            with transaction.atomic():
+                ids = list(
+                    User.objects.select_for_update().filter(pk__gt=last_id).order_by('pk')
+                    .values_list('pk', flat=True)[:options['batch_size']]
+                )
+                if not ids:
+                    break
+                actual = active_checkouts_subquery()
+                repaired += User.objects.filter(pk__in=ids).exclude(active_checkout_count=actual).update(active_checkout_count=actual)
+            last_id = ids[-1]
+        self.stdout.write(self.style.SUCCESS(f'Repaired the active loan count of {repaired} user(s).'))
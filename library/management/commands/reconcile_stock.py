@@ -0,0 +1,92 @@
+"""
+library/management/commands/reconcile_stock.py
+
+This file is part of the University Library project.
+It contains a Django management command that checks `Book.stock` against
+the stock ledger and reports or repairs the books that drifted.
+
+Author: Raul Berrios
+"""
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Sum
+
+from library.models import Book, StockMovement
+from library.stock import lock_shards, overwrite_stock, record_movement
+
+
+class Command(BaseCommand):
+    """
+    A custom Django management command to reconcile stock with its ledger.
+
+    The stock a book should have is the sum of its `StockMovement` deltas.
+    Books are processed in primary key batches: each batch locks the rows
+    and stock shards of its books (see `library.stock.lock_shards`), so no
+    checkout or return of theirs is in flight, reads their stock from the
+    locked rows and only then sums the ledger of the whole batch with one
+    grouped aggregate, which the `(book, delta)` index serves without
+    reading the ledger rows.
+
+    By default drift is only reported. `--fix` sets the stock of drifted
+    books back to their ledger; `--accept` keeps their stock and records
+    the difference as a reconciliation movement instead (e.g. after a
+    physical inventory count).
+
+    Usage:
+        python manage.py reconcile_stock
+        python manage.py reconcile_stock --fix
+        python manage.py reconcile_stock --accept --batch-size 500
+    """
+    help = 'Compares the stock of every book with its stock ledger.'
+
+    def add_arguments(self, parser):
+        """
+        Adds command-line arguments to the command.
+
+        Arguments:
+            --fix: Set the stock of drifted books to their ledger value.
+            --accept: Record the drift as reconciliation movements instead.
+            --batch-size: Number of books checked per transaction.
+        """
+        mode = parser.add_mutually_exclusive_group()
+        mode.add_argument('--fix', action='store_true', help='Set the stock of drifted books to their ledger value.')
+        mode.add_argument('--accept', action='store_true', help='Record the drift as reconciliation movements.')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Number of books checked per transaction.')
+
+    def handle(self, *args, **options):
+        """Checks every book's stock against its ledger, batch by batch."""
+        last_id = 0
+        checked = drifted = 0
+        while True:
+            with transaction.atomic():
+                books = list(
+                    Book.objects.select_for_update().filter(pk__gt=last_id).order_by('pk')
+                    .only('pk', 'title', 'stock', 'stock_shards')[:options['batch_size']]
+                )
+                if not books:
+                    break
+                lock_shards(books)
+                expected = dict(
+                    StockMovement.objects.filter(book__in=[book.pk for book in books])
+                    .order_by().values('book_id').annotate(total=Sum('delta')).values_list('book_id', 'total')
+                )
+                for book in books:
+                    actual, ledger = book.current_stock(), expected.get(book.pk, 0)
+                    if actual == ledger:
+                        continue
+                    drifted += 1
+                    self.stdout.write(f'Book {book.pk} ({book.title}): stock {actual}, ledger {ledger} ({actual - ledger:+d})')
+                    if options['fix']:
+                        overwrite_stock(book.pk, max(ledger, 0))
+                    elif options['accept']:
+                        record_movement(book.pk, actual - ledger, StockMovement.RECONCILIATION)
+            checked += len(books)
+            last_id = books[-1].pk
+
+        if options['fix']:
+            outcome = f'reset the stock of {drifted} book(s) to their ledger'
+        elif options['accept']:
+            outcome = f'recorded the drift of {drifted} book(s) in their ledger'
+        else:
+            outcome = f'found {drifted} book(s) whose stock drifted from their ledger'
+        self.stdout.write(self.style.SUCCESS(f'Checked {checked} book(s) and {outcome}.'))
@@ -0,0 +1,193 @@
+"""
+library/management/commands/replay_traffic.py
+
+This file is part of the University Library project.
+It contains a Django management command that replays API traffic recorded
+by `library.traffic.TrafficCaptureMiddleware` against a running instance and
+reports latency percentiles and errors per route.
+
+Author: Raul Berrios
+"""
+import http.client
+import json
+import math
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode, urlsplit
+
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.authtoken.models import Token
+
+from library.models import User
+from library.traffic import read_log
+
+
+def percentile(values, rank):
+    """Returns the `rank`th percentile of the sorted list `values` (nearest rank)."""
+    return values[max(math.ceil(rank / 100 * len(values)) - 1, 0)]
+
+
+class Command(BaseCommand):
+    """
+    A custom Django management command to replay recorded API traffic.
+
+    The requests of the given NDJSON logs are sent to `--base-url` with
+    their original spacing divided by `--speedup` (`--speedup 0` sends them
+    as fast as `--concurrency` clients allow). Each request is sent as one
+    of `--users` users of its recorded role, read from the database of the
+    target instance, so run the command against a local, seeded instance
+    sharing this project's database. Requests for objects which do not
+    exist there are reported as 404s.
+
+    The report lists, per route, the number of requests, client (4xx) and
+    server (5xx or connection) errors, and latency percentiles, plus how far
+    the replay fell behind the recorded schedule. `--json` also writes it
+    to a file, to compare builds.
+
+    Usage:
+        python manage.py replay_traffic traffic.ndjson
+        python manage.py replay_traffic traffic.ndjson.1 traffic.ndjson --speedup 10 --concurrency 32
+        python manage.py replay_traffic traffic.ndjson --speedup 0 --json before.json
+    """
+    help = 'Replays recorded API traffic and reports latency percentiles and errors per route.'
+
+    def add_arguments(self, parser):
+        """
+        Adds command-line arguments to the command.
+
+        Arguments:
+            logs: NDJSON traffic logs, replayed merged in timestamp order.
+            --base-url: URL of the instance to replay against.
+            --speedup: Factor dividing the recorded gaps between requests; 0 for none.
+            --concurrency: Number of concurrent clients.
+            --users: Number of users per role the requests are spread across.
+            --limit: Replay at most this many requests.
+            --json: File to also write the report to.
+        """
+        parser.add_argument('logs', nargs='+', help='NDJSON traffic logs, replayed merged in timestamp order.')
+        parser.add_argument('--base-url', default='http://localhost:8000', help='URL of the instance to replay against.')
+        parser.add_argument('--speedup', type=float, default=1.0, help='Factor dividing the recorded gaps between requests; 0 for none.')
+        parser.add_argument('--concurrency', type=int, default=8, help='Number of concurrent clients.')
+        parser.add_argument('--users', type=int, default=20, help='Number of users per role the requests are spread across.')
+        parser.add_argument('--limit', type=int, default=None, help='Replay at most this many requests.')
+        parser.add_argument('--json', dest='json_path', default=None, help='File to also write the report to.')
+
+    def handle(self, *args, **options):
+        """Replays the logs and writes the report."""
+        records = read_log(options['logs'])[:options['limit']]
+        if not records:
+            raise CommandError('The logs contain no requests.')
+        url = urlsplit(options['base_url'])
+        if url.scheme not in ('http', 'https') or not url.hostname:
+            raise CommandError('--base-url must be an http(s) URL.')
+        self.url = url
+        self.tokens = self.user_tokens({record.get('role', 'anonymous') for record in records}, options['users'])
+        self.local = threading.local()
+        self.results = defaultdict(list)  # route -> [(status, milliseconds)]
+        self.lag = 0.0
+        self.lock = threading.Lock()
+
+        self.stdout.write(f"Replaying {len(records)} request(s) against {options['base_url']}...")
+        started = time.perf_counter()
+        first = records[0]['ts']
+        speedup = options['speedup']
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+            for index, record in enumerate(records):
+                due = started + (record['ts'] - first) / speedup if speedup > 0 else started
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                executor.submit(self.replay, record, index, due)
+        elapsed = time.perf_counter() - started
+        self.write_report(len(records), elapsed, speedup > 0, options['json_path'])
+
+    def user_tokens(self, roles, count):
+        """Returns the API tokens of up to `count` users for each role in `roles`."""
+        tokens = {'anonymous': [None]}
+        for role in roles - {'anonymous'}:
+            users = list(User.objects.filter(role=role, is_active=True).order_by('pk')[:count])
+            if not users:
+                raise CommandError(f'The database has no active {role} users. Run `manage.py seed_data` first.')
+            tokens[role] = [Token.objects.get_or_create(user=user)[0].key for user in users]
+        return tokens
+
+    def connection(self):
+        """Returns this thread's keep-alive connection to the target."""
+        if getattr(self.local, 'connection', None) is None:
+            connection_class = http.client.HTTPSConnection if self.url.scheme == 'https' else http.client.HTTPConnection
+            self.local.connection = connection_class(self.url.hostname, self.url.port, timeout=60)
+        return self.local.connection
+
+    def send(self, record, token):
+        """Sends one recorded request and returns its status code."""
+        path = record['path'] + ('?' + urlencode(record['query'], doseq=True) if record.get('query') else '')
+        headers = {'Accept': 'application/json'}
+        if token:
+            headers['Authorization'] = f'Token {token}'
+        body = None
+        if record.get('body') is not None:
+            body = json.dumps(record['body']).encode()
+            headers['Content-Type'] = 'application/json'
+        for attempt in range(2):
+            reused = getattr(self.local, 'connection', None) is not None
+            connection = self.connection()
+            try:
+                connection.request(record['method'], path, body=body, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                break
+            except (OSError, http.client.HTTPException) as error:
+                connection.close()
+                self.local.connection = None
+                # A kept-alive connection the server closed while idle is retried once.
+                if not (reused and attempt == 0 and isinstance(error, (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError))):
+                    raise
+        if response.getheader('Connection', '').lower() == 'close':
+            connection.close()
+            self.local.connection = None
+        return response.status
+
+    def replay(self, record, index, due):
+        """Replays one request and records its outcome under its route."""
+        tokens = self.tokens[record.get('role', 'anonymous')]
+        started = time.perf_counter()
+        try:
+            status = self.send(record, tokens[index % len(tokens)])
+        except (OSError, http.client.HTTPException):
+            status = None
+        milliseconds = (time.perf_counter() - started) * 1000
+        route = f"{record['method']} {record.get('route') or record['path']}"
+        with self.lock:
+            self.results[route].append((status, milliseconds))
+            self.lag = max(self.lag, started - due)
+
+    def write_report(self, total, elapsed, scheduled, json_path):
+        """Writes the per-route latencies and errors, and optionally saves them as JSON."""
+        report = {'requests': total, 'seconds': round(elapsed, 3), 'max_lag_ms': round(self.lag * 1000, 1), 'routes': {}}
+        self.stdout.write(f"{'route':<40} {'count':>7} {'4xx':>5} {'errors':>6} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}")
+        for route, outcomes in sorted(self.results.items(), key=lambda item: -len(item[1])):
+            latencies = sorted(milliseconds for _, milliseconds in outcomes)
+            row = {
+                'count': len(outcomes),
+                'client_errors': sum(1 for status, _ in outcomes if status is not None and 400 <= status < 500),
+                'errors': sum(1 for status, _ in outcomes if status is None or status >= 500),
+                **{f'p{rank}_ms': round(percentile(latencies, rank), 2) for rank in (50, 95, 99)},
+                'max_ms': round(latencies[-1], 2),
+            }
+            report['routes'][route] = row
+            self.stdout.write(
+                f"{route:<40} {row['count']:>7} {row['client_errors']:>5} {row['errors']:>6} "
+                f"{row['p50_ms']:>8.1f} {row['p95_ms']:>8.1f} {row['p99_ms']:>8.1f} {row['max_ms']:>8.1f}"
+            )
+
+        if json_path:
+            with open(json_path, 'w', encoding='utf-8') as output:
+                json.dump(report, output, indent=2)
+        errors = sum(row['errors'] for row in report['routes'].values())
+        summary = f'Replayed {total} request(s) in {elapsed:.1f}s ({total / elapsed:.1f} req/s) with {errors} error(s)'
+        if scheduled:
+            summary += f"; fell behind the recorded schedule by up to {report['max_lag_ms']:.0f} ms"
+        summary += '.'
+        self.stdout.write(self.style.SUCCESS(summary) if not errors else self.style.WARNING(summary))
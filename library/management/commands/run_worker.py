@@ -0,0 +1,126 @@
+"""
+library/management/commands/run_worker.py
+
+This file is part of the University Library project.
+It contains a Django management command that processes the background
+tasks queued in the `Task` table.
+
+Author: Raul Berrios
+"""
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from library.tasks import claim, execute, heartbeat, prune_finished, requeue_stale
+
+# How often, in seconds, a worker recovers stale tasks and prunes old ones.
+MAINTENANCE_SECONDS = 60
+
+
+class Command(BaseCommand):
+    """
+    A custom Django management command to run a background task worker.
+
+    The worker claims due tasks, highest priority first, and runs up to
+    `--concurrency` of them at a time on a pool of threads, or of processes
+    for CPU-bound work (`--pool process`). When the queue is empty it polls
+    every `LIBRARY_TASK_POLL_SECONDS`. Every `LIBRARY_TASK_HEARTBEAT_SECONDS`
+    it refreshes the heartbeat of the tasks it runs, and once a minute it
+    hands the tasks of dead workers (whose heartbeat stopped) back to the
+    queue and deletes old finished tasks. Several workers, on one or several
+    machines, can run side by side.
+
+    SIGTERM or Ctrl-C stops claiming tasks and waits for the running ones.
+
+    Usage:
+        python manage.py run_worker
+        python manage.py run_worker --concurrency 8
+        python manage.py run_worker --pool process --concurrency 4
+        python manage.py run_worker --burst
+    """
+    help = 'Processes queued background tasks.'
+
+    def add_arguments(self, parser):
+        """
+        Adds command-line arguments to the command.
+
+        Arguments:
+            --concurrency: Number of tasks run at a time.
+            --pool: Run tasks on threads or processes.
+            --burst: Exit once no task is due instead of waiting for more.
+        """
+        parser.add_argument('--concurrency', type=int, default=None, help='Number of tasks run at a time (default: LIBRARY_TASK_WORKERS).')
+        parser.add_argument('--pool', choices=['thread', 'process'], default='thread', help='Run tasks on threads or processes.')
+        parser.add_argument('--burst', action='store_true', help='Exit once no task is due instead of waiting for more.')
+
+    def handle(self, *args, **options):
+        """Claims and runs tasks until stopped (or, with --burst, until none is due)."""
+        concurrency = options['concurrency'] or settings.LIBRARY_TASK_WORKERS
+        worker = f'{socket.gethostname()}:{os.getpid()}'
+        stopping = threading.Event()
+        handles_signals = threading.current_thread() is threading.main_thread()
+        if handles_signals:
+            previous_handler = signal.signal(signal.SIGTERM, lambda *_: stopping.set())
+
+        if options['pool'] == 'process':
+            # `spawn` rather than `fork`: each process sets Django up and opens its own connections.
+            connections.close_all()
+            pool = ProcessPoolExecutor(max_workers=concurrency, mp_context=multiprocessing.get_context('spawn'), initializer=django.setup)
+        else:
+            pool = ThreadPoolExecutor(max_workers=concurrency)
+
+        self.stdout.write(f"Worker {worker} running up to {concurrency} task(s) on a {options['pool']} pool.")
+        running = set()
+        processed = 0
+        next_maintenance = next_heartbeat = 0.0
+        try:
+            while not stopping.is_set():
+                if running and time.monotonic() >= next_heartbeat:
+                    heartbeat(worker)
+                    next_heartbeat = time.monotonic() + settings.LIBRARY_TASK_HEARTBEAT_SECONDS
+                if time.monotonic() >= next_maintenance:
+                    recovered, pruned = requeue_stale(), prune_finished()
+                    if recovered or pruned:
+                        self.stdout.write(f'Requeued {recovered} stale task(s) and pruned {pruned} finished task(s).')
+                    next_maintenance = time.monotonic() + MAINTENANCE_SECONDS
+
+                while len(running) < concurrency:
+                    task_id = claim(worker)
+                    if task_id is None:
+                        break
+                    running.add(pool.submit(execute, task_id))
+
+                if not running:
+                    if options['burst']:
+                        break
+                    stopping.wait(settings.LIBRARY_TASK_POLL_SECONDS)
+                    continue
+                done, running = wait(running, timeout=settings.LIBRARY_TASK_POLL_SECONDS, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is not None:
+                        self.stderr.write(f'A task could not be run: {future.exception()!r}')
+                processed += len(done)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stdout.write(f'Waiting for {len(running)} running task(s)...' if running else 'Stopping.')
+            while running:
+                # Running tasks keep their heartbeat until they finish.
+                done, running = wait(running, timeout=settings.LIBRARY_TASK_HEARTBEAT_SECONDS)
+                processed += len(done)
+                if running:
+                    heartbeat(worker)
+            pool.shutdown(wait=True)
+            connections.close_all()
+            if handles_signals:
+                signal.signal(signal.SIGTERM, previous_handler)
+        self.stdout.write(self.style.SUCCESS(f'Worker {worker} processed {processed} task(s).'))
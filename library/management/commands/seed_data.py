@@ -12,7 +12,7 @@ import random
 from django.core.management.base import BaseCommand
 from django.db import transaction
 from faker import Faker
-from library.models import User, Book
+from library.models import User, Book, StockMovement
 
 class Command(BaseCommand):
     """
@@ -123,5 +123,9 @@ class Command(BaseCommand):
             for _ in range(num_books)
         ]
         Book.objects.bulk_create(books)
+        # bulk_create skips Book.save(), so the opening stock is recorded here
+        StockMovement.objects.bulk_create(
+            StockMovement(book=book, delta=book.stock, reason=StockMovement.OPENING) for book in books
+        )
 
         self.stdout.write(self.style.SUCCESS(f'Successfully created {created_users_count} new users and {num_books} books.'))
\ No newline at end of file
@@ -0,0 +1,54 @@
+"""
+library/management/commands/shard_stock.py
+
+This file is part of the University Library project.
+It contains a Django management command that splits the stock of heavily
+borrowed titles across several counter rows.
+
+Author: Raul Berrios
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from library.models import Book
+from library.stock import split_stock
+
+
+class Command(BaseCommand):
+    """
+    A custom Django management command to shard the stock of books.
+
+    Every checkout of a title decrements its stock, so during rushes on a
+    single title (e.g. course reading at the start of a semester) all
+    checkouts of that title queue for the lock on its row. Once sharded,
+    each checkout takes a copy from one of `--shards` counter rows instead
+    (see `library.stock`). Run `compact_stock` once the rush is over.
+
+    Usage:
+        python manage.py shard_stock 42 57
+        python manage.py shard_stock 42 --shards 16
+    """
+    help = 'Splits the stock of the given books across several counter rows.'
+
+    def add_arguments(self, parser):
+        """
+        Adds command-line arguments to the command.
+
+        Arguments:
+            book_ids: The books to shard.
+            --shards: Number of counter rows per book (default: LIBRARY_STOCK_SHARDS).
+        """
+        parser.add_argument('book_ids', nargs='+', type=int, help='The books to shard.')
+        parser.add_argument('--shards', type=int, default=None, help='Number of counter rows per book (default: LIBRARY_STOCK_SHARDS).')
+
+    def handle(self, *args, **options):
+        """Shards each book in its own transaction."""
+        if options['shards'] is not None and options['shards'] < 1:
+            raise CommandError('--shards must be at least 1.')
+        for book_id in options['book_ids']:
+            try:
+                book = split_stock(book_id, options['shards'])
+            except Book.DoesNotExist:
+                raise CommandError(f'Book {book_id} does not exist.')
+            self.stdout.write(self.style.SUCCESS(
+                f'"{book.title}": {book.current_stock()} copies across {book.stock_shards} shards.'
+            ))
@@ -0,0 +1,70 @@
+# Generated by Django 5.2.18 on 2026-10-19 03:50
+
+from datetime import timedelta
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_due_dates(apps, schema_editor):
+    """Gives existing loans the default student loan period."""
+    Checkout = apps.get_model('library', 'Checkout')
+    period = timedelta(days=settings.LIBRARY_LOAN_PERIODS['student'])
+    Checkout.objects.filter(due_date__isnull=True).update(due_date=models.F('checkout_date') + period)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='JobWatermark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('value', models.DateTimeField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='OverdueNotice',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('due_date', models.DateTimeField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='checkout',
+            name='due_date',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='checkout',
+            name='is_overdue',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddIndex(
+            model_name='checkout',
+            index=models.Index(condition=models.Q(('return_date__isnull', True)), fields=['due_date'], name='checkout_active_due_idx'),
+        ),
+        migrations.AddField(
+            model_name='overduenotice',
+            name='checkout',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='overdue_notices', to='library.checkout'),
+        ),
+        migrations.AddField(
+            model_name='overduenotice',
+            name='student',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='overdue_notices', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddConstraint(
+            model_name='overduenotice',
+            constraint=models.UniqueConstraint(fields=('checkout', 'due_date'), name='unique_overdue_notice'),
+        ),
+        migrations.RunPython(backfill_due_dates, migrations.RunPython.noop),
+    ]
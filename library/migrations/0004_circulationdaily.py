@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-19 03:53
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0003_hold'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CirculationDaily',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('genre', models.CharField(max_length=100)),
+                ('checkouts', models.PositiveIntegerField(default=0)),
+                ('returns', models.PositiveIntegerField(default=0)),
+                ('loan_seconds', models.BigIntegerField(default=0)),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='circulation', to='library.book')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['date', 'genre'], name='circulation_date_genre_idx')],
+                'constraints': [models.UniqueConstraint(fields=('date', 'book', 'genre'), name='unique_circulation_day')],
+            },
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-19 04:38
+
+from django.db import migrations, models
+
+
+def create_trigram_index(apps, schema_editor):
+    """Indexes the search document of active loans for `LIKE '%term%'` on PostgreSQL."""
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    schema_editor.execute(
+        'CREATE INDEX IF NOT EXISTS checkout_search_trgm_idx ON library_checkout '
+        'USING gin (search_document gin_trgm_ops) WHERE return_date IS NULL'
+    )
+
+
+def drop_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX IF EXISTS checkout_search_trgm_idx')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0008_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='checkout',
+            name='search_document',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+        # Existing rows are filled by migration 0014.
+        migrations.RunPython(create_trigram_index, drop_trigram_index),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-19 04:41
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_active_checkouts(apps, schema_editor):
+    """Counts the active loans of existing users."""
+    User = apps.get_model('library', 'User')
+    Checkout = apps.get_model('library', 'Checkout')
+    counts = (
+        Checkout.objects.filter(student=OuterRef('pk'), return_date__isnull=True)
+        .order_by()
+        .values('student')
+        .annotate(count=Count('pk'))
+        .values('count')
+    )
+    User.objects.update(active_checkout_count=Coalesce(Subquery(counts), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0009_checkout_search_document'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='active_checkout_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_active_checkouts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.2.18 on 2026-10-19 04:47
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import Sum
+
+
+def record_opening_stock(apps, schema_editor):
+    """Opens the ledger of existing books with the stock they have now."""
+    Book = apps.get_model('library', 'Book')
+    StockMovement = apps.get_model('library', 'StockMovement')
+    books = Book.objects.annotate(shard_stock=Sum('shards__count')).order_by('pk').values_list('pk', 'stock', 'shard_stock')
+    movements = (
+        StockMovement(book_id=book_id, delta=stock + (shard_stock or 0), reason='opening')
+        for book_id, stock, shard_stock in books.iterator(chunk_size=1000)
+        if stock or shard_stock
+    )
+    StockMovement.objects.bulk_create(movements, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0010_user_active_checkout_count'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockMovement',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('delta', models.IntegerField()),
+                ('reason', models.CharField(choices=[('opening', 'Opening stock'), ('checkout', 'Checkout'), ('return', 'Return'), ('adjustment', 'Adjustment'), ('reconciliation', 'Reconciliation')], max_length=16)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('book', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='stock_movements', to='library.book')),
+                ('checkout', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='library.checkout')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['book', 'delta'], name='stockmovement_book_delta_idx')],
+            },
+        ),
+        migrations.RunPython(record_opening_stock, migrations.RunPython.noop),
+    ]
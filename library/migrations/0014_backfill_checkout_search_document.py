@@ -0,0 +1,49 @@
+from django.db import migrations
+from django.db.models import OuterRef, Subquery, TextField, Value
+from django.db.models.functions import Concat, Lower
+
+# Checkouts updated per statement.
+BATCH_SIZE = 10000
+
+
+def fill_search_documents(apps, schema_editor):
+    """
+    Fills the empty search documents of existing checkouts, which librarian
+    searches filter on, in primary key batches. The expression is a frozen
+    copy of `library.search.search_document_expression`.
+    """
+    User = apps.get_model('library', 'User')
+    Book = apps.get_model('library', 'Book')
+    Checkout = apps.get_model('library', 'Checkout')
+
+    def joined(model, fields, outer_ref):
+        parts = []
+        for name in fields:
+            parts += [name, Value('\n')]
+        row = model.objects.filter(pk=OuterRef(outer_ref)).annotate(document=Concat(*parts[:-1], output_field=TextField()))
+        return Subquery(row.values('document'))
+
+    document = Lower(Concat(
+        joined(User, ('username', 'first_name', 'last_name'), 'student_id'), Value('\n'),
+        joined(Book, ('title', 'author'), 'book_id'),
+        output_field=TextField(),
+    ))
+    empty = Checkout.objects.filter(search_document='').order_by('pk')
+    last_id = 0
+    while True:
+        ids = list(empty.filter(pk__gt=last_id).values_list('pk', flat=True)[:BATCH_SIZE])
+        if not ids:
+            break
+        Checkout.objects.filter(pk__in=ids).update(search_document=document)
+        last_id = ids[-1]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0013_task_heartbeat'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_search_documents, migrations.RunPython.noop),
+    ]
@@ -7,9 +7,14 @@ the structure of the User, Book, and Checkout tables in the database.
 
 Author: Raul Berrios
 """
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
 from django.contrib.auth.models import AbstractUser, UserManager
 from django.db import models
 from django.db.models import Q
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
 
@@ -48,6 +53,10 @@ class User(AbstractUser):
     either 'student' or 'librarian'. This model is the central point for
     user authentication and role-based permissions. It uses the
     CustomUserManager to handle user creation.
+
+    `active_checkout_count` is maintained by the circulation code next to
+    the book stock, so the loan limit of the user's role (see
+    `LIBRARY_LOAN_LIMITS`) is enforced without counting their loans.
     """
 
     ROLE_CHOICES = (
@@ -56,9 +65,17 @@ class User(AbstractUser):
     )
     # Add role field with default 'student'
     role = models.CharField(max_length=10, choices=ROLE_CHOICES, default="student")
+    # Number of unreturned loans; repaired by `manage.py reconcile_loan_counts`.
+    active_checkout_count = models.PositiveIntegerField(default=0, editable=False)
 
     objects = CustomUserManager()
 
+    @staticmethod
+    def loan_limit(role):
+        """Returns the maximum number of active loans for a user role."""
+        limits = settings.LIBRARY_LOAN_LIMITS
+        return limits.get(role, limits["student"])
+
 
 class Book(models.Model):
     """
@@ -66,6 +83,14 @@ class Book(models.Model):
 
     Stores details about the book, including its title, author, publication
     year, genre, and the current number of copies available in stock.
+
+    The stock of a heavily borrowed title can be split across
+    `stock_shards` counter rows (`BookStockShard`) so concurrent checkouts
+    do not all wait for the lock on this row; the copies on the shelf are
+    then `stock` plus the shard counts (see `library.stock`).
+
+    Every change of the stock is recorded in the `StockMovement` ledger,
+    starting with an opening movement when the book is created.
     """
 
     title = models.CharField(max_length=200)
@@ -73,21 +98,122 @@ class Book(models.Model):
     published_year = models.IntegerField()
     genre = models.CharField(max_length=100)
     stock = models.PositiveIntegerField(default=0)
+    stock_shards = models.PositiveSmallIntegerField(default=0)
 
     def __str__(self):
         return self.title
 
+    def save(self, *args, **kwargs):
+        """Records the initial stock of a new book in the ledger."""
+        adding = self._state.adding
+        super().save(*args, **kwargs)
+        if adding and self.stock:
+            StockMovement.objects.create(book=self, delta=self.stock, reason=StockMovement.OPENING)
+
+    def current_stock(self):
+        """
+        Returns the number of copies in stock, including the copies held in
+        stock shards. Uses the `shard_stock` annotation when present (see
+        `library.fieldsets.shape_book_queryset`).
+        """
+        if not self.stock_shards:
+            return self.stock
+        shard_stock = getattr(self, "shard_stock", None)
+        if shard_stock is None:
+            shard_stock = self.shards.aggregate(total=models.Sum("count"))["total"] or 0
+        return self.stock + shard_stock
+
+
+class BookStockShard(models.Model):
+    """
+    One of the counter rows a sharded book's stock is split across.
+
+    Checkouts take a copy from a random shard with a conditional UPDATE and
+    try the other shards when it is empty; returns add the copy to a random
+    shard. `manage.py compact_stock` folds the shards back into
+    `Book.stock`.
+    """
+
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name="shards")
+    shard = models.PositiveSmallIntegerField()
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["book", "shard"], name="unique_book_shard"),
+        ]
+
+    def __str__(self):
+        return f"{self.book_id}#{self.shard}: {self.count}"
+
+
+class StockMovement(models.Model):
+    """
+    An append-only ledger entry recording a change of a book's stock.
+
+    Movements are written in the same transaction as the change they record
+    (see `library.stock` and `library.circulation`), so the sum of a book's
+    deltas is the stock it should have; `manage.py reconcile_stock` compares
+    the two. Copies lent from a hold never reach the stock and are not
+    recorded.
+    """
+
+    OPENING = "opening"
+    CHECKOUT = "checkout"
+    RETURN = "return"
+    ADJUSTMENT = "adjustment"
+    RECONCILIATION = "reconciliation"
+    REASON_CHOICES = (
+        (OPENING, "Opening stock"),
+        (CHECKOUT, "Checkout"),
+        (RETURN, "Return"),
+        (ADJUSTMENT, "Adjustment"),
+        (RECONCILIATION, "Reconciliation"),
+    )
+
+    # Indexed together with `delta` below, so summing a book's movements
+    # only reads the index.
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name="stock_movements", db_index=False)
+    delta = models.IntegerField()
+    reason = models.CharField(max_length=16, choices=REASON_CHOICES)
+    checkout = models.ForeignKey("Checkout", on_delete=models.SET_NULL, null=True, blank=True, related_name="+")
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["book", "delta"], name="stockmovement_book_delta_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.book_id} {self.delta:+d} ({self.reason})"
+
 
 class Checkout(models.Model):
     """
     Represents a checkout record for a book by a student.
 
     This model links a student (User) to a book they have checked out.
-    It includes the checkout date and an optional return date. A database
-    constraint (`unique_active_checkout`) prevents a student from checking
-    out the same book more than once if it hasn't been returned yet.
+    It includes the checkout date, the due date and an optional return date.
+    A database constraint (`unique_active_checkout`) prevents a student from
+    checking out the same book more than once if it hasn't been returned yet.
+
+    The due date defaults to the checkout time plus the loan period of the
+    borrower's role (see `LIBRARY_LOAN_PERIODS`). A partial index on the due
+    date of active loans (`checkout_active_due_idx`) keeps overdue scans
+    proportional to the number of overdue loans rather than the table size.
+
+    `search_document` holds the student's username and names and the book's
+    title and author, lowercased, so librarian searches filter a single
+    column (trigram-indexed on PostgreSQL) instead of joining the three
+    tables. It is kept current by `library.search`.
     """
 
+    # Fields copied into `search_document`. Search terms never contain a
+    # newline, so a term cannot match across two fields.
+    SEARCH_STUDENT_FIELDS = ("username", "first_name", "last_name")
+    SEARCH_BOOK_FIELDS = ("title", "author")
+    SEARCH_SEPARATOR = "\n"
+
     student = models.ForeignKey(
         User,
         on_delete=models.CASCADE,
@@ -96,7 +222,11 @@ class Checkout(models.Model):
     )
     book = models.ForeignKey(Book, on_delete=models.CASCADE)
     checkout_date = models.DateTimeField(auto_now_add=True)
+    due_date = models.DateTimeField(null=True, blank=True)
     return_date = models.DateTimeField(null=True, blank=True)
+    # Set in bulk by `manage.py scan_overdue` once the loan becomes overdue.
+    is_overdue = models.BooleanField(default=False)
+    search_document = models.TextField(blank=True, default="", editable=False)
 
     class Meta:
         constraints = [
@@ -106,6 +236,304 @@ class Checkout(models.Model):
                 name="unique_active_checkout",
             )
         ]
+        indexes = [
+            models.Index(
+                fields=["due_date"],
+                condition=Q(return_date__isnull=True),
+                name="checkout_active_due_idx",
+            )
+        ]
 
     def __str__(self):
         return f"{self.student.username} - {self.book.title}"
+
+    @staticmethod
+    def loan_period(role):
+        """Returns the loan period for a user role, as a timedelta."""
+        periods = settings.LIBRARY_LOAN_PERIODS
+        return timedelta(days=periods.get(role, periods["student"]))
+
+    def build_search_document(self):
+        """Returns the search document of this loan, from its student and book."""
+        values = [getattr(self.student, name) for name in self.SEARCH_STUDENT_FIELDS]
+        values += [getattr(self.book, name) for name in self.SEARCH_BOOK_FIELDS]
+        return self.SEARCH_SEPARATOR.join(value or "" for value in values).lower()
+
+    def save(self, *args, **kwargs):
+        """Sets the due date from the student's role and the search document on the first save."""
+        if self._state.adding:
+            if self.due_date is None:
+                self.due_date = timezone.now() + self.loan_period(self.student.role)
+            if not self.search_document:
+                self.search_document = self.build_search_document()
+        super().save(*args, **kwargs)
+
+
+class Hold(models.Model):
+    """
+    A student's place in the queue for a book that is out of stock.
+
+    Holds are served first-in, first-out: when a copy is returned it is lent
+    directly to the oldest pending hold instead of going back into stock
+    (see `library.circulation.return_checkout`). The partial index on
+    (book, created_at) of pending holds makes finding the head of a queue
+    and computing queue positions index-only operations.
+    """
+
+    PENDING = "pending"
+    FULFILLED = "fulfilled"
+    CANCELLED = "cancelled"
+    STATUS_CHOICES = (
+        (PENDING, "Pending"),
+        (FULFILLED, "Fulfilled"),
+        (CANCELLED, "Cancelled"),
+    )
+
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name="holds")
+    student = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name="holds",
+        limit_choices_to={"role": "student"},
+    )
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    created_at = models.DateTimeField(auto_now_add=True)
+    fulfilled_at = models.DateTimeField(null=True, blank=True)
+    # The loan created for the student when the hold was fulfilled.
+    checkout = models.OneToOneField(Checkout, on_delete=models.SET_NULL, null=True, blank=True, related_name="hold")
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["student", "book"],
+                condition=Q(status="pending"),
+                name="unique_pending_hold",
+            )
+        ]
+        indexes = [
+            models.Index(
+                fields=["book", "created_at"],
+                condition=Q(status="pending"),
+                name="hold_queue_idx",
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.student.username} - {self.book.title} ({self.status})"
+
+
+class CirculationDaily(models.Model):
+    """
+    Daily circulation totals per book, backing the librarian reports.
+
+    One row per (date, book, genre) holds the loans opened and closed that
+    day and the total duration of the closed loans. Rows are updated as
+    loans are opened and returned (see `library.rollups`) and can be
+    recomputed from `Checkout` with `manage.py rollup_circulation`, so
+    reports never have to aggregate the full checkout history.
+    """
+
+    date = models.DateField()
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name="circulation")
+    # Denormalized from the book so per-genre reports need no join.
+    genre = models.CharField(max_length=100)
+    checkouts = models.PositiveIntegerField(default=0)
+    returns = models.PositiveIntegerField(default=0)
+    loan_seconds = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["date", "book", "genre"], name="unique_circulation_day"),
+        ]
+        indexes = [
+            models.Index(fields=["date", "genre"], name="circulation_date_genre_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.date} - {self.book_id} ({self.checkouts} out, {self.returns} in)"
+
+
+class RelatedBook(models.Model):
+    """
+    A precomputed "borrowed together" recommendation.
+
+    For each book, the `rank`-th most co-borrowed book and the number of
+    students (`score`) who borrowed both. Built offline by
+    `manage.py build_related`; the unique (book, rank) index lets the API
+    read a book's recommendations with a single index range scan.
+    """
+
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name="related_books")
+    related = models.ForeignKey(Book, on_delete=models.CASCADE, related_name="+")
+    score = models.PositiveIntegerField()
+    rank = models.PositiveSmallIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["book", "rank"], name="unique_related_rank"),
+        ]
+
+    def __str__(self):
+        return f"{self.book_id} -> {self.related_id} ({self.score})"
+
+
+class OverdueNotice(models.Model):
+    """
+    A notification that a loan became overdue.
+
+    Written in bulk by `manage.py scan_overdue`. The unique constraint on
+    (checkout, due_date) makes the scan idempotent: re-processing a batch
+    after a crash does not notify the student twice.
+    """
+
+    checkout = models.ForeignKey(Checkout, on_delete=models.CASCADE, related_name="overdue_notices")
+    student = models.ForeignKey(User, on_delete=models.CASCADE, related_name="overdue_notices")
+    due_date = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["checkout", "due_date"], name="unique_overdue_notice"),
+        ]
+
+    def __str__(self):
+        return f"Overdue: {self.checkout_id} (due {self.due_date:%Y-%m-%d})"
+
+
+class OutboxEvent(models.Model):
+    """
+    A change to book availability or to a loan, recorded in the same
+    transaction as the change itself (a transactional outbox).
+
+    The event stream at `/api/events/` sends these rows to subscribed
+    clients in `id` order; the `id` doubles as the SSE event ID clients
+    resume from with `Last-Event-ID`. Old rows are removed by
+    `manage.py prune_events`.
+    """
+
+    BOOK_AVAILABILITY = "book.availability"
+    CHECKOUT_CREATED = "checkout.created"
+    CHECKOUT_RETURNED = "checkout.returned"
+    KIND_CHOICES = (
+        (BOOK_AVAILABILITY, "Book availability"),
+        (CHECKOUT_CREATED, "Checkout created"),
+        (CHECKOUT_RETURNED, "Checkout returned"),
+    )
+
+    kind = models.CharField(max_length=32, choices=KIND_CHOICES)
+    # Set for loan events, whose payload only the borrower and librarians may see.
+    student = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True, related_name="+")
+    payload = models.JSONField(encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return f"#{self.pk} {self.kind}"
+
+
+class IdempotencyKey(models.Model):
+    """
+    The outcome of a mutating API request sent with an `Idempotency-Key`
+    header, stored so that retries of the request are answered with the
+    same response instead of being processed again.
+
+    A row without a `status_code` is a request still being processed.
+    Keys are scoped to the user and expire after
+    `LIBRARY_IDEMPOTENCY_TTL_SECONDS` (see `library.idempotency`).
+    """
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="+")
+    key = models.CharField(max_length=255)
+    # SHA-256 of the method, path and body, to detect a key reused for another request.
+    fingerprint = models.CharField(max_length=64)
+    status_code = models.PositiveSmallIntegerField(null=True, blank=True)
+    response = models.JSONField(encoder=DjangoJSONEncoder, null=True, blank=True)
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "key"], name="unique_idempotency_key"),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id}:{self.key}"
+
+
+class JobWatermark(models.Model):
+    """
+    Records how far an incremental background job has progressed.
+
+    Jobs such as `scan_overdue` only process rows newer than their
+    watermark and advance it once a run completes.
+    """
+
+    name = models.CharField(max_length=100, unique=True)
+    value = models.DateTimeField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} @ {self.value.isoformat()}"
+
+    @classmethod
+    def get(cls, name, default=None):
+        """Returns the watermark value of job `name`, or `default`."""
+        value = cls.objects.filter(name=name).values_list("value", flat=True).first()
+        return default if value is None else value
+
+    @classmethod
+    def advance(cls, name, value):
+        """Stores `value` as the new watermark of job `name`."""
+        cls.objects.update_or_create(name=name, defaults={"value": value})
+
+
+class Task(models.Model):
+    """
+    A unit of background work queued in the database and run by
+    `manage.py run_worker` (see `library.tasks`), so that long operations do
+    not hold a request worker.
+
+    Workers claim the queued task with the highest `priority` whose
+    `run_after` has passed; the partial index on queued tasks makes that an
+    index scan however many finished tasks are kept. A failed attempt is
+    retried with an exponential backoff until `max_attempts` is reached.
+    The worker running a task refreshes its `heartbeat_at`; a running task
+    whose heartbeat stopped lost its worker and is queued again.
+    """
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    STATUS_CHOICES = (
+        (QUEUED, "Queued"),
+        (RUNNING, "Running"),
+        (SUCCEEDED, "Succeeded"),
+        (FAILED, "Failed"),
+    )
+
+    name = models.CharField(max_length=100)
+    kwargs = models.JSONField(encoder=DjangoJSONEncoder, default=dict, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    priority = models.SmallIntegerField(default=0)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=3)
+    run_after = models.DateTimeField(default=timezone.now)
+    result = models.JSONField(encoder=DjangoJSONEncoder, null=True, blank=True)
+    error = models.TextField(blank=True)
+    worker = models.CharField(max_length=100, blank=True)
+    created_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True, related_name="+")
+    created_at = models.DateTimeField(default=timezone.now)
+    started_at = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["-priority", "run_after", "id"],
+                condition=Q(status="queued"),
+                name="task_queue_idx",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.name} #{self.pk} ({self.status})"
@@ -0,0 +1,205 @@
+"""
+library/pagination.py
+
+This file is part of the University Library project.
+It contains the pagination classes used by the library API in addition to
+the project-wide default configured in `REST_FRAMEWORK`, and the admin's
+paginator for large tables.
+
+Author: Raul Berrios
+"""
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.paginator import InvalidPage, Page, Paginator
+from django.db import connections
+from django.db.models import QuerySet
+from django.utils.functional import cached_property
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.pagination import CursorPagination, PageNumberPagination
+from rest_framework.response import Response
+
+
+class OverdueCursorPagination(CursorPagination):
+    """
+    Keyset pagination for overdue loans, oldest due date first.
+
+    Pages are fetched with `WHERE (due_date, id) > cursor` instead of an
+    OFFSET, so deep pages are as cheap as the first one and the list is
+    stable while loans are being returned.
+    """
+    ordering = ('due_date', 'id')
+    page_size = 100
+
+
+def estimate_count(queryset):
+    """
+    Returns the query planner's estimate of the number of rows of
+    `queryset`, or None where no estimate is available (databases other
+    than PostgreSQL).
+
+    An unfiltered queryset is estimated from the table statistics in
+    `pg_class`, a filtered one from its `EXPLAIN` plan; neither scans the
+    table, unlike `COUNT(*)`.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+    if not queryset.query.where:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass', [queryset.model._meta.db_table])
+            row = cursor.fetchone()
+        if row and row[0] >= 0:  # -1 until the table is first analyzed
+            return row[0]
+    plan = json.loads(queryset.order_by().explain(format='json'))
+    if isinstance(plan, list):  # the driver returned the plan as text
+        plan = plan[0]
+    return int(plan['Plan']['Plan Rows'])
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator using an estimated count for large querysets.
+
+    Counts below `LIBRARY_EXACT_COUNT_THRESHOLD` (and every count on
+    databases without estimates) are exact. Above it, page links are based
+    on the planner's estimate, so the last pages may be off by a few rows,
+    but rendering a page no longer scans the whole table.
+    """
+
+    @cached_property
+    def count(self):
+        estimate = estimate_count(self.object_list) if isinstance(self.object_list, QuerySet) else None
+        if estimate is None or estimate < settings.LIBRARY_EXACT_COUNT_THRESHOLD:
+            return super().count
+        return estimate
+
+
+class CountedPaginator(Paginator):
+    """A Django paginator whose number of objects was determined beforehand."""
+
+    def __init__(self, object_list, per_page, count, **kwargs):
+        super().__init__(object_list, per_page, **kwargs)
+        self.count = count
+
+
+class CountModePagination(PageNumberPagination):
+    """
+    Page number pagination letting the client choose how the total is
+    counted with `?count=`:
+
+    - `exact` (default): an exact `COUNT(*)`, as with `PageNumberPagination`.
+    - `estimate`: the planner's estimate on PostgreSQL, or a count capped at
+      `LIBRARY_EXACT_COUNT_THRESHOLD` rows elsewhere (e.g. "10000+");
+      estimates of filtered lists are cached for `LIBRARY_COUNT_CACHE_SECONDS`
+      by query signature. `count_approximate` tells whether `count` is exact.
+      Pages are fetched as with `none`, so an estimate lower than the real
+      count never hides rows, and the last page reports the exact count.
+    - `none`: no count at all; one extra row is fetched to know whether
+      there is a next page, and `count` is null.
+    """
+    count_query_param = 'count'
+    count_modes = ('exact', 'estimate', 'none')
+
+    def get_count_mode(self, request):
+        mode = request.query_params.get(self.count_query_param) or 'exact'
+        if mode not in self.count_modes:
+            raise ValidationError({self.count_query_param: f'Must be one of: {", ".join(self.count_modes)}.'})
+        return mode
+
+    def estimate_total(self, queryset):
+        """Returns `(count, approximate)` for `?count=estimate`."""
+        filtered = bool(queryset.query.where)
+        if filtered:
+            sql, params = queryset.query.sql_with_params()
+            key = 'library:count:' + hashlib.sha256(f'{queryset.db}:{sql}:{params!r}'.encode()).hexdigest()
+            total = cache.get(key)
+            if total is not None:
+                return tuple(total)
+
+        threshold = settings.LIBRARY_EXACT_COUNT_THRESHOLD
+        estimate = estimate_count(queryset)
+        if estimate is not None and estimate >= threshold:
+            total = (estimate, True)
+        else:
+            # Counts at most threshold + 1 rows, in a subquery with a LIMIT.
+            count = queryset.order_by()[:threshold + 1].count()
+            total = (threshold, True) if count > threshold else (count, False)
+
+        if filtered:
+            cache.set(key, total, settings.LIBRARY_COUNT_CACHE_SECONDS)
+        return total
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.count_mode = self.get_count_mode(request)
+        self.count_approximate = False
+        if self.count_mode == 'exact':
+            return super().paginate_queryset(queryset, request, view)
+
+        page_size = self.get_page_size(request)
+        if not page_size:
+            return None
+        if self.count_mode == 'estimate':
+            self.count, self.count_approximate = self.estimate_total(queryset)
+        # Pages are never validated against the estimate, which may be lower
+        # than the real count (it is capped, or the planner is off).
+        return self.paginate_ahead(queryset, request, page_size)
+
+    def paginate_ahead(self, queryset, request, page_size):
+        """
+        Returns the requested page without counting: one extra row is
+        fetched to know whether there is a next page.
+        """
+        page_number = request.query_params.get(self.page_query_param) or 1
+        try:
+            number = int(page_number)
+            if number < 1:
+                raise InvalidPage('That page number is less than 1')
+        except (TypeError, ValueError, InvalidPage) as exc:
+            raise NotFound(self.invalid_page_message.format(page_number=page_number, message=str(exc)))
+        offset = (number - 1) * page_size
+        rows = list(queryset[offset:offset + page_size + 1])
+        if not rows and number > 1:
+            raise NotFound(self.invalid_page_message.format(page_number=page_number, message='That page contains no results'))
+        # A lower bound of the count: enough for `has_next` and the links.
+        paginator = CountedPaginator(queryset, page_size, offset + len(rows))
+        self.page = Page(rows[:page_size], number, paginator)
+        self.request = request
+        if self.count_mode == 'estimate':
+            if len(rows) <= page_size:
+                # The last page: the count is known exactly.
+                self.count, self.count_approximate = paginator.count, False
+            elif self.count < paginator.count:
+                self.count = paginator.count
+        return list(self.page)
+
+    def get_paginated_response(self, data):
+        if self.count_mode == 'exact':
+            return super().get_paginated_response(data)
+        return Response({
+            'count': self.count if self.count_mode == 'estimate' else None,
+            'count_approximate': self.count_approximate if self.count_mode == 'estimate' else True,
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        schema = super().get_paginated_response_schema(schema)
+        schema['properties']['count']['nullable'] = True
+        schema['properties']['count_approximate'] = {
+            'type': 'boolean',
+            'description': 'Only with `?count=estimate` or `?count=none`: whether `count` is approximate.',
+        }
+        return schema
+
+    def get_schema_operation_parameters(self, view):
+        return super().get_schema_operation_parameters(view) + [{
+            'name': self.count_query_param,
+            'required': False,
+            'in': 'query',
+            'description': 'How to count the results: `exact` (default), `estimate` or `none`.',
+            'schema': {'type': 'string', 'enum': list(self.count_modes)},
+        }]
@@ -0,0 +1,116 @@
+"""
+library/provisioning.py
+
+This file is part of the University Library project.
+It creates user accounts in bulk, e.g. all the students of a new semester,
+for `POST /api/users/bulk/` and `manage.py import_users`.
+
+Author: Raul Berrios
+"""
+from django.db import IntegrityError, transaction
+
+from .hashing import hash_passwords
+from .models import User
+from .serializers import BulkUserSerializer
+
+
+def existing_usernames(usernames):
+    """Returns which of `usernames` are already taken, with a single query."""
+    return set(User.objects.filter(username__in=list(usernames)).values_list('username', flat=True))
+
+
+def provision_users(rows, workers=None, batch_size=1000):
+    """
+    Creates the users described by `rows` (dicts of `BulkUserSerializer`
+    fields) and returns one result per row, in order:
+
+        {'row': 0, 'username': 'jdoe', 'status': 'created', 'id': 42}
+        {'row': 1, 'username': 'jdoe', 'status': 'error', 'errors': {...}}
+
+    Rows are validated without touching the database, usernames are checked
+    against the database with one query, passwords are hashed in parallel
+    (see `hash_passwords`) and the valid rows are inserted with
+    `bulk_create` in a single transaction. Invalid rows do not prevent the
+    others from being created.
+    """
+    results, valid = validate_users(rows)
+    return create_users(results, valid, workers=workers, batch_size=batch_size)
+
+
+def prepare_users(rows, workers=None):
+    """
+    Validates `rows` and hashes the passwords of the valid ones ahead of
+    `create_prepared_users`, so that rows queued for a background task are
+    never stored with clear-text passwords.
+
+    Returns the results of `validate_users` and the validated data of the
+    valid rows, with their hashed password and their `row` index; both are
+    JSON-serializable.
+    """
+    results, valid = validate_users(rows)
+    hashes = hash_passwords((data['password'] for _, data in valid), workers)
+    return results, [{**data, 'password': hashed, 'row': result['row']} for (result, data), hashed in zip(valid, hashes)]
+
+
+def create_prepared_users(results, users, batch_size=1000):
+    """Creates the users returned by `prepare_users` and returns one result per row, like `provision_users`."""
+    valid = [(results[user['row']], {key: value for key, value in user.items() if key != 'row'}) for user in users]
+    return create_users(results, valid, batch_size=batch_size, hashed=True)
+
+
+def validate_users(rows):
+    """
+    Validates `rows` without touching the database. Returns one result per
+    row, with the errors of the invalid ones, and the `(result, validated
+    data)` pairs of the valid ones.
+    """
+    results = []
+    valid = []
+    seen = set()
+    for index, row in enumerate(rows):
+        serializer = BulkUserSerializer(data=row)
+        username = row.get('username') if isinstance(row, dict) else None
+        result = {'row': index, 'username': username}
+        results.append(result)
+        if not serializer.is_valid():
+            result.update(status='error', errors=serializer.errors)
+        elif serializer.validated_data['username'] in seen:
+            result.update(status='error', errors={'username': ['Duplicate username in this batch.']})
+        else:
+            seen.add(serializer.validated_data['username'])
+            valid.append((result, serializer.validated_data))
+    return results, valid
+
+
+def create_users(results, valid, workers=None, batch_size=1000, hashed=False):
+    """
+    Inserts the valid rows returned by `validate_users`, hashing their
+    passwords unless they are `hashed` already, and completes `results`.
+    """
+    taken = existing_usernames(data['username'] for _, data in valid)
+    passwords = [data['password'] for _, data in valid if data['username'] not in taken]
+    hashes = passwords if hashed else hash_passwords(passwords, workers)
+
+    pending = []
+    for result, data in valid:
+        if data['username'] in taken:
+            result.update(status='error', errors={'username': ['A user with that username already exists.']})
+        else:
+            pending.append((result, User(**{**data, 'password': hashes[len(pending)]})))
+
+    try:
+        with transaction.atomic():
+            created = User.objects.bulk_create([user for _, user in pending], batch_size=batch_size)
+    except IntegrityError:
+        # A concurrent request took some of the usernames since the check above.
+        taken = existing_usernames(user.username for _, user in pending)
+        for result, user in pending:
+            if user.username in taken:
+                result.update(status='error', errors={'username': ['A user with that username already exists.']})
+        pending = [(result, user) for result, user in pending if user.username not in taken]
+        with transaction.atomic():
+            created = User.objects.bulk_create([user for _, user in pending], batch_size=batch_size)
+
+    for (result, _), user in zip(pending, created):
+        result.update(status='created', id=user.pk)
+    return results
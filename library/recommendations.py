@@ -0,0 +1,127 @@
+"""
+library/recommendations.py
+
+This file is part of the University Library project.
+It computes "borrowed together" recommendations: for every book, the books
+most often borrowed by the same students. The computation runs offline
+(see `manage.py build_related`) and its results are stored in the
+`RelatedBook` table, which the API reads with a single indexed query.
+
+Author: Raul Berrios
+"""
+from collections import Counter, defaultdict
+
+from django.db import transaction
+
+from .models import Checkout, RelatedBook
+
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:
+    np = sparse = None
+
+
+def vectorized_available():
+    """Returns True when NumPy and SciPy are installed."""
+    return sparse is not None
+
+
+def borrow_pairs(books=None):
+    """
+    Returns the distinct (student_id, book_id) pairs of the checkout
+    history, i.e. the non-zero cells of the student x book matrix.
+
+    With `books` (IDs, or a queryset of them), only the pairs of students
+    who borrowed one of them are returned: the co-borrow counts of `books`
+    depend on no others.
+    """
+    checkouts = Checkout.objects.all()
+    if books is not None:
+        checkouts = checkouts.filter(student_id__in=Checkout.objects.filter(book_id__in=books).values('student_id'))
+    return list(checkouts.values_list('student_id', 'book_id').distinct().order_by())
+
+
+def _top_k(scores, k):
+    """Sorts `(book_id, score)` pairs by descending score (then ID) and keeps `k`."""
+    return sorted(scores, key=lambda item: (-item[1], item[0]))[:k]
+
+
+def cooccurrence_vectorized(pairs, k, books=None):
+    """
+    Computes the top-`k` co-borrowed books with sparse matrix products.
+
+    Builds the binary student x book matrix `A` in CSR form and computes
+    `A[:, books].T @ A`, whose cell (i, j) counts the students who borrowed
+    both book i and book j. Only the rows of `books` are computed, which is
+    what makes incremental rebuilds cheap. Returns `{book_id: [(related_id,
+    score), ...]}`.
+    """
+    if not pairs:
+        return {}
+    data = np.asarray(pairs, dtype=np.int64)
+    student_ids, students = np.unique(data[:, 0], return_inverse=True)
+    book_ids, columns = np.unique(data[:, 1], return_inverse=True)
+    matrix = sparse.csr_matrix(
+        (np.ones(len(data), dtype=np.int32), (students, columns)),
+        shape=(len(student_ids), len(book_ids)),
+    )
+
+    if books is None:
+        rows = np.arange(len(book_ids))
+    else:
+        rows = np.flatnonzero(np.isin(book_ids, np.fromiter(books, dtype=np.int64)))
+    products = (matrix[:, rows].T.tocsr() @ matrix).tocsr()
+
+    results = {}
+    for index, row in enumerate(rows):
+        start, end = products.indptr[index], products.indptr[index + 1]
+        cols, counts = products.indices[start:end], products.data[start:end]
+        keep = cols != row  # a book is not related to itself
+        related, counts = book_ids[cols[keep]], counts[keep]
+        best = np.lexsort((related, -counts))[:k]  # highest score first, then lowest ID
+        results[int(book_ids[row])] = list(zip(related[best].tolist(), counts[best].tolist()))
+    return results
+
+
+def cooccurrence_python(pairs, k, books=None):
+    """
+    Pure Python fallback of `cooccurrence_vectorized`, used when NumPy and
+    SciPy are not installed. Produces the same results.
+    """
+    borrowed = defaultdict(set)
+    for student_id, book_id in pairs:
+        borrowed[student_id].add(book_id)
+
+    wanted = None if books is None else set(books)
+    counts = defaultdict(Counter)
+    for titles in borrowed.values():
+        for book_id in titles:
+            if wanted is not None and book_id not in wanted:
+                continue
+            counts[book_id].update(other for other in titles if other != book_id)
+    return {book_id: _top_k(counter.items(), k) for book_id, counter in counts.items()}
+
+
+def cooccurrence(pairs, k, books=None):
+    """Computes the top-`k` co-borrowed books with the fastest available implementation."""
+    if vectorized_available():
+        return cooccurrence_vectorized(pairs, k, books)
+    return cooccurrence_python(pairs, k, books)
+
+
+def store_related(results, books=None, batch_size=1000):
+    """
+    Replaces the stored recommendations of `books` (all books when None)
+    with `results`, in a single transaction.
+    """
+    rows = [
+        RelatedBook(book_id=book_id, related_id=related_id, score=score, rank=rank)
+        for book_id, related in results.items()
+        for rank, (related_id, score) in enumerate(related, start=1)
+    ]
+    with transaction.atomic():
+        stale = RelatedBook.objects.all() if books is None else RelatedBook.objects.filter(book_id__in=list(books))
+        stale.delete()
+        RelatedBook.objects.bulk_create(rows, batch_size=batch_size)
+    return len(rows)
@@ -0,0 +1,95 @@
+"""
+library/renderers.py
+
+This file is part of the University Library project.
+It contains the JSON renderer and parser used by the REST API. They are
+built on orjson when it is installed and fall back to Django REST
+Framework's stdlib-based implementations when it is not.
+
+Author: Raul Berrios
+"""
+from django.conf import settings
+from rest_framework.utils.encoders import JSONEncoder
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# DRF's encoder knows how to handle Decimals, lazy strings, querysets, etc.
+_encoder_default = JSONEncoder().default
+
+
+def fast_json_enabled():
+    """
+    Returns True when orjson is installed and not disabled in settings.
+
+    The `LIBRARY_FAST_JSON` setting can be set to False to force the stdlib
+    code path, e.g. when comparing output during an upgrade.
+    """
+    return orjson is not None and getattr(settings, 'LIBRARY_FAST_JSON', True)
+
+
+class FastJSONRenderer(JSONRenderer):
+    """
+    Renders API responses to JSON using orjson.
+
+    orjson serializes strings, numbers, UUIDs and nested dicts/lists
+    natively and is several times faster than the stdlib `json` module on
+    large paginated responses. Anything it does not understand (Decimals,
+    lazy translation strings, querysets...) is handed to DRF's
+    `JSONEncoder`, so the output matches the default renderer. Raw
+    datetimes are passed through to the encoder as well, because DRF
+    truncates them to milliseconds; serializer fields already emit them as
+    strings, so this is not on the hot path. Indented output, which is
+    only requested by the browsable API, is delegated to the parent class.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        """
+        Render `data` into JSON, returning a bytestring.
+        """
+        if data is None:
+            return b''
+
+        renderer_context = renderer_context or {}
+        if (
+            not fast_json_enabled()
+            or not self.compact
+            or self.ensure_ascii
+            or self.get_indent(accepted_media_type, renderer_context) is not None
+        ):
+            return super().render(data, accepted_media_type, renderer_context)
+
+        ret = orjson.dumps(data, default=_encoder_default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+        # Keep the stdlib renderer's guarantee that the output is a strict
+        # JavaScript subset.
+        return ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+
+
+class FastJSONParser(JSONParser):
+    """
+    Parses JSON request bodies using orjson.
+
+    Falls back to DRF's `JSONParser` when orjson is unavailable or the
+    request declares a charset other than UTF-8, which orjson does not
+    decode.
+    """
+    renderer_class = FastJSONRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        """
+        Parses the incoming bytestream as JSON and returns the resulting data.
+        """
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+        if not fast_json_enabled() or encoding.lower().replace('-', '') != 'utf8':
+            return super().parse(stream, media_type, parser_context)
+
+        try:
+            return orjson.loads(stream.read())
+        except orjson.JSONDecodeError as exc:
+            raise ParseError('JSON parse error - %s' % str(exc))
@@ -0,0 +1,146 @@
+"""
+library/rollups.py
+
+This file is part of the University Library project.
+It maintains the daily circulation rollups (`CirculationDaily`) that back the
+librarian reports: incrementally, as loans are opened and closed, and in
+batches, when catching up or rebuilding from the `Checkout` history.
+
+Author: Raul Berrios
+"""
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import Checkout, CirculationDaily
+
+
+def inline_rollups_enabled(book):
+    """
+    Returns True if the rollups of `book` are updated in the checkout and
+    return transactions. Sharded books (see `library.stock`) are left to
+    `rollup_circulation`: bumping their single rollup row of the day would
+    queue their checkouts on it again.
+    """
+    return getattr(settings, 'LIBRARY_INLINE_ROLLUPS', True) and not book.stock_shards
+
+
+def bump(day, book, **deltas):
+    """
+    Adds `deltas` (e.g. `checkouts=1`) to the rollup row of `book` on `day`,
+    creating the row if needed.
+
+    The common case is a single UPDATE. When the row does not exist yet it
+    is inserted inside a savepoint; if a concurrent transaction inserted it
+    first, the UPDATE is simply retried.
+    """
+    rows = CirculationDaily.objects.filter(date=day, book_id=book.pk, genre=book.genre)
+    increments = {name: F(name) + value for name, value in deltas.items()}
+    if rows.update(**increments):
+        return
+    try:
+        with transaction.atomic():
+            CirculationDaily.objects.create(date=day, book_id=book.pk, genre=book.genre, **deltas)
+    except IntegrityError:
+        rows.update(**increments)
+
+
+def record_checkout(checkout, book):
+    """Counts a new loan in today's rollup of its book."""
+    if inline_rollups_enabled(book):
+        bump(timezone.localdate(checkout.checkout_date), book, checkouts=1)
+
+
+def record_return(checkout, book):
+    """Counts a returned loan, and how long it lasted, in today's rollup."""
+    if inline_rollups_enabled(book):
+        loan_seconds = int((checkout.return_date - checkout.checkout_date).total_seconds())
+        bump(timezone.localdate(checkout.return_date), book, returns=1, loan_seconds=loan_seconds)
+
+
+def lock_rollups():
+    """
+    Blocks inline `bump`s until the current transaction ends, and waits for
+    the transactions which already bumped a rollup to commit. On SQLite,
+    transactions take the database's write lock when they begin (see
+    `transaction_mode` in the settings), which serializes them already.
+    """
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute(f'LOCK TABLE {CirculationDaily._meta.db_table} IN SHARE ROW EXCLUSIVE MODE')
+
+
+def rebuild_days(start, end):
+    """
+    Recomputes the rollup rows for the days `start` to `end` (inclusive)
+    from the `Checkout` table, with one grouped aggregate for loans opened
+    and one for loans closed in that range.
+
+    The aggregates are read and the existing rows for those days replaced
+    in one transaction, so the operation is idempotent and can be repeated
+    safely. When the days include today's or yesterday's, which inline
+    `bump`s may still update, the rollups are locked first (see
+    `lock_rollups`): loans committed before the lock are in the aggregates,
+    and the bumps of later ones apply to the new rows. Returns the number
+    of rows written.
+    """
+    with transaction.atomic():
+        if end >= timezone.localdate() - timedelta(days=1):
+            lock_rollups()
+        return replace_days(start, end)
+
+
+def replace_days(start, end):
+    """Recomputes and replaces the rollup rows of `start` to `end`; see `rebuild_days`."""
+    rows = {}
+    since = timezone.make_aware(datetime.combine(start, time.min))
+    until = timezone.make_aware(datetime.combine(end + timedelta(days=1), time.min))
+
+    def row(day, book_id, genre):
+        key = (day, book_id, genre)
+        if key not in rows:
+            rows[key] = CirculationDaily(date=day, book_id=book_id, genre=genre)
+        return rows[key]
+
+    opened = (
+        Checkout.objects.filter(checkout_date__gte=since, checkout_date__lt=until)
+        .annotate(day=TruncDate('checkout_date'))
+        .values('day', 'book_id', 'book__genre')
+        .annotate(count=Count('pk'))
+        .order_by()
+    )
+    for item in opened:
+        row(item['day'], item['book_id'], item['book__genre']).checkouts = item['count']
+
+    closed = (
+        Checkout.objects.filter(return_date__gte=since, return_date__lt=until)
+        .annotate(day=TruncDate('return_date'))
+        .values('day', 'book_id', 'book__genre')
+        .annotate(count=Count('pk'), duration=Sum(F('return_date') - F('checkout_date')))
+        .order_by()
+    )
+    for item in closed:
+        target = row(item['day'], item['book_id'], item['book__genre'])
+        target.returns = item['count']
+        target.loan_seconds = int(item['duration'].total_seconds()) if item['duration'] else 0
+
+    CirculationDaily.objects.filter(date__gte=start, date__lte=end).delete()
+    CirculationDaily.objects.bulk_create(rows.values(), batch_size=1000)
+    return len(rows)
+
+
+def rebuild_range(start, end, batch_days=31):
+    """
+    Rebuilds the rollups from `start` to `end` in batches of `batch_days`
+    days, so a full rebuild never holds one long transaction. Yields
+    `(batch_start, batch_end, rows_written)` after each batch.
+    """
+    day = start
+    while day <= end:
+        batch_end = min(day + timedelta(days=batch_days - 1), end)
+        yield day, batch_end, rebuild_days(day, batch_end)
+        day = batch_end + timedelta(days=1)
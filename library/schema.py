@@ -0,0 +1,158 @@
+"""
+library/schema.py
+
+This file is part of the University Library project.
+It serves the OpenAPI schema from a precomputed artifact instead of
+introspecting every viewset and serializer on each request. The artifact is
+written by `manage.py build_schema` (at image build or container boot) and
+kept in memory, rendered once per format, with ETag support.
+
+Author: Raul Berrios
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_cache_control
+from drf_spectacular.settings import spectacular_settings
+from drf_spectacular.views import SpectacularAPIView
+from rest_framework.utils.encoders import JSONEncoder
+
+
+def get_artifact_path():
+    """Returns the path of the schema artifact configured in settings."""
+    return str(settings.LIBRARY_SCHEMA_ARTIFACT)
+
+
+def generate_schema():
+    """
+    Generates the OpenAPI schema by introspecting the API and returns it as
+    JSON bytes.
+
+    This is the expensive operation the artifact exists to avoid; it is
+    what `SpectacularAPIView` does on every request.
+    """
+    generator = spectacular_settings.DEFAULT_GENERATOR_CLASS()
+    schema = generator.get_schema(request=None, public=spectacular_settings.SERVE_PUBLIC)
+    return json.dumps(schema, cls=JSONEncoder).encode()
+
+
+def write_schema_artifact(path=None):
+    """
+    Generates the schema and writes it as JSON to `path` (defaults to the
+    configured artifact). The file is replaced atomically so running
+    workers never read a partial schema. Returns the written path.
+    """
+    path = path or get_artifact_path()
+    data = generate_schema()
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as tmp:
+            tmp.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return path
+
+
+class SchemaCache:
+    """
+    Process-wide cache of the schema and its rendered representations.
+
+    The cache is keyed on the artifact's modification time and size, so a
+    deploy that writes a new artifact invalidates it on the next request at
+    the cost of a single `stat()`. When no artifact exists the schema is
+    generated once in-process and kept for the lifetime of the worker.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._key = None
+        self._schema = None
+        self._digest = None
+        self._rendered = {}
+
+    def _artifact_key(self, path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def _load(self):
+        path = get_artifact_path()
+        key = self._artifact_key(path)
+        if self._schema is not None and key == self._key:
+            return
+        with self._lock:
+            key = self._artifact_key(path)
+            if self._schema is not None and key == self._key:
+                return
+            if key is None:
+                data = generate_schema()
+            else:
+                with open(path, 'rb') as artifact:
+                    data = artifact.read()
+            self._schema = json.loads(data)
+            self._digest = hashlib.sha256(data).hexdigest()[:32]
+            self._rendered = {}
+            self._key = key
+
+    def get(self, renderer):
+        """
+        Returns `(body, etag)` for the schema rendered with `renderer`.
+        """
+        self._load()
+        media_type = renderer.media_type
+        cached = self._rendered.get(media_type)
+        if cached is None:
+            body = renderer.render(self._schema, media_type, {})
+            cached = (body, f'"{self._digest}-{renderer.format}"')
+            self._rendered[media_type] = cached
+        return cached
+
+    def clear(self):
+        """Drops the cached schema; the next request reloads it."""
+        with self._lock:
+            self._key = self._schema = self._digest = None
+            self._rendered = {}
+
+
+schema_cache = SchemaCache()
+
+
+class CachedSpectacularAPIView(SpectacularAPIView):
+    """
+    Serves the OpenAPI schema from `schema_cache`.
+
+    Behaves like `SpectacularAPIView` (same content negotiation and
+    formats) but answers from memory and honours `If-None-Match`, so the
+    Swagger UI and ReDoc pages revalidate with a 304 instead of downloading
+    the schema again. Requests for a specific `lang` or `version` are
+    passed through to the regular, uncached generation.
+    """
+
+    def _get_schema_response(self, request):
+        if request.GET.get('lang') or request.GET.get('version') or self.api_version:
+            return super()._get_schema_response(request)
+
+        renderer = request.accepted_renderer
+        body, etag = schema_cache.get(renderer)
+        if etag in request.headers.get('If-None-Match', ''):
+            response = HttpResponseNotModified()
+        else:
+            content_type = renderer.media_type
+            if renderer.charset:
+                content_type = f'{content_type}; charset={renderer.charset}'
+            response = HttpResponse(body, content_type=content_type)
+            response['Content-Disposition'] = f'inline; filename="{self._get_filename(request, None)}"'
+        response['ETag'] = etag
+        patch_cache_control(response, no_cache=True)
+        return response
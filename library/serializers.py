@@ -7,11 +7,54 @@ the User, Book, and Checkout models are converted to and from JSON.
 
 Author: Raul Berrios
 """
+from django.conf import settings
 from rest_framework import serializers
-from .models import User, Book, Checkout
+from .fieldsets import Fieldset
+from .models import User, Book, Checkout, Hold, RelatedBook, Task
+from .stock import set_stock
 from django.contrib.auth.hashers import make_password
+from django.contrib.auth.validators import UnicodeUsernameValidator
 
-class UserSerializer(serializers.ModelSerializer):
+
+class SparseFieldsetMixin:
+    """
+    Prunes serializer fields according to the request's `?fields=` and
+    `?expand=` parameters (see `library.fieldsets.Fieldset`).
+
+    Works for nested serializers as well: each serializer computes its
+    dotted path from its parents, so `?fields=book.title` prunes the nested
+    BookSerializer of a checkout. Nested serializers that are not expanded
+    are replaced by a primary key field.
+    """
+
+    def get_fieldset_prefix(self):
+        """Returns the dotted path of this serializer, e.g. 'book.'."""
+        names = []
+        node = self
+        while node is not None:
+            if getattr(node, 'field_name', None):
+                names.append(node.field_name)
+            node = node.parent
+        return ''.join(name + '.' for name in reversed(names))
+
+    def get_fields(self):
+        fields = super().get_fields()
+        request = self.context.get('request')
+        if request is None:
+            return fields
+
+        fieldset = Fieldset.from_request(request)
+        prefix = self.get_fieldset_prefix()
+        for name in list(fields):
+            path = prefix + name
+            if not fieldset.includes(path):
+                del fields[name]
+            elif isinstance(fields[name], serializers.BaseSerializer) and not fieldset.expands(path):
+                fields[name] = serializers.PrimaryKeyRelatedField(read_only=True)
+        return fields
+
+
+class UserSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     """
     Serializes User model data.
 
@@ -29,7 +72,22 @@ class UserSerializer(serializers.ModelSerializer):
         validated_data['password'] = make_password(validated_data.get('password'))
         return super().create(validated_data)
 
-class BookSerializer(serializers.ModelSerializer):
+class BulkUserSerializer(serializers.ModelSerializer):
+    """
+    Validates one row of a bulk import.
+
+    Same fields as `UserSerializer`, but without the per-row uniqueness
+    query on `username`: duplicates are detected for the whole batch at
+    once by `library.provisioning.provision_users`.
+    """
+
+    class Meta:
+        model = User
+        fields = ['username', 'first_name', 'last_name', 'email', 'role', 'password']
+        extra_kwargs = {'username': {'validators': [UnicodeUsernameValidator()]}}
+
+
+class BookSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     """
     Serializes Book model data.
 
@@ -42,24 +100,49 @@ class BookSerializer(serializers.ModelSerializer):
         model = Book
         fields = ['id', 'title', 'author', 'published_year', 'genre', 'stock', 'checked_out_count', 'available']
 
-    def get_checked_out_count(self, obj):
+    def get_checked_out_count(self, obj) -> int:
         """
         Calculates the number of times this book is currently checked out.
+
+        Uses the `active_checkouts` annotation added by the viewsets (see
+        `library.fieldsets.shape_book_queryset`) and only falls back to a
+        COUNT query for books loaded without it.
         """
-        
-        return obj.checkout_set.filter(return_date__isnull=True).count()
+        count = getattr(obj, 'active_checkouts', None)
+        if count is None:
+            count = obj.checkout_set.filter(return_date__isnull=True).count()
+        return count
     
-    def get_available(self, obj):
+    def get_available(self, obj) -> int:
         """
         Calculates the number of books currently available (stock - checked out).
         """
         # It's important to call the method to get checked_out_count
         # and not try to access the serialized field directly from obj
         checked_out = self.get_checked_out_count(obj)
-        return obj.stock - checked_out
+        return obj.current_stock() - checked_out
 
+    def to_representation(self, instance):
+        """Reports the stock of sharded books as the total across their shards."""
+        data = super().to_representation(instance)
+        if 'stock' in data and instance.stock_shards:
+            data['stock'] = instance.current_stock()
+        return data
 
-class CheckoutStudentSerializer(serializers.ModelSerializer):
+    def update(self, instance, validated_data):
+        """
+        Applies a new stock value with `set_stock`, which records it in the
+        stock ledger and spreads it across the shards of a sharded book.
+        """
+        if 'stock' not in validated_data:
+            return super().update(instance, validated_data)
+        stock = validated_data.pop('stock')
+        instance = super().update(instance, validated_data)
+        set_stock(instance, stock)
+        return instance
+
+
+class CheckoutStudentSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     """
     Serializer for students to view their own checkouts.
 
@@ -71,10 +154,10 @@ class CheckoutStudentSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Checkout
-        fields = ['id', 'book', 'checkout_date', 'return_date']
+        fields = ['id', 'book', 'checkout_date', 'due_date', 'return_date', 'is_overdue']
 
 
-class CheckoutLibrarianSerializer(serializers.ModelSerializer):
+class CheckoutLibrarianSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     """
     Serializer for librarians to view all checkouts.
 
@@ -87,7 +170,7 @@ class CheckoutLibrarianSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Checkout
-        fields = ['id', 'student', 'book', 'checkout_date', 'return_date']
+        fields = ['id', 'student', 'book', 'checkout_date', 'due_date', 'return_date', 'is_overdue']
 
 
 class CreateCheckoutSerializer(serializers.ModelSerializer):
@@ -106,6 +189,126 @@ class CreateCheckoutSerializer(serializers.ModelSerializer):
 
     def validate_book(self, book):
         """Ensures the book is in stock before allowing a checkout."""
-        if book.stock <= 0:
-            raise serializers.ValidationError("This book is out of stock.")
+        if book.current_stock() <= 0:
+            raise serializers.ValidationError("This book is out of stock. Place a hold to get the next returned copy.")
         return book
+
+
+class HoldSerializer(serializers.ModelSerializer):
+    """
+    Serializer for holds placed on out-of-stock books.
+
+    Students create a hold by posting the book's ID. The `position` is the
+    hold's 1-based place in the book's queue (annotated by `HoldViewSet`)
+    and `checkout` is the loan created once the hold is fulfilled.
+    """
+    position = serializers.IntegerField(read_only=True, default=None)
+
+    class Meta:
+        model = Hold
+        fields = ['id', 'book', 'status', 'position', 'created_at', 'fulfilled_at', 'checkout']
+        read_only_fields = ['status', 'created_at', 'fulfilled_at', 'checkout']
+
+
+class RelatedBookSerializer(serializers.ModelSerializer):
+    """
+    Serializer for a "borrowed together" recommendation: the related book
+    and the number of students who borrowed both books (`score`).
+    """
+    related = BookSerializer(read_only=True)
+
+    class Meta:
+        model = RelatedBook
+        fields = ['rank', 'score', 'related']
+
+
+class BookSummarySerializer(serializers.ModelSerializer):
+    """Compact, read-only representation of a book for embedding in other payloads."""
+
+    class Meta:
+        model = Book
+        fields = ['id', 'title', 'author', 'genre']
+        read_only_fields = fields
+
+
+class DashboardCheckoutSerializer(serializers.ModelSerializer):
+    """
+    A loan on the student dashboard. `is_overdue` is computed from the due
+    date when the dashboard is built, not read from the overdue scan.
+    """
+    book = BookSummarySerializer(read_only=True)
+    is_overdue = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Checkout
+        fields = ['id', 'book', 'checkout_date', 'due_date', 'return_date', 'is_overdue']
+
+    def get_is_overdue(self, obj) -> bool:
+        return obj.return_date is None and obj.due_date is not None and obj.due_date < self.context['now']
+
+
+class DashboardHoldSerializer(serializers.ModelSerializer):
+    """A pending hold on the student dashboard, with its position in the queue."""
+    book = BookSummarySerializer(read_only=True)
+    position = serializers.IntegerField(read_only=True, default=None)
+
+    class Meta:
+        model = Hold
+        fields = ['id', 'book', 'position', 'created_at']
+
+
+class DashboardSerializer(serializers.Serializer):
+    """
+    Everything the student app shows after login: the profile, the active
+    loans, the most recent returned loans and the pending holds.
+    """
+    user = UserSerializer(read_only=True)
+    checkouts = DashboardCheckoutSerializer(many=True, read_only=True)
+    history = DashboardCheckoutSerializer(many=True, read_only=True)
+    holds = DashboardHoldSerializer(many=True, read_only=True)
+
+
+class BatchItemSerializer(serializers.Serializer):
+    """One sub-request of a `POST /api/batch/` request."""
+    method = serializers.ChoiceField(choices=['GET', 'POST', 'PUT', 'PATCH', 'DELETE'], default='GET')
+    path = serializers.CharField(help_text='API path, with an optional query string, e.g. `/api/books/1/?fields=id,title`.')
+    body = serializers.JSONField(required=False, help_text='JSON request body.')
+    headers = serializers.DictField(child=serializers.CharField(), required=False, help_text='Extra request headers.')
+
+
+class BatchSerializer(serializers.Serializer):
+    """
+    A batch of API sub-requests. `parallel` runs the sub-requests
+    concurrently, which is only honoured when all of them are GETs.
+    """
+    requests = BatchItemSerializer(many=True, allow_empty=False)
+    parallel = serializers.BooleanField(default=False)
+
+    def validate_requests(self, requests):
+        limit = settings.LIBRARY_BATCH_MAX_REQUESTS
+        if len(requests) > limit:
+            raise serializers.ValidationError(f'A batch can contain at most {limit} requests.')
+        return requests
+
+
+class TaskSerializer(serializers.ModelSerializer):
+    """Read-only view of a background task, its status and its result."""
+
+    class Meta:
+        model = Task
+        fields = ['id', 'name', 'status', 'priority', 'attempts', 'max_attempts', 'run_after', 'result', 'error',
+                  'created_by', 'created_at', 'started_at', 'heartbeat_at', 'finished_at']
+        read_only_fields = fields
+
+
+class EnqueueCommandSerializer(serializers.Serializer):
+    """A management command to run in the background (see `LIBRARY_TASK_COMMANDS`)."""
+    command = serializers.CharField()
+    args = serializers.ListField(child=serializers.CharField(), required=False, default=list,
+                                 help_text='Command-line arguments, e.g. `["--days", "7"]`.')
+    priority = serializers.IntegerField(default=0, min_value=-100, max_value=100)
+
+    def validate_command(self, command):
+        if command not in settings.LIBRARY_TASK_COMMANDS:
+            raise serializers.ValidationError(f'Choose one of: {", ".join(settings.LIBRARY_TASK_COMMANDS)}.')
+        return command
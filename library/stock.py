@@ -0,0 +1,150 @@
+"""
+library/stock.py
+
+This file is part of the University Library project.
+It contains the stock counter operations used by the circulation code. The
+stock of most books is the `Book.stock` column; the stock of heavily
+borrowed titles can be split across `BookStockShard` rows, so concurrent
+checkouts of the same title update different rows instead of queueing for
+the lock on the book's row. Changes of the stock are recorded in the
+`StockMovement` ledger by `record_movement`.
+
+Author: Raul Berrios
+"""
+import random
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+
+from .cache import invalidate_books
+from .models import Book, BookStockShard, StockMovement
+
+
+def take_copy(book):
+    """
+    Takes a copy of `book` out of stock and returns True, or returns False
+    if no copy is left.
+
+    For a sharded book, a random shard is decremented with a conditional
+    UPDATE (`count > 0`) and the other shards are tried, in random order,
+    when it is empty. Unsharded books decrement `Book.stock` the same way
+    (`stock > 0`), so the loser of a race for the last copy gets False.
+    """
+    if book.stock_shards:
+        shards = list(range(book.stock_shards))
+        random.shuffle(shards)
+        for shard in shards:
+            if BookStockShard.objects.filter(book_id=book.pk, shard=shard, count__gt=0).update(count=F('count') - 1):
+                return True
+        # Every shard is empty, or the book was compacted in the meantime.
+        book.refresh_from_db(fields=['stock', 'stock_shards'])
+        if book.stock_shards:
+            return False
+    return Book.objects.filter(pk=book.pk, stock__gt=0).update(stock=F('stock') - 1) == 1
+
+
+def put_copy(book):
+    """Puts a returned copy of `book` back into stock (a random shard, if sharded)."""
+    if book.stock_shards:
+        shard = random.randrange(book.stock_shards)
+        if BookStockShard.objects.filter(book_id=book.pk, shard=shard).update(count=F('count') + 1):
+            return
+    Book.objects.filter(pk=book.pk).update(stock=F('stock') + 1)
+
+
+def lock_shards(books):
+    """
+    Locks the shard rows of the sharded books among `books`, whose own rows
+    the caller locked, and sets their `shard_stock` (see `current_stock`)
+    from the locked rows. Checkouts (`take_copy`) decrement the shards
+    without touching the book's row, so only once both are locked is no
+    checkout or return of these books in flight.
+    """
+    sharded = {book.pk: book for book in books if book.stock_shards}
+    totals = dict.fromkeys(sharded, 0)
+    shards = (
+        BookStockShard.objects.select_for_update().filter(book_id__in=list(sharded))
+        .order_by('book_id', 'shard').values_list('book_id', 'count')
+    )
+    for book_id, count in shards:
+        totals[book_id] += count
+    for book_id, total in totals.items():
+        sharded[book_id].shard_stock = total
+
+
+def lock_stock(book_id):
+    """
+    Locks the stock of a book for the rest of the current transaction (its
+    row and its shards, see `lock_shards`) and returns the book.
+    """
+    book = Book.objects.select_for_update().get(pk=book_id)
+    lock_shards([book])
+    return book
+
+
+def split_stock(book_id, shards=None):
+    """
+    Spreads the stock of a book evenly across `shards` counter rows
+    (`LIBRARY_STOCK_SHARDS` by default), re-splitting it if the book is
+    already sharded. Returns the book.
+    """
+    shards = shards or settings.LIBRARY_STOCK_SHARDS
+    with transaction.atomic():
+        book = lock_stock(book_id)
+        total = book.current_stock()
+        BookStockShard.objects.filter(book=book).delete()
+        BookStockShard.objects.bulk_create(
+            BookStockShard(book=book, shard=shard, count=total // shards + (shard < total % shards))
+            for shard in range(shards)
+        )
+        book.stock, book.stock_shards = 0, shards
+        book.save(update_fields=['stock', 'stock_shards'])
+    return book
+
+
+def compact_stock(book_id):
+    """
+    Folds the shards of a book back into `Book.stock` and deletes them.
+    Returns the book.
+    """
+    with transaction.atomic():
+        book = lock_stock(book_id)
+        book.stock = book.current_stock()
+        book.stock_shards = 0
+        BookStockShard.objects.filter(book=book).delete()
+        book.save(update_fields=['stock', 'stock_shards'])
+    return book
+
+
+def record_movement(book_id, delta, reason, checkout=None):
+    """Appends a change of a book's stock to the ledger."""
+    StockMovement.objects.create(book_id=book_id, delta=delta, reason=reason, checkout=checkout)
+
+
+def overwrite_stock(book_id, stock):
+    """
+    Sets the stock of a book without recording a movement; the caller holds
+    its stock lock (see `lock_stock`). A sharded book stays sharded, with `stock` spread
+    across its shards.
+    """
+    shards = Book.objects.values_list('stock_shards', flat=True).get(pk=book_id)
+    BookStockShard.objects.filter(book_id=book_id).update(count=0)
+    Book.objects.filter(pk=book_id).update(stock=stock)
+    if shards:
+        split_stock(book_id, shards)
+    invalidate_books([book_id])
+
+
+def set_stock(book, stock):
+    """
+    Sets the number of copies of `book` in stock, e.g. when a librarian
+    edits the book, and records the difference as an adjustment.
+    """
+    with transaction.atomic():
+        delta = stock - lock_stock(book.pk).current_stock()
+        if delta:
+            overwrite_stock(book.pk, stock)
+            record_movement(book.pk, delta, StockMovement.ADJUSTMENT)
+    book.refresh_from_db(fields=['stock', 'stock_shards'])
+    book.shard_stock = None  # drop an annotation loaded before the change
@@ -0,0 +1,178 @@
+"""
+library/tasks.py
+
+This file is part of the University Library project.
+It contains the background task queue: a table of tasks (`Task`) which API
+views and management commands enqueue work into and return immediately,
+and which `manage.py run_worker` processes. There is no broker; workers
+claim tasks from the table.
+
+Author: Raul Berrios
+"""
+import io
+import logging
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management import call_command
+from django.db import close_old_connections, connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Task
+from .provisioning import create_prepared_users, provision_users
+
+logger = logging.getLogger(__name__)
+
+# Characters of a command's output kept as the result of its task.
+MAX_OUTPUT = 10000
+
+# Registered task functions, by name (see `task`).
+registry = {}
+
+
+def task(name):
+    """Registers the decorated function as the task `name`."""
+    def register(func):
+        registry[name] = func
+        return func
+    return register
+
+
+def enqueue(name, priority=0, user=None, max_attempts=None, **kwargs):
+    """
+    Queues the task `name`, to be called with `kwargs` (which must be JSON
+    serializable), and returns its `Task`. Inside a transaction, the task
+    is only visible to workers once the transaction commits.
+    """
+    if name not in registry:
+        raise ValueError(f'Unknown task {name!r}.')
+    return Task.objects.create(
+        name=name, kwargs=kwargs, priority=priority, created_by=user,
+        max_attempts=max_attempts or settings.LIBRARY_TASK_MAX_ATTEMPTS,
+    )
+
+
+def claim(worker):
+    """
+    Marks the next due task as running for `worker` and returns its ID, or
+    None when no task is due. `skip_locked` lets workers claim different
+    tasks concurrently on PostgreSQL; SQLite serializes the claims.
+    """
+    with transaction.atomic():
+        task_id = (
+            Task.objects.select_for_update(skip_locked=True)
+            .filter(status=Task.QUEUED, run_after__lte=timezone.now())
+            .order_by('-priority', 'run_after', 'id')
+            .values_list('pk', flat=True)
+            .first()
+        )
+        if task_id is None:
+            return None
+        now = timezone.now()
+        Task.objects.filter(pk=task_id).update(
+            status=Task.RUNNING, worker=worker, started_at=now, heartbeat_at=now, attempts=F('attempts') + 1,
+        )
+    return task_id
+
+
+def heartbeat(worker):
+    """Refreshes the heartbeat of the tasks `worker` is running (see `requeue_stale`)."""
+    return Task.objects.filter(status=Task.RUNNING, worker=worker).update(heartbeat_at=timezone.now())
+
+
+def execute(task_id):
+    """
+    Runs a claimed task and records its result, or its error and whether
+    it will be retried. Runs in a worker thread or process, and closes its
+    database connections when done.
+    """
+    close_old_connections()
+    try:
+        task = Task.objects.get(pk=task_id)
+        try:
+            result = registry[task.name](**task.kwargs)
+        except Exception:
+            logger.exception('Task %s failed', task)
+            fail(task, traceback.format_exc())
+        else:
+            finish(task, Task.SUCCEEDED, result=result)
+        return task_id
+    finally:
+        connections.close_all()
+
+
+def attempt(task):
+    """
+    Returns the task's row as long as it is still running this attempt, so
+    that an attempt given up for lost (see `requeue_stale`) and run again
+    cannot overwrite the outcome of the next one.
+    """
+    return Task.objects.filter(pk=task.pk, status=Task.RUNNING, attempts=task.attempts)
+
+
+def finish(task, status, **fields):
+    """Records the end of a task; its arguments are dropped, as they may be sensitive."""
+    attempt(task).update(status=status, kwargs={}, finished_at=timezone.now(), **fields)
+
+
+def fail(task, error):
+    """Queues a failed task again after a backoff, or marks it failed after its last attempt."""
+    if task.attempts < task.max_attempts:
+        delay = settings.LIBRARY_TASK_RETRY_SECONDS * 2 ** (task.attempts - 1)
+        attempt(task).update(
+            status=Task.QUEUED, error=error, run_after=timezone.now() + timedelta(seconds=delay),
+        )
+    else:
+        finish(task, Task.FAILED, error=error)
+
+
+def requeue_stale():
+    """
+    Hands the running tasks whose worker died (no heartbeat for
+    `LIBRARY_TASK_STALE_SECONDS`) back to the queue, or fails them after
+    their last attempt. Returns the number of tasks recovered. Tasks which
+    merely run long keep their heartbeat and are left alone.
+    """
+    cutoff = timezone.now() - timedelta(seconds=settings.LIBRARY_TASK_STALE_SECONDS)
+    stale = Task.objects.filter(status=Task.RUNNING, heartbeat_at__lt=cutoff)
+    error = 'The worker running this task stopped.'
+    failed = stale.filter(attempts__gte=F('max_attempts')).update(
+        status=Task.FAILED, error=error, kwargs={}, finished_at=timezone.now(),
+    )
+    return failed + stale.update(status=Task.QUEUED, error=error, run_after=timezone.now())
+
+
+def prune_finished():
+    """Deletes the tasks which finished more than `LIBRARY_TASK_RETENTION_DAYS` ago."""
+    cutoff = timezone.now() - timedelta(days=settings.LIBRARY_TASK_RETENTION_DAYS)
+    return Task.objects.filter(status__in=[Task.SUCCEEDED, Task.FAILED], finished_at__lt=cutoff).delete()[0]
+
+
+@task('command')
+def run_command(command, args=()):
+    """
+    Runs one of the management commands of `LIBRARY_TASK_COMMANDS` and
+    returns the end of its output.
+    """
+    if command not in settings.LIBRARY_TASK_COMMANDS:
+        raise ValueError(f'The command {command!r} cannot be run as a task.')
+    output = io.StringIO()
+    call_command(command, *args, stdout=output, stderr=output)
+    return {'output': output.getvalue()[-MAX_OUTPUT:]}
+
+
+@task('provision_users')
+def run_provision_users(rows=None, results=None, users=None):
+    """
+    Creates users in bulk, like `POST /api/users/bulk/` (see
+    `library.provisioning`), from `rows` or, when queued, from the `results`
+    and `users` of `prepare_users`, whose passwords are already hashed.
+    """
+    if rows is not None:
+        results = provision_users(rows)
+    else:
+        results = create_prepared_users(results, users)
+    created = sum(result['status'] == 'created' for result in results)
+    return {'created': created, 'failed': len(results) - created, 'results': results}
@@ -7,10 +7,44 @@ book management, and checkout processes using Django REST Framework's APITestCas
 
 Author: Raul Berrios
 """
+import io
+import json
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+
+from django.conf import settings
+from django.contrib.auth.hashers import check_password
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import LiveServerTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 from rest_framework import status
-from rest_framework.test import APITestCase
-from .models import User, Book, Checkout
+from rest_framework.exceptions import ParseError, ValidationError
+from rest_framework.renderers import JSONRenderer
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APITestCase, APITransactionTestCase
+from . import autocomplete
+from .circulation import checkout_book, return_checkouts
+from .events import Cursor, read_events, stream_events
+from .models import User, Book, BookStockShard, Checkout, CirculationDaily, Hold, IdempotencyKey, OutboxEvent, OverdueNotice, RelatedBook, StockMovement, Task
+from .renderers import FastJSONParser, FastJSONRenderer
+from .hashing import hash_passwords
+from .recommendations import cooccurrence_python, cooccurrence_vectorized, vectorized_available
+from .cache import invalidate_dashboards
+from .serializers import DashboardSerializer
+from .budget import BudgetExceeded, RequestBudget, current_budget
+from .schema import schema_cache
+from .tasks import claim, enqueue, finish, heartbeat, requeue_stale
+from .stock import split_stock
 
 class LibraryAPITests(APITestCase):
     """
@@ -182,4 +216,1629 @@ class LibraryAPITests(APITestCase):
         self.client.force_authenticate(user=self.student_user)
         url = reverse('checkout-return-book', kwargs={'pk': checkout.id})
         response = self.client.post(url)
-        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
\ No newline at end of file
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+class FastJSONTests(APITestCase):
+    """
+    Tests for the orjson-backed renderer and parser.
+    """
+
+    def test_renderer_matches_stdlib_output(self):
+        """
+        Ensure the fast renderer produces the same document as DRF's JSONRenderer.
+        """
+        data = {
+            'price': Decimal('12.50'),
+            'when': datetime(2025, 1, 2, 3, 4, 5, tzinfo=dt_timezone.utc),
+            'title': 'Café  ',
+            'items': [1, 2.5, None, True],
+        }
+        fast = FastJSONRenderer().render(data)
+        self.assertEqual(json.loads(fast), json.loads(JSONRenderer().render(data)))
+        self.assertIn(b'\\u2028', fast)
+
+    def test_parser_round_trip(self):
+        """
+        Ensure the fast parser reads what the renderer writes and rejects malformed JSON.
+        """
+        body = FastJSONRenderer().render({'book': 1, 'title': 'Dune'})
+        self.assertEqual(FastJSONParser().parse(io.BytesIO(body)), {'book': 1, 'title': 'Dune'})
+        with self.assertRaises(ParseError):
+            FastJSONParser().parse(io.BytesIO(b'{"book": '))
+
+    def test_browsable_api_still_renders(self):
+        """
+        Ensure the browsable API keeps working with the fast renderer as default.
+        """
+        user = User.objects.create_user(username='reader', password='password123')
+        self.client.force_authenticate(user=user)
+        response = self.client.get(reverse('book-list'), HTTP_ACCEPT='text/html')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('text/html', response['Content-Type'])
+
+
+class SparseFieldsetTests(APITestCase):
+    """
+    Tests for the `?fields=` and `?expand=` query parameters.
+    """
+
+    def setUp(self):
+        self.librarian = User.objects.create_user(username='librarian', password='password123', role='librarian')
+        self.student = User.objects.create_user(username='student', password='password123', role='student')
+        self.books = [
+            Book.objects.create(title=f'Book {i}', author='Author', published_year=2000, genre='Test', stock=5)
+            for i in range(5)
+        ]
+        for book in self.books:
+            Checkout.objects.create(student=self.student, book=book)
+
+    def test_book_list_prunes_fields(self):
+        """
+        Ensure only the requested book fields are returned.
+        """
+        self.client.force_authenticate(user=self.student)
+        response = self.client.get(reverse('book-list'), {'fields': 'id,title'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(set(response.data['results'][0]), {'id', 'title'})
+
+    def test_book_list_counts_in_a_single_query(self):
+        """
+        Ensure the checkout counts are annotated instead of queried per book.
+        """
+        self.client.force_authenticate(user=self.student)
+        with self.assertNumQueries(2):  # COUNT for pagination + the page itself
+            response = self.client.get(reverse('book-list'))
+        self.assertEqual(response.data['results'][0]['checked_out_count'], 1)
+        self.assertEqual(response.data['results'][0]['available'], 4)
+
+    def test_checkout_nested_fields_and_expand(self):
+        """
+        Ensure nested fields can be pruned and unexpanded relations collapse to their ID.
+        """
+        self.client.force_authenticate(user=self.librarian)
+        response = self.client.get(reverse('checkout-list'), {'fields': 'id,book.title,student', 'expand': 'book'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        checkout = response.data['results'][0]
+        self.assertEqual(set(checkout), {'id', 'book', 'student'})
+        self.assertEqual(set(checkout['book']), {'title'})
+        self.assertEqual(checkout['student'], self.student.id)
+
+    def test_checkout_list_query_count_is_constant(self):
+        """
+        Ensure the librarian checkout list does not run queries per row.
+        """
+        self.client.force_authenticate(user=self.librarian)
+        with self.assertNumQueries(3):  # COUNT, checkouts joined with students, prefetched books
+            self.client.get(reverse('checkout-list'))
+        with self.assertNumQueries(2):  # COUNT, checkouts only
+            self.client.get(reverse('checkout-list'), {'expand': ''})
+
+
+class CachedSchemaTests(APITestCase):
+    """
+    Tests for the precomputed OpenAPI schema served at /api/schema/.
+    """
+
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.artifact = os.path.join(tmpdir, 'openapi.json')
+        override = self.settings(LIBRARY_SCHEMA_ARTIFACT=self.artifact)
+        override.enable()
+        self.addCleanup(override.disable)
+        schema_cache.clear()
+        self.addCleanup(schema_cache.clear)
+
+    def test_schema_is_served_from_artifact_with_etag(self):
+        """
+        Ensure the schema is read from the artifact and revalidates with a 304.
+        """
+        call_command('build_schema', stdout=io.StringIO())
+        self.assertTrue(os.path.exists(self.artifact))
+
+        response = self.client.get(reverse('schema'), HTTP_ACCEPT='application/vnd.oai.openapi+json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('/api/books/', json.loads(response.content)['paths'])
+        etag = response['ETag']
+
+        response = self.client.get(reverse('schema'), HTTP_ACCEPT='application/vnd.oai.openapi+json', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_new_artifact_invalidates_cached_schema(self):
+        """
+        Ensure writing a new artifact (e.g. on deploy) changes the served schema.
+        """
+        with open(self.artifact, 'w') as artifact:
+            json.dump({'openapi': '3.0.3', 'paths': {}}, artifact)
+        first = self.client.get(reverse('schema'), HTTP_ACCEPT='application/vnd.oai.openapi+json')
+        self.assertEqual(json.loads(first.content)['paths'], {})
+
+        call_command('build_schema', stdout=io.StringIO())
+        second = self.client.get(reverse('schema'), HTTP_ACCEPT='application/vnd.oai.openapi+json')
+        self.assertNotEqual(first['ETag'], second['ETag'])
+        self.assertIn('/api/books/', json.loads(second.content)['paths'])
+
+
+class OverdueTests(APITestCase):
+    """
+    Tests for due dates, the `scan_overdue` job and the overdue loan listing.
+    """
+
+    def setUp(self):
+        self.librarian = User.objects.create_user(username='librarian', password='password123', role='librarian')
+        self.student = User.objects.create_user(username='student', password='password123', role='student')
+        self.book = Book.objects.create(title='Dune', author='Frank Herbert', published_year=1965, genre='Science Fiction', stock=5)
+        self.other_book = Book.objects.create(title='Emma', author='Jane Austen', published_year=1815, genre='Romance', stock=5)
+
+    def test_due_date_uses_role_loan_period(self):
+        """
+        Ensure new checkouts get a due date from the borrower's role.
+        """
+        checkout = Checkout.objects.create(student=self.student, book=self.book)
+        expected = checkout.checkout_date + timedelta(days=settings.LIBRARY_LOAN_PERIODS['student'])
+        self.assertAlmostEqual(checkout.due_date, expected, delta=timedelta(seconds=5))
+
+    def test_scan_overdue_is_incremental(self):
+        """
+        Ensure the scan flags overdue loans once and only picks up new ones on later runs.
+        """
+        overdue = Checkout.objects.create(student=self.student, book=self.book, due_date=timezone.now() - timedelta(days=1))
+        on_time = Checkout.objects.create(student=self.student, book=self.other_book)
+
+        call_command('scan_overdue', stdout=io.StringIO())
+        overdue.refresh_from_db()
+        self.assertTrue(overdue.is_overdue)
+        self.assertEqual(OverdueNotice.objects.count(), 1)
+
+        # The loan now becomes overdue; only it is processed on the next run.
+        Checkout.objects.filter(pk=on_time.pk).update(due_date=timezone.now())
+        out = io.StringIO()
+        call_command('scan_overdue', stdout=out)
+        self.assertIn('Flagged 1 ', out.getvalue())
+        self.assertEqual(OverdueNotice.objects.count(), 2)
+
+    def test_librarian_lists_overdue_loans(self):
+        """
+        Ensure librarians get overdue loans with cursor pagination and students are refused.
+        """
+        Checkout.objects.create(student=self.student, book=self.book, due_date=timezone.now() - timedelta(days=2))
+        Checkout.objects.create(student=self.student, book=self.other_book)
+
+        self.client.force_authenticate(user=self.librarian)
+        response = self.client.get(reverse('checkout-overdue'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([c['book']['title'] for c in response.data['results']], ['Dune'])
+        self.assertIn('next', response.data)
+        self.assertNotIn('count', response.data)
+
+        self.client.force_authenticate(user=self.student)
+        self.assertEqual(self.client.get(reverse('checkout-overdue')).status_code, status.HTTP_403_FORBIDDEN)
+
+
+class HoldTests(APITestCase):
+    """
+    Tests for hold queues and the allocation of returned copies.
+    """
+
+    def setUp(self):
+        self.librarian = User.objects.create_user(username='librarian', password='password123', role='librarian')
+        self.reader = User.objects.create_user(username='reader', password='password123', role='student')
+        self.first = User.objects.create_user(username='first', password='password123', role='student')
+        self.second = User.objects.create_user(username='second', password='password123', role='student')
+        self.book = Book.objects.create(title='Dune', author='Frank Herbert', published_year=1965, genre='Science Fiction', stock=0)
+        self.loan = Checkout.objects.create(student=self.reader, book=self.book)
+
+    def place_hold(self, student):
+        self.client.force_authenticate(user=student)
+        return self.client.post(reverse('hold-list'), {'book': self.book.id}, format='json')
+
+    def test_holds_queue_in_order(self):
+        """
+        Ensure holds are created with their queue positions and duplicates are refused.
+        """
+        self.assertEqual(self.place_hold(self.first).status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.place_hold(self.second).status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.place_hold(self.second).status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.get(reverse('hold-list'))
+        self.assertEqual(response.data['results'][0]['position'], 2)
+
+    def test_hold_refused_when_book_in_stock(self):
+        """
+        Ensure a hold cannot be placed on a book that can be checked out.
+        """
+        Book.objects.filter(pk=self.book.pk).update(stock=1)
+        self.assertEqual(self.place_hold(self.first).status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_return_allocates_copy_to_first_hold(self):
+        """
+        Ensure a returned copy is lent to the oldest hold instead of going back to stock.
+        """
+        self.place_hold(self.first)
+        self.place_hold(self.second)
+
+        self.client.force_authenticate(user=self.librarian)
+        response = self.client.post(reverse('checkout-return-book', kwargs={'pk': self.loan.id}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.stock, 0)
+        self.assertTrue(Checkout.objects.filter(student=self.first, book=self.book, return_date__isnull=True).exists())
+        hold = Hold.objects.get(student=self.first)
+        self.assertEqual(hold.status, Hold.FULFILLED)
+        self.assertEqual(response.data['allocated_hold'], hold.id)
+        self.assertEqual(Hold.objects.get(student=self.second).status, Hold.PENDING)
+
+    def test_admin_bulk_return_allocates_and_restocks(self):
+        """
+        Ensure the bulk return path allocates to holds and restocks once the queue is empty.
+        """
+        other_loan = Checkout.objects.create(student=self.second, book=self.book)
+        self.place_hold(self.first)
+
+        self.assertEqual(return_checkouts(Checkout.objects.filter(pk__in=[self.loan.pk, other_loan.pk])), 2)
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.stock, 1)
+        self.assertEqual(Hold.objects.get(student=self.first).status, Hold.FULFILLED)
+
+    def test_student_can_cancel_hold(self):
+        """
+        Ensure a student can cancel a pending hold.
+        """
+        hold_id = self.place_hold(self.first).data['id']
+        response = self.client.delete(reverse('hold-detail', kwargs={'pk': hold_id}))
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(Hold.objects.get(pk=hold_id).status, Hold.CANCELLED)
+
+
+class CirculationReportTests(APITestCase):
+    """
+    Tests for the circulation rollups and the librarian reports.
+    """
+
+    def setUp(self):
+        self.librarian = User.objects.create_user(username='librarian', password='password123', role='librarian')
+        self.students = [User.objects.create_user(username=f'student{i}', password='password123', role='student') for i in range(3)]
+        self.dune = Book.objects.create(title='Dune', author='Frank Herbert', published_year=1965, genre='Science Fiction', stock=5)
+        self.emma = Book.objects.create(title='Emma', author='Jane Austen', published_year=1815, genre='Romance', stock=5)
+        for student in self.students:
+            self.client.force_authenticate(user=student)
+            self.client.post(reverse('checkout-list'), {'book': self.dune.id}, format='json')
+        self.client.force_authenticate(user=self.students[0])
+        self.client.post(reverse('checkout-list'), {'book': self.emma.id}, format='json')
+        self.client.force_authenticate(user=self.librarian)
+        self.client.post(reverse('checkout-return-book', kwargs={'pk': Checkout.objects.filter(book=self.emma).get().pk}))
+
+    def test_rollups_are_updated_incrementally(self):
+        """
+        Ensure checkouts and returns are counted in today's rollup rows.
+        """
+        today = timezone.localdate()
+        self.assertEqual(CirculationDaily.objects.get(date=today, book=self.dune).checkouts, 3)
+        emma = CirculationDaily.objects.get(date=today, book=self.emma)
+        self.assertEqual((emma.checkouts, emma.returns), (1, 1))
+
+    def test_reports(self):
+        """
+        Ensure the reports are served from the rollups.
+        """
+        response = self.client.get(reverse('report-most-borrowed'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([row['title'] for row in response.data], ['Dune', 'Emma'])
+
+        response = self.client.get(reverse('report-genres'))
+        self.assertEqual({row['genre']: row['checkouts'] for row in response.data}, {'Science Fiction': 3, 'Romance': 1})
+
+        response = self.client.get(reverse('report-utilization'), {'start': 'not-a-date'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_rebuild_matches_incremental_rollups(self):
+        """
+        Ensure a from-scratch rebuild produces the same rows as the inline updates.
+        """
+        fields = ('date', 'book_id', 'genre', 'checkouts', 'returns')
+        before = sorted(CirculationDaily.objects.values_list(*fields))
+        CirculationDaily.objects.all().delete()
+        call_command('rollup_circulation', '--rebuild', stdout=io.StringIO())
+        self.assertEqual(sorted(CirculationDaily.objects.values_list(*fields)), before)
+
+    def test_students_cannot_read_reports(self):
+        """
+        Ensure reports are restricted to librarians.
+        """
+        self.client.force_authenticate(user=self.students[0])
+        self.assertEqual(self.client.get(reverse('report-most-borrowed')).status_code, status.HTTP_403_FORBIDDEN)
+
+
+class RelatedBooksTests(APITestCase):
+    """
+    Tests for the precomputed "borrowed together" recommendations.
+    """
+
+    def setUp(self):
+        self.students = [User.objects.create_user(username=f'student{i}', password='password123', role='student') for i in range(3)]
+        self.books = [
+            Book.objects.create(title=title, author='Author', published_year=2000, genre='Fiction', stock=5)
+            for title in ('Dune', 'Emma', 'Ulysses', 'Beloved')
+        ]
+        dune, emma, ulysses, _ = self.books
+        for student, titles in zip(self.students, [(dune, emma, ulysses), (dune, emma), (dune, ulysses)]):
+            for book in titles:
+                Checkout.objects.create(student=student, book=book)
+
+    def test_command_and_endpoint(self):
+        """
+        Ensure related books are ranked by the number of shared borrowers.
+        """
+        dune, emma, ulysses, beloved = self.books
+        call_command('build_related', stdout=io.StringIO())
+        self.client.force_authenticate(user=self.students[0])
+
+        response = self.client.get(reverse('book-related', kwargs={'pk': dune.id}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([(row['related']['title'], row['score']) for row in response.data], [('Emma', 2), ('Ulysses', 2)])
+        self.assertEqual(response.data[0]['related']['checked_out_count'], 2)
+
+        response = self.client.get(reverse('book-related', kwargs={'pk': beloved.id}))
+        self.assertEqual(response.data, [])
+
+    def test_incremental_rebuild(self):
+        """
+        Ensure an incremental run recomputes the books borrowed by recent borrowers from their borrowers' loans only.
+        """
+        dune, emma, ulysses, beloved = self.books
+        reader = User.objects.create_user(username='reader', password='password123', role='student')
+        Checkout.objects.create(student=reader, book=Book.objects.create(title='Walden', author='Author', published_year=2000, genre='Fiction', stock=5))
+        call_command('build_related', stdout=io.StringIO())
+        Checkout.objects.create(student=self.students[1], book=beloved)
+        out = io.StringIO()
+        call_command('build_related', '--incremental', stdout=out)
+        self.assertIn('for 3 affected book(s) from 8 borrow pair(s)', out.getvalue())
+        self.assertEqual(
+            list(RelatedBook.objects.filter(book=beloved).values_list('related__title', flat=True)),
+            ['Dune', 'Emma'],
+        )
+        self.assertIn(beloved.id, RelatedBook.objects.filter(book=emma).values_list('related_id', flat=True))
+
+    def test_vectorized_matches_python(self):
+        """
+        Ensure the sparse matrix implementation agrees with the fallback.
+        """
+        if not vectorized_available():
+            self.skipTest('NumPy and SciPy are not installed')
+        pairs = [(student, book) for student in range(40) for book in range(30) if (student * book) % 7 < 3]
+        for books in (None, {1, 5, 29}):
+            self.assertEqual(cooccurrence_vectorized(pairs, 5, books), cooccurrence_python(pairs, 5, books))
+
+
+class EventStreamTests(APITransactionTestCase):
+    """
+    Tests for the event outbox and the Server-Sent Events stream.
+    """
+
+    def setUp(self):
+        self.librarian = User.objects.create_user(username='librarian', password='password123', role='librarian')
+        self.student = User.objects.create_user(username='student', password='password123', role='student')
+        self.other = User.objects.create_user(username='other', password='password123', role='student')
+        self.book = Book.objects.create(title='Dune', author='Frank Herbert', published_year=1965, genre='Science Fiction', stock=1)
+
+    def read_stream(self, user, last_id, count):
+        """Returns the first `count` messages the stream sends to `user`."""
+        async def read():
+            messages = []
+            stream = stream_events(user, Cursor(last_id), poll_seconds=0.05)
+            async for message in stream:
+                messages.append(message)
+                if len(messages) == count:
+                    break
+            await stream.aclose()
+            return messages
+        return async_to_sync(read)()
+
+    def test_circulation_writes_outbox_events(self):
+        """
+        Ensure checkouts and returns record their changes in the outbox.
+        """
+        self.client.force_authenticate(user=self.student)
+        response = self.client.post(reverse('checkout-list'), {'book': self.book.id}, format='json')
+        self.client.force_authenticate(user=self.librarian)
+        self.client.post(reverse('checkout-return-book', kwargs={'pk': response.data['id']}))
+
+        events = list(OutboxEvent.objects.order_by('pk').values_list('kind', 'payload'))
+        self.assertEqual([kind for kind, _ in events], [
+            OutboxEvent.CHECKOUT_CREATED, OutboxEvent.BOOK_AVAILABILITY,
+            OutboxEvent.CHECKOUT_RETURNED, OutboxEvent.BOOK_AVAILABILITY,
+        ])
+        self.assertEqual(events[1][1], {'book': self.book.id, 'stock': 0})
+        self.assertEqual(events[3][1], {'book': self.book.id, 'stock': 1})
+
+    def test_stream_resumes_after_last_event_id(self):
+        """
+        Ensure the stream replays missed events and hides other students' loans.
+        """
+        self.client.force_authenticate(user=self.student)
+        self.client.post(reverse('checkout-list'), {'book': self.book.id}, format='json')
+        first = OutboxEvent.objects.order_by('pk').first()
+
+        messages = self.read_stream(self.student, first.pk - 1, 3)
+        self.assertTrue(messages[0].startswith('retry:'))
+        self.assertIn(f'id: {first.pk}\nevent: checkout.created\n', messages[1])
+        self.assertIn('event: book.availability', messages[2])
+
+        messages = self.read_stream(self.other, first.pk - 1, 3)
+        self.assertIn('event: book.availability', messages[1])
+        self.assertEqual(messages[2], ': keep-alive\n\n')
+
+    def test_late_commits_fill_gaps(self):
+        """
+        Ensure an event committed long after the events following it is still sent.
+        """
+        events = [OutboxEvent.objects.create(kind=OutboxEvent.BOOK_AVAILABILITY, payload={'book': i}) for i in range(3)]
+        late = events[1]
+        OutboxEvent.objects.filter(pk=late.pk).delete()  # not committed yet
+        cursor = Cursor(events[0].pk - 1)
+        sent, _, settle = read_events(self.student, cursor)
+        self.assertEqual([event.pk for event, _ in sent], [events[0].pk])
+        self.assertGreater(settle, 0)
+
+        OutboxEvent.objects.filter(pk=events[2].pk).update(created_at=timezone.now() - timedelta(minutes=1))
+        sent, _, settle = read_events(self.student, cursor)
+        self.assertEqual(sent[0][1], f'{events[2].pk}:{late.pk}')
+        self.assertIsNone(settle)
+
+        resumed = Cursor.parse(sent[0][1])
+        OutboxEvent.objects.create(pk=late.pk, kind=late.kind, payload=late.payload)
+        for cursor in (cursor, resumed):
+            sent, _, _ = read_events(self.student, cursor)
+            self.assertEqual([(event.pk, event_id) for event, event_id in sent], [(late.pk, str(events[2].pk))])
+
+    def test_stream_authentication(self):
+        """
+        Ensure the stream accepts the API token header or a short-lived ticket, not the token in the URL.
+        """
+        response = self.client.get(reverse('event-stream'))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        token = Token.objects.create(user=self.student)
+        response = self.client.get(reverse('event-stream'), {'token': token.key})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        self.client.force_authenticate(user=self.student)
+        ticket = self.client.post(reverse('event-ticket')).data['ticket']
+        self.client.force_authenticate(user=None)
+        response = self.client.get(reverse('event-stream'), {'ticket': ticket})
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        response.close()
+        with self.settings(LIBRARY_EVENT_TICKET_SECONDS=-1):
+            response = self.client.get(reverse('event-stream'), {'ticket': ticket})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class DashboardTests(APITestCase):
+    """
+    Tests for the cached student dashboard.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.student = User.objects.create_user(username='student', password='password123', role='student')
+        self.other = User.objects.create_user(username='other', password='password123', role='student')
+        self.librarian = User.objects.create_user(username='librarian', password='password123', role='librarian')
+        self.dune = Book.objects.create(title='Dune', author='Frank Herbert', published_year=1965, genre='Science Fiction', stock=1)
+        self.emma = Book.objects.create(title='Emma', author='Jane Austen', published_year=1815, genre='Romance', stock=5)
+        self.overdue = Checkout.objects.create(student=self.student, book=self.emma)
+        Checkout.objects.filter(pk=self.overdue.pk).update(due_date=timezone.now() - timedelta(days=1))
+        Checkout.objects.create(student=self.other, book=self.dune)
+        Book.objects.filter(pk=self.dune.pk).update(stock=0)
+
+    def test_dashboard_contents(self):
+        """
+        Ensure the dashboard combines profile, loans, history and holds in three queries.
+        """
+        Hold.objects.create(student=self.other, book=self.dune)
+        Hold.objects.create(student=self.student, book=self.dune)
+        self.client.force_authenticate(user=self.student)
+
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('dashboard'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['user']['username'], 'student')
+        self.assertEqual([(c['book']['title'], c['is_overdue']) for c in response.data['checkouts']], [('Emma', True)])
+        self.assertEqual(response.data['history'], [])
+        self.assertEqual([(h['book']['title'], h['position']) for h in response.data['holds']], [('Dune', 2)])
+
+        with self.assertNumQueries(0):
+            self.client.get(reverse('dashboard'))
+
+    def test_dashboard_is_invalidated_by_circulation(self):
+        """
+        Ensure returns and hold queue changes refresh the affected dashboards.
+        """
+        hold = Hold.objects.create(student=self.student, book=self.dune)
+        self.client.force_authenticate(user=self.student)
+        self.assertEqual(self.client.get(reverse('dashboard')).data['holds'][0]['position'], 1)
+
+        self.client.force_authenticate(user=self.librarian)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('checkout-return-book', kwargs={'pk': self.overdue.pk}))
+            self.client.post(reverse('checkout-return-book', kwargs={'pk': Checkout.objects.get(student=self.other).pk}))
+
+        self.client.force_authenticate(user=self.student)
+        response = self.client.get(reverse('dashboard'))
+        self.assertEqual(response.data['holds'], [])
+        self.assertEqual([c['book']['title'] for c in response.data['checkouts']], ['Dune'])
+        self.assertEqual([c['book']['title'] for c in response.data['history']], ['Emma'])
+        hold.refresh_from_db()
+        self.assertEqual(hold.status, Hold.FULFILLED)
+
+    def test_invalidation_during_a_rebuild(self):
+        """
+        Ensure a dashboard built before an invalidation committed is not served afterwards.
+        """
+        test = self
+
+        class RacingSerializer(DashboardSerializer):
+            @property
+            def data(self):
+                data = super().data
+                with test.captureOnCommitCallbacks(execute=True):
+                    invalidate_dashboards([self.instance['user'].pk])  # e.g. a return committed meanwhile
+                return data
+
+        self.client.force_authenticate(user=self.student)
+        with mock.patch('library.views.DashboardSerializer', RacingSerializer):
+            self.client.get(reverse('dashboard'))
+        with self.assertNumQueries(3):
+            self.client.get(reverse('dashboard'))
+
+
+class BulkUserTests(APITestCase):
+    """
+    Tests for bulk user provisioning.
+    """
+
+    def setUp(self):
+        self.librarian = User.objects.create_user(username='librarian', password='password123', role='librarian')
+        self.client.force_authenticate(user=self.librarian)
+
+    def test_bulk_create_reports_each_row(self):
+        """
+        Ensure valid rows are created and invalid or duplicate rows are reported.
+        """
+        rows = [
+            {'username': 'alice', 'password': 'secret-1', 'email': 'alice@example.com'},
+            {'username': 'librarian', 'password': 'secret-2'},
+            {'username': 'alice', 'password': 'secret-3'},
+            {'username': 'bob', 'password': 'secret-4', 'role': 'wizard'},
+            {'username': 'carol', 'password': 'secret-5', 'role': 'librarian'},
+        ]
+        response = self.client.post(reverse('user-bulk'), rows, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual((response.data['created'], response.data['failed']), (2, 3))
+        self.assertEqual([r['status'] for r in response.data['results']], ['created', 'error', 'error', 'error', 'created'])
+        self.assertIn('role', response.data['results'][3]['errors'])
+
+        carol = User.objects.get(username='carol')
+        self.assertEqual(carol.role, 'librarian')
+        self.assertTrue(carol.check_password('secret-5'))
+
+    def test_bulk_create_requires_a_list(self):
+        """
+        Ensure the endpoint rejects non-list bodies and oversized batches.
+        """
+        response = self.client.post(reverse('user-bulk'), {'username': 'alice'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        with override_settings(LIBRARY_BULK_USERS_MAX=1):
+            response = self.client.post(reverse('user-bulk'), [{}, {}], format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @override_settings(LIBRARY_HASH_PARALLEL_THRESHOLD=2)
+    def test_process_pool_hashing(self):
+        """
+        Ensure passwords hashed by the process pool are returned in order.
+        """
+        hashes = hash_passwords(['first', 'second', 'third'], workers=2)
+        self.assertEqual([check_password(p, h) for p, h in zip(['first', 'second', 'third'], hashes)], [True] * 3)
+
+    def test_import_users_command(self):
+        """
+        Ensure users can be imported from a CSV file.
+        """
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as source:
+            source.write('username,password,first_name\ndave,secret-6,Dave\nlibrarian,secret-7,\n')
+        self.addCleanup(os.remove, source.name)
+        stdout, stderr = io.StringIO(), io.StringIO()
+        call_command('import_users', source.name, stdout=stdout, stderr=stderr)
+        self.assertIn('Created 1 user(s), 1 row(s) failed.', stdout.getvalue())
+        self.assertIn('Row 2 (librarian)', stderr.getvalue())
+        self.assertEqual(User.objects.get(username='dave').first_name, 'Dave')
+
+
+class ShardedStockTests(APITestCase):
+    """
+    Tests for sharded stock counters.
+    """
+
+    def setUp(self):
+        self.librarian = User.objects.create_user(username='librarian', password='password123', role='librarian')
+        self.students = [User.objects.create_user(username=f'student{i}', password='password123', role='student') for i in range(4)]
+        self.book = Book.objects.create(title='Dune', author='Frank Herbert', published_year=1965, genre='Science Fiction', stock=3)
+        split_stock(self.book.pk, 4)
+
+    def checkout(self, student):
+        self.client.force_authenticate(user=student)
+        return self.client.post(reverse('checkout-list'), {'book': self.book.id}, format='json')
+
+    def test_checkouts_fall_back_to_other_shards(self):
+        """
+        Ensure every copy can be checked out even though one shard starts empty.
+        """
+        self.book.refresh_from_db()
+        self.assertEqual((self.book.stock, self.book.stock_shards), (0, 4))
+        self.assertEqual(sorted(BookStockShard.objects.values_list('count', flat=True)), [0, 1, 1, 1])
+
+        for student in self.students[:3]:
+            self.assertEqual(self.checkout(student).status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.checkout(self.students[3]).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Book.objects.get(pk=self.book.pk).current_stock(), 0)
+
+    def test_reads_sum_the_shards(self):
+        """
+        Ensure the API reports the total stock and librarians can still edit it.
+        """
+        self.checkout(self.students[0])
+        response = self.client.get(reverse('book-detail', kwargs={'pk': self.book.id}))
+        self.assertEqual((response.data['stock'], response.data['available']), (2, 1))
+
+        self.client.force_authenticate(user=self.librarian)
+        response = self.client.patch(reverse('book-detail', kwargs={'pk': self.book.id}), {'stock': 10}, format='json')
+        self.assertEqual(response.data['stock'], 10)
+        self.assertEqual(sum(BookStockShard.objects.values_list('count', flat=True)), 10)
+
+    def test_return_and_compaction(self):
+        """
+        Ensure returns refill a shard and compaction folds the shards back.
+        """
+        checkout_id = self.checkout(self.students[0]).data['id']
+        self.client.force_authenticate(user=self.librarian)
+        self.client.post(reverse('checkout-return-book', kwargs={'pk': checkout_id}))
+        self.assertEqual(Book.objects.get(pk=self.book.pk).current_stock(), 3)
+
+        call_command('compact_stock', stdout=io.StringIO())
+        self.book.refresh_from_db()
+        self.assertEqual((self.book.stock, self.book.stock_shards), (3, 0))
+        self.assertFalse(BookStockShard.objects.exists())
+
+    def test_last_copy_taken_concurrently(self):
+        """
+        Ensure losing the race for the last copy of an unsharded book reports it out of stock.
+        """
+        book = Book.objects.create(title='Emma', author='Jane Austen', published_year=1815, genre='Classic', stock=1)
+        checkout_book(self.students[0], book)
+        with self.assertRaises(ValidationError) as raised:
+            checkout_book(self.students[1], book)  # read with one copy left
+        self.assertIn('out of stock', str(raised.exception.detail['book']))
+        self.assertEqual(Book.objects.get(pk=book.pk).stock, 0)
+
+    def test_rollups_are_left_to_the_batch_job(self):
+        """
+        Ensure checkouts of a sharded book do not update its rollup row inline.
+        """
+        self.checkout(self.students[0])
+        self.assertFalse(CirculationDaily.objects.filter(book=self.book).exists())
+        call_command('rollup_circulation', stdout=io.StringIO())
+        self.assertEqual(CirculationDaily.objects.get(book=self.book).checkouts, 1)
+
+
+class IdempotencyTests(APITestCase):
+    """
+    Tests for Idempotency-Key support on checkout POSTs.
+    """
+
+    def setUp(self):
+        self.student = User.objects.create_user(username='student', password='password123', role='student')
+        self.librarian = User.objects.create_user(username='librarian', password='password123', role='librarian')
+        self.book = Book.objects.create(title='Dune', author='Frank Herbert', published_year=1965, genre='Science Fiction', stock=2)
+        self.client.force_authenticate(user=self.student)
+
+    def test_retried_checkout_is_replayed(self):
+        """
+        Ensure a retry returns the original response without touching the stock.
+        """
+        url = reverse('checkout-list')
+        first = self.client.post(url, {'book': self.book.id}, format='json', HTTP_IDEMPOTENCY_KEY='abc')
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+
+        with self.assertNumQueries(1):
+            retry = self.client.post(url, {'book': self.book.id}, format='json', HTTP_IDEMPOTENCY_KEY='abc')
+        self.assertEqual(retry.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retry.data, first.data)
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(Book.objects.get(pk=self.book.pk).stock, 1)
+
+        other = self.client.post(url, {'book': self.book.id + 1}, format='json', HTTP_IDEMPOTENCY_KEY='abc')
+        self.assertEqual(other.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+    def test_retried_return_is_replayed(self):
+        """
+        Ensure a retried return does not report the book as already returned.
+        """
+        checkout = self.client.post(reverse('checkout-list'), {'book': self.book.id}, format='json').data
+        self.client.force_authenticate(user=self.librarian)
+        url = reverse('checkout-return-book', kwargs={'pk': checkout['id']})
+        for _ in range(2):
+            response = self.client.post(url, HTTP_IDEMPOTENCY_KEY='return-1')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(Book.objects.get(pk=self.book.pk).stock, 2)
+
+    def test_failed_requests_release_the_key(self):
+        """
+        Ensure a request that raised an error can be retried with the same key.
+        """
+        Book.objects.filter(pk=self.book.pk).update(stock=0)
+        response = self.client.post(reverse('checkout-list'), {'book': self.book.id}, format='json', HTTP_IDEMPOTENCY_KEY='k')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+    @override_settings(LIBRARY_REQUEST_BUDGET_MODE='enforce')
+    def test_requests_over_budget_release_the_key(self):
+        """
+        Ensure a request stopped by its budget can be retried with the same key.
+        """
+        def over_budget(*args):
+            budget = current_budget.get()
+            budget.queries = budget.max_queries
+            return Book.objects.count()
+
+        url = reverse('checkout-list')
+        with mock.patch('library.views.checkout_book', over_budget), self.assertLogs('library.budget', 'WARNING'):
+            response = self.client.post(url, {'book': self.book.id}, format='json', HTTP_IDEMPOTENCY_KEY='k')
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+        retry = self.client.post(url, {'book': self.book.id}, format='json', HTTP_IDEMPOTENCY_KEY='k')
+        self.assertEqual(retry.status_code, status.HTTP_201_CREATED)
+
+    @override_settings(LIBRARY_IDEMPOTENCY_MAX_KEYS=2)
+    def test_storage_is_bounded(self):
+        """
+        Ensure only the newest keys of a user are kept.
+        """
+        for key in ('k1', 'k2', 'k3'):
+            book = Book.objects.create(title=key, author='Author', published_year=2000, genre='Fiction', stock=1)
+            self.client.post(reverse('checkout-list'), {'book': book.id}, format='json', HTTP_IDEMPOTENCY_KEY=key)
+        self.assertEqual(sorted(IdempotencyKey.objects.values_list('key', flat=True)), ['k2', 'k3'])
+
+
+class BatchTests(APITestCase):
+    """
+    Tests for the batch endpoint.
+    """
+
+    def setUp(self):
+        self.student = User.objects.create_user(username='student', password='password123', role='student')
+        self.book = Book.objects.create(title='Dune', author='Frank Herbert', published_year=1965, genre='Science Fiction', stock=2)
+        self.client.force_authenticate(user=self.student)
+
+    def test_batch_runs_requests_in_order(self):
+        """
+        Ensure sub-requests run in order, as the batch's user, with their own status and timing.
+        """
+        response = self.client.post(reverse('batch'), {'requests': [
+            {'method': 'POST', 'path': '/api/checkouts/', 'body': {'book': self.book.id}},
+            {'path': f'/api/books/{self.book.id}/?fields=id,stock'},
+            {'path': '/api/users/'},
+            {'path': '/api/nowhere/'},
+        ]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        responses = response.data['responses']
+        self.assertEqual([entry['status'] for entry in responses], [201, 200, 403, 404])
+        self.assertEqual(responses[1]['body'], {'id': self.book.id, 'stock': 1})
+        self.assertTrue(all(entry['duration_ms'] >= 0 for entry in responses))
+        self.assertEqual(Checkout.objects.get().student, self.student)
+
+    def test_batch_is_validated(self):
+        """
+        Ensure oversized batches and unsupported paths are rejected.
+        """
+        with override_settings(LIBRARY_BATCH_MAX_REQUESTS=2):
+            response = self.client.post(reverse('batch'), {'requests': [{'path': '/api/books/'}] * 3}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.post(reverse('batch'), {'requests': [
+            {'path': '/api/batch/'}, {'path': '/api/events/'}, {'path': '/admin/'},
+        ]}, format='json')
+        self.assertEqual([entry['status'] for entry in response.data['responses']], [400, 400, 400])
+
+    def test_sub_requests_do_not_inherit_the_idempotency_key(self):
+        """
+        Ensure writes in a batch sent with an Idempotency-Key each use their own key, if any.
+        """
+        books = [Book.objects.create(title=f'Book {i}', author='Author', published_year=2000, genre='Fiction', stock=1) for i in range(2)]
+        response = self.client.post(reverse('batch'), {'requests': [
+            {'method': 'POST', 'path': '/api/checkouts/', 'body': {'book': self.book.id}, 'headers': {'Idempotency-Key': 'first'}},
+            {'method': 'POST', 'path': '/api/checkouts/', 'body': {'book': books[0].id}},
+            {'method': 'POST', 'path': '/api/checkouts/', 'body': {'book': books[1].id}},
+        ]}, format='json', HTTP_IDEMPOTENCY_KEY='batch-key')
+        self.assertEqual([entry['status'] for entry in response.data['responses']], [201, 201, 201])
+        self.assertEqual(list(IdempotencyKey.objects.values_list('key', flat=True)), ['first'])
+
+    def test_batch_requires_authentication(self):
+        """
+        Ensure anonymous clients cannot use the batch endpoint.
+        """
+        self.client.force_authenticate(user=None)
+        response = self.client.post(reverse('batch'), {'requests': [{'path': '/api/books/'}]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class ParallelBatchTests(APITransactionTestCase):
+    """
+    Tests for batches of reads running on several threads.
+    """
+
+    def test_parallel_reads(self):
+        """
+        Ensure parallel GETs return the same responses as sequential ones, and writes stay sequential.
+        """
+        student = User.objects.create_user(username='student', password='password123', role='student')
+        books = [Book.objects.create(title=f'Book {i}', author='Author', published_year=2000, genre='Fiction', stock=i) for i in range(4)]
+        self.client.force_authenticate(user=student)
+        requests = [{'path': f'/api/books/{book.id}/?fields=title'} for book in books]
+
+        response = self.client.post(reverse('batch'), {'requests': requests, 'parallel': True}, format='json')
+        self.assertTrue(response.data['parallel'])
+        self.assertEqual([entry['body']['title'] for entry in response.data['responses']], [book.title for book in books])
+
+        requests.append({'method': 'POST', 'path': '/api/checkouts/', 'body': {'book': books[1].id}})
+        response = self.client.post(reverse('batch'), {'requests': requests, 'parallel': True}, format='json')
+        self.assertFalse(response.data['parallel'])
+        self.assertEqual(response.data['responses'][-1]['status'], status.HTTP_201_CREATED)
+
+    def test_parallel_reads_share_the_batch_budget(self):
+        """
+        Ensure the request budget of a batch covers the statements of its worker threads.
+        """
+        student = User.objects.create_user(username='student', password='password123', role='student')
+        books = [Book.objects.create(title=f'Book {i}', author='Author', published_year=2000, genre='Fiction', stock=1) for i in range(3)]
+        self.client.force_authenticate(user=student)
+        requests = [{'path': f'/api/books/{book.id}/'} for book in books]
+        budgets = {**settings.LIBRARY_REQUEST_BUDGETS, 'batch': {'queries': 1}}
+        with self.settings(LIBRARY_REQUEST_BUDGET_MODE='enforce', LIBRARY_REQUEST_BUDGETS=budgets):
+            with self.assertLogs('library.budget', 'WARNING'):
+                response = self.client.post(reverse('batch'), {'requests': requests, 'parallel': True}, format='json')
+        self.assertTrue(response.data['parallel'])
+        self.assertIn(status.HTTP_503_SERVICE_UNAVAILABLE, [entry['status'] for entry in response.data['responses']])
+        self.assertIn('X-Request-Budget', response)
+
+
+class BulkBookRetrieveTests(APITestCase):
+    """
+    Tests for fetching many books by ID.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.student = User.objects.create_user(username='student', password='password123', role='student')
+        self.librarian = User.objects.create_user(username='librarian', password='password123', role='librarian')
+        self.books = [Book.objects.create(title=f'Book {i}', author='Author', published_year=2000, genre='Fiction', stock=2) for i in range(3)]
+        self.client.force_authenticate(user=self.student)
+        self.url = reverse('book-bulk-retrieve')
+
+    def test_bulk_retrieve_preserves_order_and_reports_missing(self):
+        """
+        Ensure books are returned in the requested order with one query, then from the cache.
+        """
+        ids = [self.books[2].id, 999, self.books[0].id]
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url, {'ids': ','.join(map(str, ids))})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([book['id'] for book in response.data['results']], [self.books[2].id, self.books[0].id])
+        self.assertEqual(response.data['results'][0]['available'], 2)
+        self.assertEqual(response.data['missing'], [999])
+
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url, {'ids': f'{self.books[0].id}', 'fields': 'id,title'})
+        self.assertEqual(response.data['results'], [{'id': self.books[0].id, 'title': 'Book 0'}])
+
+    def test_cache_is_invalidated(self):
+        """
+        Ensure checkouts and edits refresh the cached books.
+        """
+        book = self.books[0]
+        params = {'ids': str(book.id), 'fields': 'title,stock'}
+        self.client.get(self.url, params)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('checkout-list'), {'book': book.id}, format='json')
+        self.assertEqual(self.client.get(self.url, params).data['results'][0]['stock'], 1)
+
+        self.client.force_authenticate(user=self.librarian)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(reverse('book-detail', kwargs={'pk': book.id}), {'title': 'Renamed'}, format='json')
+        self.assertEqual(self.client.get(self.url, params).data['results'][0]['title'], 'Renamed')
+
+    def test_bulk_retrieve_validates_ids(self):
+        """
+        Ensure missing, malformed and too many IDs are rejected.
+        """
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get(self.url, {'ids': '1,x'}).status_code, status.HTTP_400_BAD_REQUEST)
+        with override_settings(LIBRARY_BULK_BOOKS_MAX=2):
+            self.assertEqual(self.client.get(self.url, {'ids': '1,2,3'}).status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class AdminPerformanceTests(APITestCase):
+    """
+    Tests for the admin changelists of large tables.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.admin = User.objects.create_superuser(username='admin', password='password123', email='admin@example.com')
+        self.client.force_login(self.admin)
+
+    def create_checkouts(self, count):
+        for _ in range(count):
+            student = User.objects.create_user(username=f'student{User.objects.count()}', password='x', role='student')
+            book = Book.objects.create(title='Book', author='Author', published_year=2000 + Book.objects.count(), genre='Fiction', stock=1)
+            Checkout.objects.create(student=student, book=book)
+
+    def test_checkout_changelist_queries_do_not_grow_with_rows(self):
+        """
+        Ensure students and books are joined into the changelist query.
+        """
+        url = reverse('admin:library_checkout_changelist')
+        self.create_checkouts(2)
+        with CaptureQueriesContext(connection) as few:
+            self.assertEqual(self.client.get(url).status_code, status.HTTP_200_OK)
+        self.create_checkouts(5)
+        with CaptureQueriesContext(connection) as many:
+            self.client.get(url)
+        self.assertEqual(len(few), len(many))
+
+    def test_book_filter_choices_are_cached(self):
+        """
+        Ensure the book changelist filters do not run a DISTINCT on every page.
+        """
+        self.create_checkouts(2)
+        url = reverse('admin:library_book_changelist')
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, {'published_year': '2001'})
+        self.assertFalse(any('DISTINCT' in query['sql'] for query in queries))
+        self.assertEqual(response.context['cl'].result_count, 1)
+
+
+class CountModePaginationTests(APITestCase):
+    """
+    Tests for the `?count=` modes of paginated lists.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.student = User.objects.create_user(username='student', password='password123', role='student')
+        Book.objects.bulk_create(
+            Book(title=f'Book {i}', author='Author', published_year=2000, genre='Fiction', stock=1) for i in range(250)
+        )
+        self.client.force_authenticate(user=self.student)
+        self.url = reverse('book-list')
+
+    def test_exact_count_is_the_default(self):
+        """
+        Ensure lists keep their exact count and response shape by default.
+        """
+        response = self.client.get(self.url)
+        self.assertEqual(response.data['count'], 250)
+        self.assertNotIn('count_approximate', response.data)
+
+    @override_settings(LIBRARY_EXACT_COUNT_THRESHOLD=150)
+    def test_estimated_count_is_capped_and_cached(self):
+        """
+        Ensure estimated counts are capped at the threshold and cached for filtered lists.
+        """
+        response = self.client.get(self.url, {'count': 'estimate'})
+        self.assertEqual((response.data['count'], response.data['count_approximate']), (150, True))
+        self.assertIsNotNone(response.data['next'])
+
+        params = {'count': 'estimate', 'search': 'Book', 'fields': 'id'}
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.data['count'], 150)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(self.url, params)
+        self.assertEqual(sum('COUNT' in query['sql'] for query in queries), 0)
+
+        response = self.client.get(self.url, {'count': 'estimate', 'search': 'Book 24'})
+        self.assertEqual((response.data['count'], response.data['count_approximate']), (13, False))
+
+    @override_settings(LIBRARY_EXACT_COUNT_THRESHOLD=150)
+    def test_estimated_count_pages_past_the_estimate(self):
+        """
+        Ensure every row can be paged to when the estimate is lower than the real count.
+        """
+        response = self.client.get(self.url, {'count': 'estimate', 'page': 2, 'fields': 'id'})
+        self.assertEqual(len(response.data['results']), 100)
+        self.assertIsNotNone(response.data['next'])
+        self.assertEqual(response.data['count_approximate'], True)
+
+        response = self.client.get(self.url, {'count': 'estimate', 'page': 3, 'fields': 'id'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['results']), 50)
+        self.assertIsNone(response.data['next'])
+        self.assertEqual((response.data['count'], response.data['count_approximate']), (250, False))
+        self.assertEqual(self.client.get(self.url, {'count': 'estimate', 'page': 4}).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_no_count(self):
+        """
+        Ensure `?count=none` skips the count and still links the next page.
+        """
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url, {'count': 'none', 'page': 2, 'fields': 'id,title'})
+        self.assertFalse(any('COUNT' in query['sql'] for query in queries))
+        self.assertIsNone(response.data['count'])
+        self.assertEqual(len(response.data['results']), 100)
+        self.assertIsNotNone(response.data['next'])
+        self.assertIsNotNone(response.data['previous'])
+        self.assertIsNone(self.client.get(self.url, {'count': 'none', 'page': 3}).data['next'])
+        self.assertEqual(self.client.get(self.url, {'count': 'none', 'page': 0}).status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.get(self.url, {'count': 'all'}).status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class AutocompleteTests(APITestCase):
+    """
+    Tests for the title and author autocomplete.
+    """
+
+    def setUp(self):
+        self.student = User.objects.create_user(username='student', password='password123', role='student')
+        self.dune = Book.objects.create(title='Dune', author='Frank Herbert', published_year=1965, genre='Science Fiction', stock=1)
+        Book.objects.create(title='Dune Messiah', author='Frank Herbert', published_year=1969, genre='Science Fiction', stock=1)
+        Book.objects.create(title='Emma', author='Jane Austen', published_year=1815, genre='Romance', stock=1)
+        autocomplete.load_index()
+        self.client.force_authenticate(user=self.student)
+        self.url = reverse('book-autocomplete')
+
+    def tearDown(self):
+        autocomplete.reset_index()
+
+    def complete(self, query, **params):
+        response = self.client.get(self.url, {'q': query, **params})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [(result['kind'], result['text']) for result in response.data['results']]
+
+    def test_completions(self):
+        """
+        Ensure titles and authors are completed from any word, once each, without queries.
+        """
+        with self.assertNumQueries(0):
+            self.assertEqual(self.complete('DUN'), [('title', 'Dune'), ('title', 'Dune Messiah')])
+        self.assertEqual(self.complete('mes'), [('title', 'Dune Messiah')])
+        self.assertEqual(self.complete('her'), [('author', 'Frank Herbert')])
+        self.assertEqual(self.complete('dune', limit=1), [('title', 'Dune')])
+        self.assertEqual(self.complete(' '), [])
+
+    def test_index_follows_book_changes(self):
+        """
+        Ensure saved, renamed and deleted books update the index once committed.
+        """
+        with self.captureOnCommitCallbacks(execute=True):
+            Book.objects.create(title='Persuasion', author='Jane Austen', published_year=1817, genre='Romance', stock=1)
+        self.assertEqual(self.complete('pers'), [('title', 'Persuasion')])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.dune.title = 'Children of Dune'
+            self.dune.save()
+        self.assertEqual(self.complete('dune'), [('title', 'Children of Dune'), ('title', 'Dune Messiah')])
+        self.assertEqual(self.complete('chi'), [('title', 'Children of Dune')])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Book.objects.filter(author='Frank Herbert').delete()
+        self.assertEqual(self.complete('her'), [])
+
+    def test_changes_during_a_rebuild_are_kept(self):
+        """
+        Ensure book changes committed while the index is rebuilt reach the new index.
+        """
+        build_index = autocomplete.build_index
+
+        def slow_build():
+            index = build_index()
+            with self.captureOnCommitCallbacks(execute=True):
+                Book.objects.create(title='Persuasion', author='Jane Austen', published_year=1817, genre='Romance', stock=1)
+                self.dune.delete()
+            return index
+
+        with mock.patch.object(autocomplete, 'build_index', slow_build):
+            autocomplete.load_index()
+        self.assertEqual(self.complete('pers'), [('title', 'Persuasion')])
+        self.assertEqual(self.complete('dun'), [('title', 'Dune Messiah')])
+
+    def test_memory_cap(self):
+        """
+        Ensure a capped index keeps full titles before later-word keys.
+        """
+        index = autocomplete.PrefixIndex.build([(1, 'Dune Messiah', 'Frank Herbert'), (2, 'Emma', 'Jane Austen')], max_entries=4)
+        self.assertTrue(index.truncated)
+        self.assertEqual(len(index.keys), 4)
+        self.assertEqual([result['text'] for result in index.search('e')], ['Emma'])
+
+    def test_database_fallback(self):
+        """
+        Ensure prefixes are looked up in the database while the index is built.
+        """
+        self.assertEqual(
+            [(result['kind'], result['text']) for result in autocomplete.search_database('du')],
+            [('title', 'Dune'), ('title', 'Dune Messiah')],
+        )
+
+
+class CheckoutSearchTests(APITestCase):
+    """
+    Tests for the denormalized checkout search document.
+    """
+
+    def setUp(self):
+        self.librarian = User.objects.create_user(username='librarian', password='password123', role='librarian')
+        self.student = User.objects.create_user(username='jdoe', password='password123', role='student', first_name='Jane', last_name='Doe')
+        self.other = User.objects.create_user(username='rroe', password='password123', role='student', first_name='Richard', last_name='Roe')
+        self.dune = Book.objects.create(title='Dune', author='Frank Herbert', published_year=1965, genre='Science Fiction', stock=5)
+        self.emma = Book.objects.create(title='Emma', author='Jane Austen', published_year=1815, genre='Romance', stock=5)
+        self.loan = Checkout.objects.create(student=self.student, book=self.dune)
+        Checkout.objects.create(student=self.other, book=self.emma)
+        self.client.force_authenticate(user=self.librarian)
+
+    def search(self, terms):
+        response = self.client.get(reverse('checkout-list'), {'search': terms, 'fields': 'id'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [checkout['id'] for checkout in response.data['results']]
+
+    def test_librarian_search_uses_the_document(self):
+        """
+        Ensure librarian searches match any field, case-insensitively, without joins.
+        """
+        self.assertEqual(self.loan.search_document, 'jdoe\njane\ndoe\ndune\nfrank herbert')
+        self.assertEqual(self.search('HERBERT'), [self.loan.id])
+        self.assertEqual(self.search('jane doe'), [self.loan.id])
+        self.assertEqual(len(self.search('jane')), 2)
+        with CaptureQueriesContext(connection) as queries:
+            self.search('dune')
+        self.assertFalse(any('JOIN' in query['sql'] and 'search_document' in query['sql'] for query in queries))
+
+    def test_renames_refresh_the_document(self):
+        """
+        Ensure renaming a book or a student updates the documents of their loans.
+        """
+        self.dune.title = 'Children of Dune'
+        self.dune.save()
+        self.student.last_name = 'Smith'
+        self.student.save(update_fields=['last_name'])
+        self.assertEqual(self.search('children smith'), [self.loan.id])
+        self.assertEqual(Checkout.objects.get(pk=self.loan.pk).search_document, 'jdoe\njane\nsmith\nchildren of dune\nfrank herbert')
+
+    def test_backfill_command(self):
+        """
+        Ensure the backfill command fills empty documents of existing loans.
+        """
+        Checkout.objects.update(search_document='')
+        out = io.StringIO()
+        call_command('backfill_search_documents', '--batch-size', '1', stdout=out)
+        self.assertIn('2 checkout(s)', out.getvalue())
+        self.assertEqual(Checkout.objects.get(pk=self.loan.pk).search_document, self.loan.search_document)
+
+    def test_student_search_is_limited_to_books(self):
+        """
+        Ensure students still only search their own loans by title and author.
+        """
+        self.client.force_authenticate(user=self.student)
+        self.assertEqual(self.search('herbert'), [self.loan.id])
+        self.assertEqual(self.search('jdoe'), [])
+
+
+@override_settings(LIBRARY_LOAN_LIMITS={'student': 2, 'librarian': 5})
+class LoanLimitTests(APITestCase):
+    """
+    Tests for the per-role loan limits and the active loan counters.
+    """
+
+    def setUp(self):
+        self.librarian = User.objects.create_user(username='librarian', password='password123', role='librarian')
+        self.student = User.objects.create_user(username='student', password='password123', role='student')
+        self.books = [Book.objects.create(title=f'Book {i}', author='Author', published_year=2000, genre='Fiction', stock=1) for i in range(3)]
+        self.client.force_authenticate(user=self.student)
+
+    def checkout(self, book):
+        return self.client.post(reverse('checkout-list'), {'book': book.id}, format='json')
+
+    def count(self, user):
+        return User.objects.get(pk=user.pk).active_checkout_count
+
+    def test_limit_is_enforced(self):
+        """
+        Ensure a student cannot exceed their limit until they return a book.
+        """
+        first = self.checkout(self.books[0]).data
+        self.checkout(self.books[1])
+        response = self.checkout(self.books[2])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('limit of 2', response.data['detail'])
+        self.assertEqual(Book.objects.get(pk=self.books[2].pk).stock, 1)
+        self.assertEqual(self.count(self.student), 2)
+
+        self.client.force_authenticate(user=self.librarian)
+        self.client.post(reverse('checkout-return-book', kwargs={'pk': first['id']}))
+        self.assertEqual(self.count(self.student), 1)
+        self.client.force_authenticate(user=self.student)
+        self.assertEqual(self.checkout(self.books[2]).status_code, status.HTTP_201_CREATED)
+
+    def test_hold_allocation_counts_the_loan(self):
+        """
+        Ensure a copy allocated from a hold moves the loan between the counters.
+        """
+        other = User.objects.create_user(username='other', password='password123', role='student')
+        loan = self.checkout(self.books[0]).data
+        self.client.force_authenticate(user=other)
+        self.client.post(reverse('hold-list'), {'book': self.books[0].id}, format='json')
+
+        return_checkouts(Checkout.objects.filter(pk=loan['id']))
+        self.assertEqual((self.count(self.student), self.count(other)), (0, 1))
+
+    def test_reconcile_command(self):
+        """
+        Ensure the reconciliation command repairs drifted counters.
+        """
+        Checkout.objects.create(student=self.student, book=self.books[0])
+        User.objects.filter(pk=self.librarian.pk).update(active_checkout_count=3)
+        out = io.StringIO()
+        call_command('reconcile_loan_counts', '--batch-size', '1', stdout=out)
+        self.assertIn('2 user(s)', out.getvalue())
+        self.assertEqual((self.count(self.student), self.count(self.librarian)), (1, 0))
+
+
+class StockLedgerTests(APITestCase):
+    """
+    Tests for the stock ledger and the stock reconciliation command.
+    """
+
+    def setUp(self):
+        self.librarian = User.objects.create_user(username='librarian', password='password123', role='librarian')
+        self.student = User.objects.create_user(username='student', password='password123', role='student')
+        self.book = Book.objects.create(title='Dune', author='Frank Herbert', published_year=1965, genre='Science Fiction', stock=3)
+
+    def movements(self):
+        return list(StockMovement.objects.filter(book=self.book).order_by('pk').values_list('reason', 'delta'))
+
+    def reconcile(self, *args):
+        out = io.StringIO()
+        call_command('reconcile_stock', '--batch-size', '1', *args, stdout=out)
+        return out.getvalue()
+
+    def test_mutations_are_recorded(self):
+        """
+        Ensure creating, lending, returning and editing a book write movements.
+        """
+        self.client.force_authenticate(user=self.student)
+        loan = self.client.post(reverse('checkout-list'), {'book': self.book.id}, format='json').data
+        self.client.force_authenticate(user=self.librarian)
+        self.client.post(reverse('checkout-return-book', kwargs={'pk': loan['id']}))
+        self.client.patch(reverse('book-detail', kwargs={'pk': self.book.id}), {'stock': 5}, format='json')
+        self.client.patch(reverse('book-detail', kwargs={'pk': self.book.id}), {'title': 'Dune'}, format='json')
+
+        self.assertEqual(self.movements(), [('opening', 3), ('checkout', -1), ('return', 1), ('adjustment', 2)])
+        self.assertEqual(StockMovement.objects.get(reason='checkout').checkout_id, loan['id'])
+        self.assertIn('0 book(s)', self.reconcile())
+
+    def test_report_and_fix_drift(self):
+        """
+        Ensure drift is reported, and --fix resets the stock to the ledger.
+        """
+        Book.objects.filter(pk=self.book.pk).update(stock=7)
+        out = self.reconcile()
+        self.assertIn('stock 7, ledger 3 (+4)', out)
+        self.assertIn('found 1 book(s)', out)
+        self.assertEqual(Book.objects.get(pk=self.book.pk).stock, 7)
+
+        self.reconcile('--fix')
+        self.assertEqual(Book.objects.get(pk=self.book.pk).stock, 3)
+        self.assertIn('0 book(s)', self.reconcile())
+
+    def test_accept_drift(self):
+        """
+        Ensure --accept keeps the stock and records a reconciliation movement.
+        """
+        split_stock(self.book.pk, 2)
+        BookStockShard.objects.filter(book=self.book, shard=0).update(count=0)
+        expected = Book.objects.get(pk=self.book.pk).current_stock()
+        self.reconcile('--accept')
+        self.assertEqual(Book.objects.get(pk=self.book.pk).current_stock(), expected)
+        self.assertEqual(self.movements()[-1], ('reconciliation', expected - 3))
+        self.assertIn('0 book(s)', self.reconcile())
+
+    def test_admin_stock_edit(self):
+        """
+        Ensure a stock edit in the admin is applied once, on top of the copies lent meanwhile.
+        """
+        admin = User.objects.create_superuser(username='admin', password='password123', email='admin@example.com')
+        self.client.force_login(admin)
+        url = reverse('admin:library_book_change', args=[self.book.pk])
+        form = {'title': 'Dune', 'author': 'Frank Herbert', 'published_year': 1965, 'genre': 'Science Fiction', 'stock': 3}
+        self.client.get(url)
+        self.client.force_authenticate(user=self.student)
+        self.client.post(reverse('checkout-list'), {'book': self.book.id}, format='json')  # lent while the form is open
+
+        response = self.client.post(url, {**form, 'stock': 5, 'initial-stock': 3})
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+        self.assertEqual(Book.objects.get(pk=self.book.pk).stock, 4)
+        self.assertEqual(self.movements()[-1], ('adjustment', 2))
+        self.assertIn('0 book(s)', self.reconcile())
+
+    def test_sharded_books_are_locked_before_reconciling(self):
+        """
+        Ensure lent copies of sharded books are not drift, and their shards are locked.
+        """
+        split_stock(self.book.pk, 2)
+        self.client.force_authenticate(user=self.student)
+        self.client.post(reverse('checkout-list'), {'book': self.book.id}, format='json')
+        with CaptureQueriesContext(connection) as queries:
+            self.assertIn('0 book(s)', self.reconcile('--accept'))
+        self.assertEqual(self.movements()[-1], ('checkout', -1))
+        if connection.features.has_select_for_update:
+            self.assertTrue(any('FOR UPDATE' in query['sql'] and 'bookstockshard' in query['sql'] for query in queries))
+
+
+class SQLiteProfileTests(APITestCase):
+    """
+    Tests for the SQLite connection settings of single-node deployments.
+    """
+
+    def test_connection_is_tuned(self):
+        """
+        Ensure SQLite connections use the pragmas and the transaction mode of the profile.
+        """
+        if connection.vendor != 'sqlite':
+            self.skipTest('The database is not SQLite')
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1)  # NORMAL
+            cursor.execute('PRAGMA cache_size')
+            self.assertEqual(cursor.fetchone()[0], -settings.LIBRARY_SQLITE_CACHE_SIZE)
+        self.assertEqual(connection.transaction_mode, 'IMMEDIATE')
+
+
+class TrafficCaptureTests(APITestCase):
+    """
+    Tests for the traffic capture middleware.
+    """
+
+    def setUp(self):
+        self.librarian = User.objects.create_user(username='librarian', password='password123', role='librarian')
+        self.log = os.path.join(tempfile.mkdtemp(), 'traffic.ndjson')
+        self.addCleanup(shutil.rmtree, os.path.dirname(self.log))
+
+    def records(self):
+        with open(self.log, encoding='utf-8') as log:
+            return [json.loads(line) for line in log]
+
+    def test_requests_are_recorded_and_scrubbed(self):
+        """
+        Ensure sampled API requests are logged with their route and role, without personal data.
+        """
+        self.client.force_authenticate(user=self.librarian)
+        with self.settings(LIBRARY_TRAFFIC_LOG=self.log, LIBRARY_TRAFFIC_SAMPLE_RATE=1.0):
+            self.client.get(reverse('book-list'), {'search': 'dune'})
+            self.client.post(reverse('user-list'), {'username': 'newstudent', 'password': 'secret-password', 'role': 'student'}, format='json')
+
+        search, create = self.records()
+        self.assertEqual((search['method'], search['route'], search['role'], search['status']), ('GET', 'book-list', 'librarian', 200))
+        self.assertEqual(search['query'], {'search': ['dune']})
+        self.assertEqual((create['route'], create['status']), ('user-list', 201))
+        self.assertEqual(create['body'], {'username': '<scrubbed>', 'password': '<scrubbed>', 'role': 'student'})
+        self.assertNotIn('secret-password', open(self.log, encoding='utf-8').read())
+
+    def test_unsampled_requests_are_not_recorded(self):
+        """
+        Ensure nothing is recorded when the sample rate excludes every request.
+        """
+        self.client.force_authenticate(user=self.librarian)
+        with self.settings(LIBRARY_TRAFFIC_LOG=self.log, LIBRARY_TRAFFIC_SAMPLE_RATE=0.0):
+            self.client.get(reverse('book-list'))
+        self.assertFalse(os.path.exists(self.log) and self.records())
+
+
+class ReplayTrafficTests(LiveServerTestCase):
+    """
+    Tests for replaying a traffic log against a running server.
+    """
+
+    def test_replay_reports_each_route(self):
+        """
+        Ensure the replay sends the recorded requests and reports them per route.
+        """
+        User.objects.create_user(username='student', password='password123', role='student')
+        book = Book.objects.create(title='Dune', author='Frank Herbert', published_year=1965, genre='Science Fiction', stock=1)
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        log, report = os.path.join(tmpdir, 'traffic.ndjson'), os.path.join(tmpdir, 'report.json')
+        with open(log, 'w', encoding='utf-8') as output:
+            for ts, path, route in ((1.0, '/api/books/', 'book-list'), (1.5, f'/api/books/{book.pk}/', 'book-detail'), (2.0, '/api/books/0/', 'book-detail')):
+                output.write(json.dumps({'ts': ts, 'method': 'GET', 'path': path, 'route': route, 'query': {}, 'body': None, 'role': 'student'}) + '\n')
+            output.write('not json\n')
+
+        out = io.StringIO()
+        call_command('replay_traffic', log, '--base-url', self.live_server_url, '--speedup', '0', '--json', report, stdout=out)
+        self.assertIn('Replayed 3 request(s)', out.getvalue())
+        with open(report, encoding='utf-8') as saved:
+            routes = json.load(saved)['routes']
+        self.assertEqual(routes['GET book-list']['count'], 1)
+        self.assertEqual((routes['GET book-detail']['count'], routes['GET book-detail']['client_errors']), (2, 1))
+        self.assertEqual(sum(route['errors'] for route in routes.values()), 0)
+
+
+class RequestBudgetTests(APITestCase):
+    """
+    Tests for the per-request SQL budgets.
+    """
+
+    def setUp(self):
+        self.student = User.objects.create_user(username='student', password='password123', role='student')
+        for i in range(3):
+            Book.objects.create(title=f'Book {i}', author='Author', published_year=2000, genre='Fiction', stock=1)
+        self.client.force_authenticate(user=self.student)
+
+    def budgets(self, **limits):
+        return {**settings.LIBRARY_REQUEST_BUDGETS, 'default': {**settings.LIBRARY_REQUEST_BUDGETS['default'], **limits}}
+
+    def test_within_budget(self):
+        """
+        Ensure a request within its budget is served without the header.
+        """
+        response = self.client.get(reverse('book-list'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn('X-Request-Budget', response)
+
+    def test_over_budget_is_logged(self):
+        """
+        Ensure a request over budget in log mode is served, flagged and logged with its statements.
+        """
+        with self.settings(LIBRARY_REQUEST_BUDGET_MODE='log', LIBRARY_REQUEST_BUDGETS=self.budgets(queries=1)):
+            with self.assertLogs('library.budget', 'WARNING') as logs:
+                response = self.client.get(reverse('book-list'), {'count': 'exact'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['X-Request-Budget'].startswith('queries=2/1'))
+        record = json.loads(logs.output[0].split('Request over budget: ', 1)[1])
+        self.assertEqual((record['route'], record['action'], record['queries']), ('book-list', 'logged', 2))
+        self.assertIn('library_book', record['top_statements'][0]['sql'])
+
+    def test_over_budget_is_stopped(self):
+        """
+        Ensure a request over budget in enforce mode is stopped with a 503.
+        """
+        with self.settings(LIBRARY_REQUEST_BUDGET_MODE='enforce', LIBRARY_REQUEST_BUDGETS=self.budgets(queries=1)):
+            with self.assertLogs('library.budget', 'WARNING'):
+                response = self.client.get(reverse('book-list'), {'count': 'exact'})
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response.data['detail'].code, 'request_budget_exceeded')
+
+    def test_exempt_route(self):
+        """
+        Ensure a route whose budget is None is not limited.
+        """
+        budgets = {**self.budgets(queries=0), 'book-list': None}
+        with self.settings(LIBRARY_REQUEST_BUDGET_MODE='enforce', LIBRARY_REQUEST_BUDGETS=budgets):
+            response = self.client.get(reverse('book-list'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_statement_timeout(self):
+        """
+        Ensure a statement running past the statement timeout is stopped.
+        """
+        if connection.vendor != 'sqlite':
+            self.skipTest('The database is not SQLite')
+        budget = RequestBudget('test', {'queries': 10, 'sql_ms': 60000, 'statement_timeout_ms': 50}, enforce=False)
+        slow = 'WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < 100000000) SELECT count(*) FROM n'
+        with connection.execute_wrapper(budget), connection.cursor() as cursor:
+            with self.assertRaises(BudgetExceeded):
+                cursor.execute(slow)
+            cursor.execute('SELECT 1')
+        self.assertTrue(budget.aborted)
+        self.assertEqual(budget.queries, 2)
+
+
+class BackgroundTaskTests(APITransactionTestCase):
+    """
+    Tests for the background task queue and its worker.
+    """
+
+    def setUp(self):
+        self.librarian = User.objects.create_user(username='librarian', password='password123', role='librarian')
+        self.student = User.objects.create_user(username='student', password='password123', role='student')
+        self.client.force_authenticate(user=self.librarian)
+
+    def run_worker(self):
+        # One task at a time: the in-memory test database fails concurrent
+        # writes with "database table is locked" instead of waiting.
+        call_command('run_worker', '--burst', '--concurrency', '1', stdout=io.StringIO())
+
+    def test_command_task(self):
+        """
+        Ensure librarians can queue a maintenance command and read its output once run.
+        """
+        response = self.client.post(reverse('task-list'), {'command': 'reconcile_loan_counts'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.data['status'], Task.QUEUED)
+        self.assertTrue(response['Location'].endswith(reverse('task-detail', kwargs={'pk': response.data['id']})))
+
+        self.run_worker()
+        task = self.client.get(response['Location']).data
+        self.assertEqual((task['status'], task['attempts']), (Task.SUCCEEDED, 1))
+        self.assertIn('Repaired the active loan count', task['result']['output'])
+
+    def test_only_allowed_commands_by_librarians(self):
+        """
+        Ensure commands outside LIBRARY_TASK_COMMANDS and students are refused.
+        """
+        response = self.client.post(reverse('task-list'), {'command': 'flush'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.client.force_authenticate(user=self.student)
+        response = self.client.post(reverse('task-list'), {'command': 'prune_events'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_bulk_users_in_background(self):
+        """
+        Ensure bulk user creation can be queued without clear-text passwords, and its arguments are dropped once done.
+        """
+        rows = [{'username': 'background-user', 'password': 'Complex-pass-123'}, {'username': 'no-password'}]
+        response = self.client.post(reverse('user-bulk') + '?background=true', rows, format='json')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertFalse(User.objects.filter(username='background-user').exists())
+        self.assertNotIn('Complex-pass-123', json.dumps(Task.objects.get(pk=response.data['id']).kwargs))
+
+        self.run_worker()
+        task = Task.objects.get(pk=response.data['id'])
+        self.assertEqual((task.status, task.result['created'], task.result['failed'], task.kwargs), (Task.SUCCEEDED, 1, 1, {}))
+        self.assertIn('password', task.result['results'][1]['errors'])
+        self.assertTrue(User.objects.get(username='background-user').check_password('Complex-pass-123'))
+
+    def test_failed_task_is_retried(self):
+        """
+        Ensure a failing task is retried after a backoff and fails after its last attempt.
+        """
+        task = enqueue('command', max_attempts=2, command='reconcile_loan_counts', args=['--batch-size', 'many'])
+        with self.assertLogs('library.tasks', 'ERROR'):
+            self.run_worker()
+        task.refresh_from_db()
+        self.assertEqual((task.status, task.attempts), (Task.QUEUED, 1))
+        self.assertGreater(task.run_after, timezone.now())
+        self.assertIn('CommandError', task.error)
+
+        Task.objects.filter(pk=task.pk).update(run_after=timezone.now())
+        with self.assertLogs('library.tasks', 'ERROR'):
+            self.run_worker()
+        task.refresh_from_db()
+        self.assertEqual((task.status, task.attempts, task.kwargs), (Task.FAILED, 2, {}))
+
+    def test_priority_order(self):
+        """
+        Ensure workers claim the highest priority due task first.
+        """
+        low = enqueue('command', command='prune_events')
+        high = enqueue('command', priority=10, command='prune_events')
+        later = enqueue('command', priority=20, command='prune_events')
+        Task.objects.filter(pk=later.pk).update(run_after=timezone.now() + timedelta(hours=1))
+        self.assertEqual([claim('test'), claim('test'), claim('test')], [high.pk, low.pk, None])
+
+    def test_only_tasks_without_heartbeat_are_requeued(self):
+        """
+        Ensure long tasks keep their heartbeat, and tasks of dead workers are queued again.
+        """
+        long_running = enqueue('command', command='prune_events')
+        lost = enqueue('command', command='prune_events')
+        claim('alive'), claim('dead')
+        hour_ago = timezone.now() - timedelta(hours=1)
+        Task.objects.update(started_at=hour_ago, heartbeat_at=hour_ago)
+        self.assertEqual(heartbeat('alive'), 1)
+        self.assertEqual(requeue_stale(), 1)
+        self.assertEqual(Task.objects.get(pk=long_running.pk).status, Task.RUNNING)
+        self.assertEqual(Task.objects.get(pk=lost.pk).status, Task.QUEUED)
+
+        first_attempt = Task.objects.get(pk=lost.pk)
+        claim('alive')
+        finish(first_attempt, Task.FAILED, error='The first attempt ended after all.')
+        self.assertEqual(Task.objects.get(pk=lost.pk).status, Task.RUNNING)
@@ -0,0 +1,191 @@
+"""
+library/traffic.py
+
+This file is part of the University Library project.
+It contains the traffic capture middleware, which records a sample of the
+API requests served in production to a rotating NDJSON log, and the helpers
+`manage.py replay_traffic` uses to read such logs back.
+
+Author: Raul Berrios
+"""
+import json
+import logging
+import os
+import random
+import time
+from logging.handlers import RotatingFileHandler
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.utils.functional import SimpleLazyObject, empty
+
+PREFIX = '/api/'
+
+# Request body fields and query parameters whose values are never written to
+# the log.
+SCRUBBED_FIELDS = {'password', 'username', 'email', 'first_name', 'last_name', 'token', 'key', 'secret', 'ticket'}
+SCRUBBED = '<scrubbed>'
+
+# Bodies larger than this are not recorded (the request is, without its body).
+MAX_BODY_BYTES = 64 * 1024
+
+logger = logging.getLogger('library.traffic')
+
+
+def scrub(value):
+    """Returns `value` (parsed JSON) with the values of `SCRUBBED_FIELDS` replaced."""
+    if isinstance(value, dict):
+        return {key: SCRUBBED if key in SCRUBBED_FIELDS else scrub(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [scrub(item) for item in value]
+    return value
+
+
+def scrub_query(query):
+    """Returns the query parameters of a request, with `SCRUBBED_FIELDS` replaced."""
+    return {key: [SCRUBBED] * len(values) if key in SCRUBBED_FIELDS else values for key, values in query.lists()}
+
+
+def read_body(request):
+    """
+    Returns the scrubbed JSON body of `request`, or None when it has none or
+    it is not JSON. Reading it here, before the view, keeps it readable for
+    the view.
+    """
+    if request.content_type != 'application/json':
+        return None
+    try:
+        if int(request.META.get('CONTENT_LENGTH') or 0) > MAX_BODY_BYTES:
+            return None
+        return scrub(json.loads(request.body)) if request.body else None
+    except ValueError:
+        return None
+
+
+def request_role(request):
+    """
+    Returns the role of the user who made `request`, or 'anonymous'. The
+    API authenticates in the view, which replaces `request.user`; a session
+    user the view never looked at is not loaded, since this may run in an
+    asynchronous context.
+    """
+    user = getattr(request, 'user', None)
+    if user is None or (isinstance(user, SimpleLazyObject) and user._wrapped is empty):
+        return 'anonymous'
+    return user.role if user.is_authenticated else 'anonymous'
+
+
+def capture_logger():
+    """
+    Returns the logger writing `LIBRARY_TRAFFIC_LOG` through a rotating
+    handler, created once per file. A `{pid}` placeholder in the path gives
+    every worker process its own file, since processes cannot safely rotate
+    a shared one.
+    """
+    path = os.path.abspath(settings.LIBRARY_TRAFFIC_LOG.format(pid=os.getpid()))
+    capture = logging.getLogger(f'library.traffic.capture:{path}')
+    if not capture.handlers:
+        handler = RotatingFileHandler(
+            path, maxBytes=settings.LIBRARY_TRAFFIC_LOG_MAX_BYTES,
+            backupCount=settings.LIBRARY_TRAFFIC_LOG_BACKUPS, encoding='utf-8',
+        )
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        capture.addHandler(handler)
+        capture.setLevel(logging.INFO)
+        capture.propagate = False
+    return capture
+
+
+class TrafficCaptureMiddleware:
+    """
+    Records `LIBRARY_TRAFFIC_SAMPLE_RATE` of the API requests to the
+    `LIBRARY_TRAFFIC_LOG` file, one JSON object per line:
+
+        {"ts": 1760850000.12, "method": "GET", "path": "/api/books/",
+         "route": "book-list", "query": {"search": ["dune"]}, "body": null,
+         "role": "student", "status": 200, "duration_ms": 12.4}
+
+    Personal data in bodies and query strings is scrubbed (see
+    `SCRUBBED_FIELDS`). Streaming responses (the event stream) are not
+    recorded. The middleware removes itself when `LIBRARY_TRAFFIC_LOG` is
+    not set, and a request which is not sampled costs one random number.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.LIBRARY_TRAFFIC_LOG:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.sample_rate = settings.LIBRARY_TRAFFIC_SAMPLE_RATE
+        self.capture = capture_logger()
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def sampled(self, request):
+        """Returns whether `request` is recorded."""
+        return request.path.startswith(PREFIX) and random.random() < self.sample_rate
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if not self.sampled(request):
+            return self.get_response(request)
+        body = read_body(request)
+        timestamp, started = time.time(), time.perf_counter()
+        response = self.get_response(request)
+        return self.record(request, response, body, timestamp, started)
+
+    async def __acall__(self, request):
+        if not self.sampled(request):
+            return await self.get_response(request)
+        body = read_body(request)
+        timestamp, started = time.time(), time.perf_counter()
+        response = await self.get_response(request)
+        return self.record(request, response, body, timestamp, started)
+
+    def record(self, request, response, body, timestamp, started):
+        """Writes the log line of a sampled request and returns its response."""
+        duration_ms = round((time.perf_counter() - started) * 1000, 2)
+        if response.streaming:
+            return response
+
+        match = request.resolver_match
+        record = {
+            'ts': round(timestamp, 3),
+            'method': request.method,
+            'path': request.path,
+            'route': match.url_name if match and match.url_name else request.path,
+            'query': scrub_query(request.GET),
+            'body': body,
+            'role': request_role(request),
+            'status': response.status_code,
+            'duration_ms': duration_ms,
+        }
+        try:
+            self.capture.info(json.dumps(record, default=str))
+        except Exception:
+            logger.exception('Could not record request %s %s', request.method, request.path)
+        return response
+
+
+def read_log(paths):
+    """
+    Returns the requests recorded in the NDJSON files `paths`, in timestamp
+    order. Lines which are not valid records are skipped.
+    """
+    records = []
+    for path in paths:
+        with open(path, encoding='utf-8') as log:
+            for line in log:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if isinstance(record, dict) and {'ts', 'method', 'path'} <= record.keys():
+                    records.append(record)
+    records.sort(key=lambda record: record['ts'])
+    return records
@@ -9,7 +9,9 @@ Author: Raul Berrios
 """
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import UserViewSet, BookViewSet, CheckoutViewSet, current_user_api
+from .batch import batch_api
+from .events import event_stream, event_ticket
+from .views import UserViewSet, BookViewSet, CheckoutViewSet, HoldViewSet, ReportViewSet, TaskViewSet, current_user_api, dashboard_api
 
 # Create a router and register our viewsets with it.
 router = DefaultRouter()
@@ -18,6 +20,9 @@ router.register(r'books', BookViewSet)
 # The `basename` is provided for the CheckoutViewSet because its `get_queryset`
 # method is dynamic, preventing DRF from automatically inferring the model name.
 router.register(r'checkouts', CheckoutViewSet, basename='checkout')
+router.register(r'holds', HoldViewSet, basename='hold')
+router.register(r'reports', ReportViewSet, basename='report')
+router.register(r'tasks', TaskViewSet, basename='task')
 
 
 # The API URLs are now determined automatically by the router.
@@ -25,4 +30,8 @@ router.register(r'checkouts', CheckoutViewSet, basename='checkout')
 urlpatterns = [
     path('', include(router.urls)),
     path('me/', current_user_api, name='current-user'),
+    path('me/dashboard/', dashboard_api, name='dashboard'),
+    path('events/', event_stream, name='event-stream'),
+    path('events/ticket/', event_ticket, name='event-ticket'),
+    path('batch/', batch_api, name='batch'),
 ]
@@ -7,24 +7,43 @@ handling the logic for user, book, and checkout management.
 
 Author: Raul Berrios
 """
-from django.db import transaction, IntegrityError
+from django.conf import settings
+from django.db import IntegrityError
 from django.utils import timezone
-from django.db.models import F
-from rest_framework import viewsets, status, filters
+from django.db.models import Count, OuterRef, Prefetch, Q, Subquery, Sum
+from django.utils.dateparse import parse_date
+from rest_framework import mixins, viewsets, status, filters
 from rest_framework.decorators import action, api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from rest_framework.response import Response
+from rest_framework.reverse import reverse
 from rest_framework.exceptions import ValidationError
-from drf_spectacular.utils import extend_schema
+from drf_spectacular.types import OpenApiTypes
+from drf_spectacular.utils import OpenApiParameter, extend_schema, extend_schema_view
 
-from .models import User, Book, Checkout
+from .autocomplete import complete
+from .cache import book_key, dashboard_key, dashboard_timeout, get_versioned, invalidate_books, set_versioned
+from .circulation import cancel_hold, checkout_book, place_hold, return_checkout
+from .fieldsets import Fieldset, shape_book_queryset, shape_checkout_queryset
+from .idempotency import IDEMPOTENCY_PARAMETER, idempotent
+from .models import User, Book, BookStockShard, Checkout, CirculationDaily, Hold, RelatedBook, Task
+from .pagination import OverdueCursorPagination
 from .permissions import IsLibrarian, IsStudent
+from .search import SearchDocumentFilter
+from .provisioning import prepare_users
+from .tasks import enqueue, run_provision_users
 from .serializers import (
     UserSerializer,
     BookSerializer,
+    BulkUserSerializer,
     CheckoutStudentSerializer,
     CheckoutLibrarianSerializer,
     CreateCheckoutSerializer,
+    DashboardSerializer,
+    EnqueueCommandSerializer,
+    HoldSerializer,
+    RelatedBookSerializer,
+    TaskSerializer,
 )
 
 @extend_schema(
@@ -40,6 +59,77 @@ def current_user_api(request):
     return Response(serializer.data)
 
 
+def hold_position_subquery():
+    """
+    Returns an expression computing a pending hold's 1-based position in
+    its book's queue (the number of pending holds placed up to it).
+    """
+    ahead = (
+        Hold.objects.filter(book=OuterRef('book'), status=Hold.PENDING)
+        .filter(Q(created_at__lt=OuterRef('created_at')) | Q(created_at=OuterRef('created_at'), id__lte=OuterRef('id')))
+        .order_by()
+        .values('book')
+        .annotate(count=Count('pk'))
+        .values('count')
+    )
+    return Subquery(ahead)
+
+
+# Number of returned loans shown in the dashboard's history.
+DASHBOARD_HISTORY_SIZE = 10
+
+
+@extend_schema(
+    responses={200: DashboardSerializer},
+)
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def dashboard_api(request):
+    """
+    Returns everything the student app shows after login in one response:
+    the user's profile, active loans with their due status, the most recent
+    returned loans and pending holds with their position in the queue.
+
+    The dashboard is built with three queries (active loans, history and
+    holds, each joined with its books) and cached per user until one of
+    the user's loans or holds changes (see `library.circulation`), a loan
+    becomes overdue, or `LIBRARY_DASHBOARD_CACHE_SECONDS` elapse.
+    """
+    user = request.user
+    key = dashboard_key(user.pk)
+    cached, versions = get_versioned([key])
+    data = cached.get(key)
+    if data is None:
+        now = timezone.now()
+        loans = Checkout.objects.filter(student=user).select_related('book')
+        checkouts = list(loans.filter(return_date__isnull=True).order_by('due_date', 'id'))
+        history = list(loans.filter(return_date__isnull=False).order_by('-return_date', '-id')[:DASHBOARD_HISTORY_SIZE])
+        holds = (
+            Hold.objects.filter(student=user, status=Hold.PENDING)
+            .select_related('book')
+            .annotate(position=hold_position_subquery())
+            .order_by('created_at', 'id')
+        )
+        dashboard = {'user': user, 'checkouts': checkouts, 'history': history, 'holds': holds}
+        data = DashboardSerializer(dashboard, context={'now': now}).data
+        next_due = min((c.due_date for c in checkouts if c.due_date and c.due_date > now), default=None)
+        set_versioned({key: data}, versions, dashboard_timeout(next_due, now))
+    return Response(data)
+
+
+# Query parameters understood by serializers using SparseFieldsetMixin.
+FIELDSET_PARAMETERS = [
+    OpenApiParameter('fields', str, description='Comma separated (dotted) fields to return, e.g. `id,book.title`.'),
+    OpenApiParameter('expand', str, description='Comma separated relations to nest; others are returned as IDs.'),
+]
+
+
+def task_accepted(request, task):
+    """Returns the 202 response of a request whose work was queued as `task`."""
+    url = reverse('task-detail', kwargs={'pk': task.pk}, request=request)
+    return Response(TaskSerializer(task).data, status=status.HTTP_202_ACCEPTED, headers={'Location': url})
+
+
 class UserViewSet(viewsets.ModelViewSet):
     """
     Provides the API endpoints for viewing and editing users.
@@ -52,19 +142,65 @@ class UserViewSet(viewsets.ModelViewSet):
     serializer_class = UserSerializer
     permission_classes = [IsAdminUser | IsLibrarian] # Superusers or Librarians
 
+    @extend_schema(
+        request=BulkUserSerializer(many=True),
+        parameters=[OpenApiParameter('background', bool, description='Create the users in a background task and return it (202).')],
+        responses={200: OpenApiTypes.OBJECT, 202: TaskSerializer},
+    )
+    @action(detail=False, methods=['post'])
+    def bulk(self, request):
+        """
+        Creates many users at once from a list of user objects.
 
+        Rows are validated and checked for duplicate usernames as a batch,
+        passwords are hashed in parallel and the users are inserted with a
+        single `bulk_create` (see `library.provisioning`). Invalid rows are
+        reported individually and do not prevent the others from being
+        created. With `?background=true`, the rows are validated and their
+        passwords hashed before they are queued, and the users are created by
+        a background task, whose status and results are at `/api/tasks/{id}/`.
+        """
+        rows = request.data
+        if not isinstance(rows, list):
+            raise ValidationError({'detail': 'Expected a list of users.'})
+        if len(rows) > settings.LIBRARY_BULK_USERS_MAX:
+            raise ValidationError({'detail': f'At most {settings.LIBRARY_BULK_USERS_MAX} users can be created per request.'})
+
+        if request.query_params.get('background') in ('1', 'true'):
+            results, users = prepare_users(rows)
+            task = enqueue('provision_users', user=request.user, results=results, users=users)
+            return task_accepted(request, task)
+        return Response(run_provision_users(rows))
+
+
+@extend_schema_view(
+    list=extend_schema(parameters=FIELDSET_PARAMETERS),
+    retrieve=extend_schema(parameters=FIELDSET_PARAMETERS),
+)
 class BookViewSet(viewsets.ModelViewSet):
     """
     Provides API endpoints for managing books in the library.
 
     Allows for listing, searching, creating, updating, and deleting books.
-    Access is controlled based on the user's role.
+    Access is controlled based on the user's role. Responses support sparse
+    fieldsets through the `?fields=` query parameter.
     """
     queryset = Book.objects.all()
     serializer_class = BookSerializer
     filter_backends = [filters.SearchFilter]
     search_fields = ['title', 'author', 'genre']
 
+    def get_queryset(self):
+        """
+        Narrows the queryset to the requested fields.
+
+        The active checkout count is annotated in the same query (instead of
+        one COUNT per book) and skipped entirely when neither
+        `checked_out_count` nor `available` was requested.
+        """
+        fieldset = Fieldset.from_request(self.request)
+        return shape_book_queryset(super().get_queryset(), fieldset, self.get_serializer_class())
+
     def get_permissions(self):
         """
         Dynamically sets permissions based on the action.
@@ -78,7 +214,115 @@ class BookViewSet(viewsets.ModelViewSet):
             self.permission_classes = [IsAuthenticated]
         return super().get_permissions()
 
+    def perform_update(self, serializer):
+        """Saves the book and drops its cached representation."""
+        serializer.save()
+        invalidate_books([serializer.instance.pk])
+
+    def perform_destroy(self, instance):
+        """Deletes the book and drops its cached representation."""
+        invalidate_books([instance.pk])
+        instance.delete()
+
+    @extend_schema(
+        parameters=[
+            OpenApiParameter('q', str, required=True, description='The text typed so far.'),
+            OpenApiParameter('limit', int, description='Maximum number of completions (default 10, at most 50).'),
+        ],
+        responses={200: OpenApiTypes.OBJECT},
+    )
+    @action(detail=False, methods=['get'], pagination_class=None)
+    def autocomplete(self, request):
+        """
+        Completes the title or author being typed in a search box:
+
+            {"results": [{"text": "Dune Messiah", "kind": "title"},
+                         {"text": "Dune", "kind": "title"}]}
+
+        Completions come from an in-memory prefix index of every title and
+        author (see `library.autocomplete`), so a lookup does not touch the
+        database. Matches start at any word, in alphabetical order of the
+        matched text. While a process builds its index, titles and authors
+        starting with `q` are looked up in the database instead.
+        """
+        try:
+            limit = max(1, min(int(request.query_params.get('limit', 10)), 50))
+        except ValueError:
+            raise ValidationError({'limit': 'Enter a whole number.'})
+        return Response({'results': complete(request.query_params.get('q', ''), limit)})
+
+    @extend_schema(
+        parameters=[
+            OpenApiParameter('ids', str, required=True, description='Comma separated book IDs, e.g. `3,1,2`.'),
+            FIELDSET_PARAMETERS[0],
+        ],
+        responses={200: OpenApiTypes.OBJECT},
+    )
+    @action(detail=False, methods=['get'], url_path='bulk', pagination_class=None)
+    def bulk_retrieve(self, request):
+        """
+        Returns the books with the given `?ids=`, in the requested order,
+        and the IDs that do not exist:
+
+            {"results": [{"id": 3, ...}, {"id": 1, ...}], "missing": [2]}
 
+        Each book is served from the cache when possible (see
+        `library.cache.invalidate_books`); the others are loaded with a
+        single query, their checkout counts and shard totals annotated, and
+        cached for `LIBRARY_BOOK_CACHE_SECONDS`.
+        """
+        try:
+            ids = list(dict.fromkeys(int(value) for value in request.query_params.get('ids', '').split(',') if value.strip()))
+        except ValueError:
+            raise ValidationError({'ids': 'Enter a comma separated list of book IDs.'})
+        if not ids:
+            raise ValidationError({'ids': 'This parameter is required.'})
+        if len(ids) > settings.LIBRARY_BULK_BOOKS_MAX:
+            raise ValidationError({'ids': f'At most {settings.LIBRARY_BULK_BOOKS_MAX} books can be fetched per request.'})
+
+        cached, versions = get_versioned([book_key(book_id) for book_id in ids])
+        books = {book_id: cached[book_key(book_id)] for book_id in ids if book_key(book_id) in cached}
+        misses = [book_id for book_id in ids if book_id not in books]
+        if misses:
+            # Cache full representations, so any ?fields= can be served from them.
+            queryset = shape_book_queryset(Book.objects.filter(pk__in=misses), Fieldset(), BookSerializer)
+            loaded = {book['id']: book for book in BookSerializer(queryset, many=True).data}
+            set_versioned({book_key(book_id): book for book_id, book in loaded.items()}, versions, settings.LIBRARY_BOOK_CACHE_SECONDS)
+            books.update(loaded)
+
+        fieldset = Fieldset.from_request(request)
+        results = [
+            {name: value for name, value in books[book_id].items() if fieldset.includes(name)}
+            for book_id in ids if book_id in books
+        ]
+        return Response({'results': results, 'missing': [book_id for book_id in ids if book_id not in books]})
+
+    @extend_schema(responses={200: RelatedBookSerializer(many=True)})
+    @action(detail=True, methods=['get'], pagination_class=None)
+    def related(self, request, pk=None):
+        """
+        Lists the books most often borrowed by the students who borrowed
+        this one, best match first.
+
+        The recommendations are precomputed by `manage.py build_related`, so
+        this is an indexed read of at most a few rows plus one query for the
+        related books themselves.
+        """
+        book = self.get_object()
+        books = shape_book_queryset(Book.objects.all(), Fieldset.from_request(request), BookSerializer, 'related.')
+        related = (
+            RelatedBook.objects.filter(book=book)
+            .order_by('rank')
+            .prefetch_related(Prefetch('related', queryset=books))
+        )
+        serializer = RelatedBookSerializer(related, many=True, context=self.get_serializer_context())
+        return Response(serializer.data)
+
+
+@extend_schema_view(
+    list=extend_schema(parameters=FIELDSET_PARAMETERS),
+    retrieve=extend_schema(parameters=FIELDSET_PARAMETERS),
+)
 class CheckoutViewSet(viewsets.ModelViewSet):
     """
     Provides API endpoints for managing book checkouts.
@@ -87,9 +331,15 @@ class CheckoutViewSet(viewsets.ModelViewSet):
       view their own active checkouts.
     - **Librarians**: Can view all active checkouts across all students and
       mark books as returned.
+
+    Responses support sparse fieldsets and controllable nesting through the
+    `?fields=` and `?expand=` query parameters.
     """
     permission_classes = [IsAuthenticated]
-    filter_backends = [filters.SearchFilter]
+    filter_backends = [SearchDocumentFilter]
+    # Librarians search the student's username and names and the book's title
+    # and author through the denormalized `Checkout.search_document`.
+    search_document_field = 'search_document'
     search_fields = ['student__username', 'student__first_name', 'student__last_name', 'book__title', 'book__author']
 
     def get_queryset(self):
@@ -98,15 +348,22 @@ class CheckoutViewSet(viewsets.ModelViewSet):
 
         - Librarians can see all active checkouts.
         - Students can only see their own active checkouts.
+
+        The queryset is then narrowed to the requested fields: nested books
+        and students are only loaded when they are rendered.
         """
         user = self.request.user
         if user.is_authenticated:
             if user.role == 'librarian':
                 # Librarians can see all checkouts
-                return Checkout.objects.filter(return_date__isnull=True)
+                queryset = Checkout.objects.filter(return_date__isnull=True)
             elif user.role == 'student':
                 # Students see only their own active checkouts
-                return Checkout.objects.filter(student=user, return_date__isnull=True)
+                queryset = Checkout.objects.filter(student=user, return_date__isnull=True)
+            else:
+                return Checkout.objects.none()
+            fieldset = Fieldset.from_request(self.request)
+            return shape_checkout_queryset(queryset, fieldset, self.get_serializer_class())
         return Checkout.objects.none()
 
     def get_serializer_class(self):
@@ -129,14 +386,18 @@ class CheckoutViewSet(viewsets.ModelViewSet):
     def filter_queryset(self, queryset):
         """
         Dynamically sets the search_fields based on the user's role.
-        Students can only search their checkouts by book title or author.
+        Students can only search their checkouts by book title or author;
+        their few loans are searched with the joined columns directly.
         """
         user = self.request.user
         if user.is_authenticated and user.role == 'student':
+            self.search_document_field = None
             self.search_fields = ['book__title', 'book__author']
-        # For librarians, the default search_fields will be used.
+        # Librarians search the lowercased `Checkout.search_document` (see `search_document_field`).
         return super().filter_queryset(queryset)
 
+    @extend_schema(parameters=[IDEMPOTENCY_PARAMETER])
+    @idempotent
     def create(self, request, *args, **kwargs):
         """
         Handles the creation of a new checkout record.
@@ -144,6 +405,8 @@ class CheckoutViewSet(viewsets.ModelViewSet):
         This method validates the request and wraps the creation logic in a
         transaction to ensure atomicity. It also provides a user-friendly
         error message if a student tries to check out a book they already have.
+        Retries sent with the same `Idempotency-Key` header get the original
+        response (see `library.idempotency`).
         """
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
@@ -161,33 +424,259 @@ class CheckoutViewSet(viewsets.ModelViewSet):
         """
         Performs the creation of a checkout and updates the book's stock.
 
-        This is called by `create` and executes within a database transaction.
-        It decrements the book's stock and saves the new checkout record.
+        This is called by `create` and executes within a database transaction
+        (see `library.circulation.checkout_book`). It decrements the book's
+        stock, saves the new checkout record and updates the rollups.
         """
         book = serializer.validated_data['book']
-        with transaction.atomic():
-            # Decrease book stock
-            Book.objects.filter(id=book.id).update(stock=F('stock') - 1)
-            # Save the checkout record
-            serializer.save(student=self.request.user)
+        serializer.instance = checkout_book(self.request.user, book)
+
+    @extend_schema(parameters=FIELDSET_PARAMETERS)
+    @action(detail=False, methods=['get'], permission_classes=[IsLibrarian],
+            pagination_class=OverdueCursorPagination)
+    def overdue(self, request):
+        """
+        Lists overdue loans, oldest due date first. Only accessible by Librarians.
 
+        Uses keyset (cursor) pagination over the partial index on the due
+        date of active loans.
+        """
+        queryset = self.filter_queryset(self.get_queryset()).filter(due_date__lt=timezone.now())
+        page = self.paginate_queryset(queryset)
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
+    @extend_schema(parameters=[IDEMPOTENCY_PARAMETER])
     @action(detail=True, methods=['post'], permission_classes=[IsLibrarian])
+    @idempotent
     def return_book(self, request, pk=None):
         """
         Marks a checkout as returned. Only accessible by Librarians.
 
-        This action sets the `return_date` to the current time and increments
-        the corresponding book's stock count.
+        This action sets the `return_date` to the current time and, in the
+        same transaction, lends the copy to the next student waiting in the
+        book's hold queue or, if nobody is waiting, increments the book's
+        stock count. Supports the `Idempotency-Key` header like `create`.
         """
         checkout = self.get_object()
-        if checkout.return_date:
+        returned, hold = return_checkout(checkout)
+        if not returned:
             return Response({'status': 'Book already returned'}, status=status.HTTP_400_BAD_REQUEST)
 
-        with transaction.atomic():
-            # Increase book stock
-            Book.objects.filter(id=checkout.book.id).update(stock=F('stock') + 1)
-            # Mark as returned
-            checkout.return_date = timezone.now()
-            checkout.save()
+        data = {'status': 'Book returned successfully'}
+        if hold is not None:
+            data['allocated_hold'] = hold.id
+        return Response(data)
+
+
+class HoldViewSet(mixins.CreateModelMixin,
+                  mixins.ListModelMixin,
+                  mixins.RetrieveModelMixin,
+                  mixins.DestroyModelMixin,
+                  viewsets.GenericViewSet):
+    """
+    Provides API endpoints for hold (reservation) queues.
+
+    - **Students**: Can place a hold on an out-of-stock book, see their holds
+      with their position in the queue, and cancel (DELETE) a pending hold.
+      When a copy is returned it is checked out to the first student in the
+      queue automatically, so there is no need to poll the book for stock.
+    - **Librarians**: Can see and cancel all pending holds.
+    """
+    serializer_class = HoldSerializer
+    permission_classes = [IsAuthenticated]
+
+    def get_queryset(self):
+        """
+        Returns the user's holds (all pending holds for librarians), with
+        each pending hold's position in its book's queue annotated.
+        """
+        user = self.request.user
+        if not user.is_authenticated:
+            return Hold.objects.none()
+        if user.role == 'librarian':
+            queryset = Hold.objects.filter(status=Hold.PENDING)
+        else:
+            queryset = Hold.objects.filter(student=user)
+
+        return queryset.annotate(position=hold_position_subquery()).order_by('created_at', 'id')
+
+    def get_permissions(self):
+        """Only students can place holds; anyone authenticated can view or cancel their own."""
+        if self.action == 'create':
+            self.permission_classes = [IsStudent]
+        return super().get_permissions()
+
+    def perform_create(self, serializer):
+        """Appends the hold to the book's queue under the book's row lock."""
+        serializer.instance = place_hold(self.request.user, serializer.validated_data['book'])
+
+    def destroy(self, request, *args, **kwargs):
+        """Cancels a pending hold instead of deleting the record."""
+        hold = self.get_object()
+        if not cancel_hold(hold):
+            return Response({'status': 'Hold is no longer pending'}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
 
-        return Response({'status': 'Book returned successfully'})
+# Query parameters shared by the circulation reports.
+REPORT_PARAMETERS = [
+    OpenApiParameter('start', OpenApiTypes.DATE, description='First day of the period (default: first day of this month).'),
+    OpenApiParameter('end', OpenApiTypes.DATE, description='Last day of the period (default: today).'),
+    OpenApiParameter('limit', int, description='Maximum number of titles returned (default: 10, max: 100).'),
+]
+
+
+class ReportViewSet(viewsets.ViewSet):
+    """
+    Provides circulation reports for Librarians.
+
+    All reports read the daily rollup table (`CirculationDaily`) instead of
+    aggregating the checkout history, so they answer in constant time with
+    respect to the size of that history. Reports cover the period given by
+    the `start` and `end` query parameters (ISO dates, inclusive), which
+    defaults to the current month.
+    """
+    permission_classes = [IsLibrarian]
+
+    def get_period(self):
+        """Returns the (start, end) dates requested, validating them."""
+        today = timezone.localdate()
+        period = []
+        for name, default in (('start', today.replace(day=1)), ('end', today)):
+            value = self.request.query_params.get(name)
+            day = parse_date(value) if value else default
+            if day is None:
+                raise ValidationError({name: 'Enter a valid date (YYYY-MM-DD).'})
+            period.append(day)
+        if period[0] > period[1]:
+            raise ValidationError({'start': 'The start date must not be after the end date.'})
+        return tuple(period)
+
+    def get_limit(self):
+        """Returns the requested number of titles, between 1 and 100."""
+        try:
+            return max(1, min(int(self.request.query_params.get('limit', 10)), 100))
+        except ValueError:
+            raise ValidationError({'limit': 'Enter a whole number.'})
+
+    def get_rollups(self):
+        """Returns the rollup rows of the requested period."""
+        start, end = self.get_period()
+        return CirculationDaily.objects.filter(date__gte=start, date__lte=end)
+
+    @extend_schema(responses=OpenApiTypes.OBJECT)
+    def list(self, request):
+        """Lists the available reports."""
+        return Response({
+            name: reverse(f'report-{name}', request=request)
+            for name in ('most-borrowed', 'genres', 'utilization')
+        })
+
+    @extend_schema(parameters=REPORT_PARAMETERS, responses=OpenApiTypes.OBJECT)
+    @action(detail=False, url_path='most-borrowed')
+    def most_borrowed(self, request):
+        """Returns the most borrowed titles of the period."""
+        rows = (
+            self.get_rollups()
+            .values('book_id', 'book__title', 'book__author', 'book__genre')
+            .annotate(checkouts=Sum('checkouts'))
+            .filter(checkouts__gt=0)
+            .order_by('-checkouts', 'book_id')[:self.get_limit()]
+        )
+        return Response([
+            {'book': row['book_id'], 'title': row['book__title'], 'author': row['book__author'],
+             'genre': row['book__genre'], 'checkouts': row['checkouts']}
+            for row in rows
+        ])
+
+    @extend_schema(parameters=REPORT_PARAMETERS[:2], responses=OpenApiTypes.OBJECT)
+    @action(detail=False)
+    def genres(self, request):
+        """Returns the checkouts and returns per genre per day of the period."""
+        rows = (
+            self.get_rollups()
+            .values('date', 'genre')
+            .annotate(checkouts=Sum('checkouts'), returns=Sum('returns'))
+            .order_by('date', 'genre')
+        )
+        return Response(list(rows))
+
+    @extend_schema(parameters=REPORT_PARAMETERS, responses=OpenApiTypes.OBJECT)
+    @action(detail=False)
+    def utilization(self, request):
+        """
+        Returns per-title utilization for the period, busiest titles first.
+
+        `loan_days` is the total duration of the loans returned in the
+        period; `utilization` divides it by the days a title's copies
+        (current stock plus active loans) were available in the period.
+        """
+        start, end = self.get_period()
+        days = (end - start).days + 1
+        rows = list(
+            self.get_rollups()
+            .values('book_id', 'book__title', 'book__stock')
+            .annotate(checkouts=Sum('checkouts'), returns=Sum('returns'), loan_seconds=Sum('loan_seconds'))
+            .order_by('-loan_seconds', 'book_id')[:self.get_limit()]
+        )
+        book_ids = [row['book_id'] for row in rows]
+        active = dict(
+            Checkout.objects.filter(book_id__in=book_ids, return_date__isnull=True)
+            .values('book_id').annotate(count=Count('pk')).values_list('book_id', 'count')
+        )
+        sharded = dict(
+            BookStockShard.objects.filter(book_id__in=book_ids)
+            .values('book_id').annotate(total=Sum('count')).values_list('book_id', 'total')
+        )
+        results = []
+        for row in rows:
+            copies = row['book__stock'] + sharded.get(row['book_id'], 0) + active.get(row['book_id'], 0)
+            loan_days = row['loan_seconds'] / 86400
+            results.append({
+                'book': row['book_id'],
+                'title': row['book__title'],
+                'copies': copies,
+                'checkouts': row['checkouts'],
+                'returns': row['returns'],
+                'loan_days': round(loan_days, 2),
+                'utilization': round(loan_days / (copies * days), 4) if copies else None,
+            })
+        return Response(results)
+
+
+class TaskViewSet(mixins.CreateModelMixin,
+                  mixins.ListModelMixin,
+                  mixins.RetrieveModelMixin,
+                  viewsets.GenericViewSet):
+    """
+    Provides the background tasks to Librarians: their status and result,
+    and the queueing of maintenance commands.
+
+    `POST /api/tasks/` runs one of the management commands listed in
+    `LIBRARY_TASK_COMMANDS` (e.g. `rollup_circulation`) in the background
+    and returns the queued task at once (202); `GET /api/tasks/{id}/`
+    reports its progress and, once finished, its output. Tasks are run by
+    `manage.py run_worker`.
+    """
+    queryset = Task.objects.order_by('-id')
+    serializer_class = TaskSerializer
+    permission_classes = [IsLibrarian]
+
+    def get_queryset(self):
+        """Filters the tasks by `?status=` and `?name=` when given."""
+        queryset = super().get_queryset()
+        for field in ('status', 'name'):
+            value = self.request.query_params.get(field)
+            if value:
+                queryset = queryset.filter(**{field: value})
+        return queryset
+
+    @extend_schema(request=EnqueueCommandSerializer, responses={202: TaskSerializer})
+    def create(self, request, *args, **kwargs):
+        """Queues a management command and returns its task."""
+        serializer = EnqueueCommandSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        task = enqueue('command', priority=data['priority'], user=request.user, command=data['command'], args=data['args'])
+        return task_accepted(request, task)
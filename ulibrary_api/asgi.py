@@ -6,6 +6,11 @@ It configures the ASGI entry-point for the application, allowing it to be
 served by ASGI-compliant web servers. It exposes the ASGI callable as a
 module-level variable named ``application``.
 
+Serving through ASGI is required for the Server-Sent Events feed at
+``/api/events/`` (``library.events``): each open stream is then a suspended
+coroutine instead of a blocked worker. In Docker, gunicorn runs this
+application with uvicorn workers.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/4.1/ref/settings/
 
 Author: Raul Berrios
 """
+import json
 import os
 from pathlib import Path
 import dj_database_url
@@ -60,6 +61,8 @@ INSTALLED_APPS = [
 # A list of middleware to be executed for each request/response.
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'library.traffic.TrafficCaptureMiddleware',  # Disabled unless LIBRARY_TRAFFIC_LOG is set.
+    'library.budget.RequestBudgetMiddleware',  # SQL query, time and statement timeout limits per request.
     'corsheaders.middleware.CorsMiddleware',  # Should be placed high, but after SecurityMiddleware.
     'whitenoise.middleware.WhiteNoiseMiddleware',  # WhiteNoise middleware for static files
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -98,9 +101,47 @@ WSGI_APPLICATION = 'ulibrary_api.wsgi.application'
 # https://docs.djangoproject.com/en/4.1/ref/settings/#databases
 
 # Database configuration. Uses dj_database_url to parse the DATABASE_URL environment variable.
+# Without DATABASE_URL, an embedded SQLite database at LIBRARY_SQLITE_PATH is used, for
+# single-node deployments.
 DATABASES = {}
 if 'DATABASE_URL' in os.environ:
     DATABASES['default'] = dj_database_url.config(conn_max_age=600, ssl_require=False)
+else:
+    DATABASES['default'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.getenv('LIBRARY_SQLITE_PATH', str(BASE_DIR / 'db.sqlite3')),
+        'CONN_MAX_AGE': 600,
+    }
+
+# SQLite tuning, applied to every SQLite connection. WAL lets readers run while a write
+# is in progress, and synchronous=NORMAL only syncs at checkpoints in WAL mode. Writers
+# wait up to LIBRARY_SQLITE_BUSY_TIMEOUT seconds for the write lock instead of failing
+# with "database is locked"; transactions take that lock when they begin (IMMEDIATE), so
+# a transaction that reads before writing cannot fail to upgrade its lock halfway.
+# LIBRARY_SQLITE_MMAP_SIZE (bytes) and LIBRARY_SQLITE_CACHE_SIZE (KiB) size the
+# memory-mapped I/O and the page cache of each connection.
+LIBRARY_SQLITE_BUSY_TIMEOUT = float(os.getenv('LIBRARY_SQLITE_BUSY_TIMEOUT', '20'))
+LIBRARY_SQLITE_MMAP_SIZE = int(os.getenv('LIBRARY_SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)))
+LIBRARY_SQLITE_CACHE_SIZE = int(os.getenv('LIBRARY_SQLITE_CACHE_SIZE', str(64 * 1024)))
+if DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3':
+    DATABASES['default'].setdefault('OPTIONS', {}).update({
+        'timeout': LIBRARY_SQLITE_BUSY_TIMEOUT,
+        'transaction_mode': 'IMMEDIATE',
+        'init_command': (
+            'PRAGMA journal_mode=WAL;'
+            'PRAGMA synchronous=NORMAL;'
+            f'PRAGMA mmap_size={LIBRARY_SQLITE_MMAP_SIZE};'
+            f'PRAGMA cache_size=-{LIBRARY_SQLITE_CACHE_SIZE};'
+            'PRAGMA temp_store=MEMORY'
+        ),
+    })
+
+# Cache configuration. Uses Redis (shared by all processes) when REDIS_URL is set,
+# and a per-process in-memory cache otherwise.
+if os.getenv('REDIS_URL'):
+    CACHES = {'default': {'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': os.getenv('REDIS_URL')}}
+else:
+    CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
 
 
 # Password validation
@@ -168,10 +209,24 @@ REST_FRAMEWORK = {
     # The default schema generator for API documentation.
     'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema',
      # Default pagination settings for API views.
-    'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
+    'DEFAULT_PAGINATION_CLASS': 'library.pagination.CountModePagination',
     'PAGE_SIZE': 100,
+    # orjson-backed JSON renderer/parser. Both fall back to the stdlib `json`
+    # implementation when orjson is not installed.
+    'DEFAULT_RENDERER_CLASSES': [
+        'library.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'library.renderers.FastJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
 }
 
+# Set to False to force the stdlib JSON code path even when orjson is installed.
+LIBRARY_FAST_JSON = os.getenv('LIBRARY_FAST_JSON', 'True').lower() in ('true', '1', 't')
+
 # CORS Settings - a list of origins that are authorized to make cross-site HTTP requests.
 # Update this to your React app's URL in production.
 CORS_ALLOWED_ORIGINS = [origin.strip() for origin in os.getenv('CORS_ALLOWED_ORIGINS', "http://localhost:3000,http://127.0.0.1:3000,http://localhost,http://cfmapp.com").split(',')]
@@ -203,5 +258,137 @@ SPECTACULAR_SETTINGS = {
     }
 }
 
+# Loan period, in days, by borrower role. Sets `Checkout.due_date` on checkout.
+LIBRARY_LOAN_PERIODS = {
+    'student': int(os.getenv('LIBRARY_STUDENT_LOAN_DAYS', '14')),
+    'librarian': int(os.getenv('LIBRARY_LIBRARIAN_LOAN_DAYS', '28')),
+}
+
+# Maximum number of active loans, by borrower role (see `User.active_checkout_count`).
+LIBRARY_LOAN_LIMITS = {
+    'student': int(os.getenv('LIBRARY_STUDENT_LOAN_LIMIT', '10')),
+    'librarian': int(os.getenv('LIBRARY_LIBRARIAN_LOAN_LIMIT', '25')),
+}
+
+# Update the circulation rollups inside the checkout/return transactions. When
+# disabled, run `manage.py rollup_circulation` periodically instead. The rollups of
+# sharded books are always left to `rollup_circulation`.
+LIBRARY_INLINE_ROLLUPS = os.getenv('LIBRARY_INLINE_ROLLUPS', 'True').lower() in ('true', '1', 't')
+
+# Idempotency-Key support on checkout POSTs: how long responses are kept for
+# retries, and how many keys are kept per user at most.
+LIBRARY_IDEMPOTENCY_TTL_SECONDS = int(os.getenv('LIBRARY_IDEMPOTENCY_TTL_SECONDS', '86400'))
+LIBRARY_IDEMPOTENCY_MAX_KEYS = int(os.getenv('LIBRARY_IDEMPOTENCY_MAX_KEYS', '1000'))
+
+# Default number of counter rows the stock of a title is split across by
+# `manage.py shard_stock`.
+LIBRARY_STOCK_SHARDS = int(os.getenv('LIBRARY_STOCK_SHARDS', '8'))
+
+# Bulk user provisioning (/api/users/bulk/, `manage.py import_users`). Passwords
+# are hashed by LIBRARY_HASH_WORKERS processes (0: one per CPU) for batches of at
+# least LIBRARY_HASH_PARALLEL_THRESHOLD users.
+LIBRARY_HASH_WORKERS = int(os.getenv('LIBRARY_HASH_WORKERS', '0'))
+LIBRARY_HASH_PARALLEL_THRESHOLD = int(os.getenv('LIBRARY_HASH_PARALLEL_THRESHOLD', '16'))
+LIBRARY_BULK_USERS_MAX = int(os.getenv('LIBRARY_BULK_USERS_MAX', '5000'))
+
+# Maximum time a student dashboard (/api/me/dashboard/) is cached. Dashboards are
+# also invalidated when the student's loans or holds change, which only reaches
+# other processes through a shared cache (REDIS_URL).
+LIBRARY_DASHBOARD_CACHE_SECONDS = int(os.getenv('LIBRARY_DASHBOARD_CACHE_SECONDS', '300'))
+
+# Event stream (/api/events/). The broker wakes up open streams when events are
+# committed; the default one only reaches streams served by the same process,
+# streams in other processes pick new events up every LIBRARY_EVENT_POLL_SECONDS.
+LIBRARY_EVENT_BROKER = os.getenv('LIBRARY_EVENT_BROKER', 'library.events.InProcessBroker')
+LIBRARY_EVENT_POLL_SECONDS = float(os.getenv('LIBRARY_EVENT_POLL_SECONDS', '5'))
+# Browsers open the stream with a signed ticket (POST /api/events/ticket/) in its URL
+# rather than their API token; a ticket is valid for this many seconds.
+LIBRARY_EVENT_TICKET_SECONDS = int(os.getenv('LIBRARY_EVENT_TICKET_SECONDS', '60'))
+
+# Admin changelists, and API lists requested with ?count=estimate, report the
+# planner's row estimate (PostgreSQL) or a count capped at
+# LIBRARY_EXACT_COUNT_THRESHOLD (other databases) for larger results. Estimates of
+# filtered API lists are cached for LIBRARY_COUNT_CACHE_SECONDS. The admin caches
+# its filter choices for LIBRARY_ADMIN_FILTER_CACHE_SECONDS.
+LIBRARY_EXACT_COUNT_THRESHOLD = int(os.getenv('LIBRARY_EXACT_COUNT_THRESHOLD', '10000'))
+LIBRARY_COUNT_CACHE_SECONDS = int(os.getenv('LIBRARY_COUNT_CACHE_SECONDS', '30'))
+LIBRARY_ADMIN_FILTER_CACHE_SECONDS = int(os.getenv('LIBRARY_ADMIN_FILTER_CACHE_SECONDS', '3600'))
+
+# GET /api/books/autocomplete/: maximum number of keys of the prefix index (roughly
+# 150 bytes each; a title or author of N words takes N keys), and how often it is
+# rebuilt, scanning the book table, to pick up changes made by other processes.
+# Every server process holds and rebuilds its own index: the default cap costs up
+# to about 150 MB per process, so multiply by the workers when raising it.
+LIBRARY_AUTOCOMPLETE_MAX_ENTRIES = int(os.getenv('LIBRARY_AUTOCOMPLETE_MAX_ENTRIES', '1000000'))
+LIBRARY_AUTOCOMPLETE_REFRESH_SECONDS = int(os.getenv('LIBRARY_AUTOCOMPLETE_REFRESH_SECONDS', '300'))
+
+# GET /api/books/bulk/: maximum number of IDs per request, and how long the
+# representation of a book is cached. Changes made through the API, the admin
+# and the circulation code invalidate it; the timeout bounds the staleness
+# after other writes (e.g. raw SQL).
+LIBRARY_BULK_BOOKS_MAX = int(os.getenv('LIBRARY_BULK_BOOKS_MAX', '100'))
+LIBRARY_BOOK_CACHE_SECONDS = int(os.getenv('LIBRARY_BOOK_CACHE_SECONDS', '300'))
+
+# POST /api/batch/: maximum number of sub-requests per batch, and of threads
+# running the sub-requests of a parallel batch.
+LIBRARY_BATCH_MAX_REQUESTS = int(os.getenv('LIBRARY_BATCH_MAX_REQUESTS', '20'))
+LIBRARY_BATCH_WORKERS = int(os.getenv('LIBRARY_BATCH_WORKERS', '4'))
+
+# Request budgets (see library/budget.py): the SQL queries, total SQL time and statement timeout
+# allowed per request, by URL name, over the 'default' budget; a route set to None is exempt.
+# LIBRARY_REQUEST_BUDGET_ROUTES overrides routes with a JSON object, e.g.
+# '{"report-circulation": {"sql_ms": 10000}}'. In 'log' mode requests over budget are served
+# with an X-Request-Budget header and logged; in 'enforce' mode they are stopped with a 503;
+# 'off' disables the middleware.
+LIBRARY_REQUEST_BUDGET_MODE = os.getenv('LIBRARY_REQUEST_BUDGET_MODE', 'log')
+LIBRARY_REQUEST_BUDGETS = {
+    'default': {
+        'queries': int(os.getenv('LIBRARY_REQUEST_MAX_QUERIES', '100')),
+        'sql_ms': float(os.getenv('LIBRARY_REQUEST_MAX_SQL_MS', '2000')),
+        'statement_timeout_ms': int(os.getenv('LIBRARY_STATEMENT_TIMEOUT_MS', '5000')),
+    },
+    # The event stream is long-lived and polls the outbox for as long as it is open.
+    'event-stream': None,
+}
+# A batch runs up to LIBRARY_BATCH_MAX_REQUESTS sub-requests within one request.
+LIBRARY_REQUEST_BUDGETS['batch'] = {
+    'queries': LIBRARY_REQUEST_BUDGETS['default']['queries'] * LIBRARY_BATCH_MAX_REQUESTS,
+    'sql_ms': LIBRARY_REQUEST_BUDGETS['default']['sql_ms'] * LIBRARY_BATCH_MAX_REQUESTS,
+}
+LIBRARY_REQUEST_BUDGETS.update(json.loads(os.getenv('LIBRARY_REQUEST_BUDGET_ROUTES', '{}')))
+
+# Background tasks (see library/tasks.py), run by `manage.py run_worker`: the tasks a worker runs
+# at a time, how often an idle worker polls the task table, the attempts per task and the delay
+# before the first retry (doubled for each further one), how often workers refresh the heartbeat
+# of their running tasks, after how long without one a running task is assumed to have lost its
+# worker and is queued again, and how long finished tasks are kept.
+# LIBRARY_TASK_COMMANDS are the management commands librarians may queue with POST /api/tasks/.
+LIBRARY_TASK_WORKERS = int(os.getenv('LIBRARY_TASK_WORKERS', '4'))
+LIBRARY_TASK_POLL_SECONDS = float(os.getenv('LIBRARY_TASK_POLL_SECONDS', '1'))
+LIBRARY_TASK_MAX_ATTEMPTS = int(os.getenv('LIBRARY_TASK_MAX_ATTEMPTS', '3'))
+LIBRARY_TASK_RETRY_SECONDS = float(os.getenv('LIBRARY_TASK_RETRY_SECONDS', '30'))
+LIBRARY_TASK_HEARTBEAT_SECONDS = float(os.getenv('LIBRARY_TASK_HEARTBEAT_SECONDS', '30'))
+LIBRARY_TASK_STALE_SECONDS = int(os.getenv('LIBRARY_TASK_STALE_SECONDS', '300'))
+LIBRARY_TASK_RETENTION_DAYS = int(os.getenv('LIBRARY_TASK_RETENTION_DAYS', '7'))
+LIBRARY_TASK_COMMANDS = [
+    command.strip() for command in os.getenv(
+        'LIBRARY_TASK_COMMANDS',
+        'rollup_circulation,build_related,scan_overdue,reconcile_stock,reconcile_loan_counts,'
+        'backfill_search_documents,prune_events,prune_idempotency_keys',
+    ).split(',') if command.strip()
+]
+
+# Traffic capture for load testing (see library/traffic.py). When LIBRARY_TRAFFIC_LOG is set,
+# LIBRARY_TRAFFIC_SAMPLE_RATE of the API requests are appended to it as NDJSON, for
+# `manage.py replay_traffic`. The file is rotated at LIBRARY_TRAFFIC_LOG_MAX_BYTES, keeping
+# LIBRARY_TRAFFIC_LOG_BACKUPS old files; use a {pid} placeholder with several worker processes.
+LIBRARY_TRAFFIC_LOG = os.getenv('LIBRARY_TRAFFIC_LOG', '')
+LIBRARY_TRAFFIC_SAMPLE_RATE = float(os.getenv('LIBRARY_TRAFFIC_SAMPLE_RATE', '0.1'))
+LIBRARY_TRAFFIC_LOG_MAX_BYTES = int(os.getenv('LIBRARY_TRAFFIC_LOG_MAX_BYTES', str(100 * 1024 * 1024)))
+LIBRARY_TRAFFIC_LOG_BACKUPS = int(os.getenv('LIBRARY_TRAFFIC_LOG_BACKUPS', '5'))
+
+# Precomputed OpenAPI schema served by /api/schema/ (see `manage.py build_schema`).
+LIBRARY_SCHEMA_ARTIFACT = os.getenv('LIBRARY_SCHEMA_ARTIFACT', str(BASE_DIR / 'openapi-schema.json'))
+
 # Grappelli Settings
 GRAPPELLI_ADMIN_TITLE = "ULibrary Administration"
@@ -11,10 +11,10 @@ Author: Raul Berrios
 from django.contrib import admin
 from django.urls import include, path
 from django.views.generic.base import RedirectView
-from drf_spectacular.views import (SpectacularAPIView, SpectacularRedocView,
-                                   SpectacularSwaggerView)
+from drf_spectacular.views import SpectacularRedocView, SpectacularSwaggerView
 from rest_framework.authtoken import views
 from django.views.decorators.csrf import csrf_exempt
+from library.schema import CachedSpectacularAPIView
 
 # Main URL patterns for the project.
 urlpatterns = [
@@ -33,9 +33,9 @@ urlpatterns = [
     # Include the URL patterns from the 'library' application, prefixed with "api/".
     path("api/", include("library.urls")),
 
-    # API schema generation endpoints provided by drf-spectacular.
-    # Generates the OpenAPI schema file.
-    path("api/schema/", SpectacularAPIView.as_view(), name="schema"),
+    # API schema endpoints provided by drf-spectacular.
+    # Serves the precomputed OpenAPI schema (see `manage.py build_schema`).
+    path("api/schema/", CachedSpectacularAPIView.as_view(), name="schema"),
     # Serves the interactive Swagger UI for the API.
     path(
         "api/schema/swagger-ui/",